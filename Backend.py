@@ -1,12 +1,98 @@
 # Calculator backend which loads json configs/recipes, and calculates mixes
 
-import json, pprint
-import pdb
+import json
+import hashlib, os, threading
+from collections import OrderedDict
+from RecipeStore import RecipeStore
+from RecipeSearch import SearchIndex, parse_query
+import RecipeSnapshot
+from Storage import FileStorage, is_database, storage_for
+import Stats
+from Stats import timer
+
+# default recipe library, next to the program
+CONFIG_FILE_NAME = 'vaperecipes.json'
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), CONFIG_FILE_NAME)
+
+# write the library out and cut the journal down once it gets this big, see compact_journal
+JOURNAL_COMPACT_BYTES = 1 << 20
+
+class MixResult(object):
+    """ Result of Backend.calculate_mix. Holds the raw volumes (all in mL) and the Max VG/PG
+    message, and only builds the text for the output box the first time str() or render() is called.
+    flavors and volumes are parallel tuples, sorted by flavor name.
+    """
+    __slots__ = ('recipe_name', 'mix', 'flavors', 'volumes', 'concentrate', 'nic', 'vg', 'pg',
+                 'makes', 'message', 'width', '_text')
+
+    def __init__(self, recipe_name, mix, flavors, volumes, concentrate, nic, vg, pg, makes, message=None,
+                 width=None):
+        self.recipe_name = recipe_name
+        self.mix = mix
+        self.flavors = flavors
+        self.volumes = volumes
+        self.concentrate = concentrate
+        self.nic = nic
+        self.vg = vg
+        self.pg = pg
+        self.makes = makes
+        self.message = message
+        self.width = width
+        self._text = None
+
+    def render(self):
+        if self._text is not None:
+            return self._text
+
+        mix = self.mix
+        if mix != 'from_concentrate':
+            width = self.width
+            if width is None:
+                width = max([len(f) for f in self.flavors] + [len('Nicotine')])
+            lines = ['%*s: %5.2f mL'%(width, f, v) for (f, v) in zip(self.flavors, self.volumes)]
+        else:
+            # "Concentrate" is longer than Nicotine, so it gets the max
+            width = len('Concentrate')
+            lines = ['Concentrate: %5.2f mL'%self.concentrate]
+
+        message = self.message
+        if mix != 'concentrate':
+            # add nic/VG/PG
+            lines += ['',
+                      ' '*(width-8) + 'Nicotine: %5.2f mL'%self.nic,
+                      ' '*(width-2) + 'VG: %5.2f mL'%self.vg,
+                      ' '*(width-2) + 'PG: %5.2f mL'%self.pg]
+        else:
+            message = ' '*(width-5) + 'Makes: %5.2f mL'%self.makes
+
+        if message is not None:
+            lines += ['', message]
+
+        self._text = '\n'.join(lines)
+        return self._text
+
+    def __str__(self):
+        return self.render()
 
 class Backend(object):
 
-    def __init__(self, arg=None):
+    def __init__(self, arg=None, cache_size=256):
         self.filename = None
+        # LRU cache of calculate_mix results, see calculate_mix
+        self._mix_cache = OrderedDict()
+        self._mix_cache_size = cache_size
+        self._cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+        self._recipe_versions = {}
+        # RecipeJournal of changes not in the json file yet, see attach_journal
+        self._journal = None
+        self._compaction = None
+        # _lock keeps _dirty in step with the recipe versions while a compaction thread is finishing,
+        # _write_lock keeps json/snapshot writes from overlapping. Writes are numbered when they
+        # start, so a compaction that lost the race against a newer save doesn't overwrite it.
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._write_seq = 0
+        self._written_seq = 0
         if arg is None:
             self._default_config()
         elif type(arg) == dict:
@@ -14,10 +100,7 @@ class Backend(object):
         elif type(arg) == str:
             # if arg is a string, assume it's a json filename
             try:
-                with open(arg) as fp:
-                    js = json.load(fp)
-                    self._import_config_dict(js)
-                    self.filename = arg
+                self.load_file(arg)
             except:
                 print("Error: Unable to load %s! Using default config"%arg)
                 self._default_config()
@@ -26,14 +109,46 @@ class Backend(object):
             self._default_config()
 
     def _default_config(self):
-        self._recipes = {}
+        # Recipes live in a columnar RecipeStore, which also serves as the per-recipe index
+        # (sorted flavors, total flavor, column width) and keeps the sorted recipe name list.
+        self._store = RecipeStore()
         self._nic_base = 'vg'
         self._nic_strength = 100.0
-
+        self._mix_cache.clear()
+        # RecipeSearch index, built the first time something is searched for
+        self._search = None
+        # RecipeMatrix of all recipes, built on demand and thrown away whenever a recipe changes
+        self._matrix = None
+        # names of recipes changed since the last load/save, so write_file knows if it has anything to do
+        self._dirty = set()
+        # for a library directory (see RecipeShards): shard -> set of recipe names, recipe -> shard,
+        # both None for a single file. A removed recipe stays in them until its shard is written.
+        self._shards = None
+        self._shard_of = None
+        # and shard -> (RecipeStore, nic_base, nic_strength), what else is in the shard's file: the
+        # copies of recipes that were ignored for the ones in other shards, and its own _config.
+        # Both are written back as they were whenever the shard is saved.
+        self._shard_files = None
+        # (recipe name or '_config', shard used, shard ignored) for everything in more than one shard
+        self._conflicts = []
+        # where the recipes came from and changes go back to, see Storage
+        self._storage = FileStorage(self)
+
+    def _put_recipe(self, recipe_name, recipe_data):
+        self._store.put(recipe_name, recipe_data)
+        self._bump_version(recipe_name)
+        if self._search is not None:
+            self._search.put(recipe_name, recipe_data)
+
+    def _bump_version(self, recipe_name):
+        # bumping the version makes any cached mixes of this recipe stale
+        self._recipe_versions[recipe_name] = self._recipe_versions.get(recipe_name, 0) + 1
+        self._matrix = None
 
     def _import_config_dict(self, arg):
         if '_recipes' in arg.keys():
-            self._recipes = self._check_recipes(arg['_recipes'])
+            self._default_config()
+            self._store.update(self._check_recipes(arg['_recipes']))
             try:
                 self._nic_base = arg['_config']['nic_base']
             except KeyError:
@@ -46,12 +161,51 @@ class Backend(object):
             # if there's no _recipes dict inside, then assume the whole file is
             # a dict of recipes, and use defaults for nic stuff
             self._default_config()
-            self._recipes = self._check_recipes(arg)
+            self._store.update(self._check_recipes(arg))
+
+    def load_file(self, filename, progress=None, snapshot=True):
+        """ Load a json recipe file, replacing whatever is loaded now """
+        for _ in self.iter_load(filename, progress, snapshot=snapshot):
+            pass
+
+    def iter_load(self, filename, progress=None, batch_size=1000, snapshot=True):
+        """ Load a json recipe file incrementally, replacing whatever is loaded now.
+        This is a generator: the file is streamed through RecipeLoader and each recipe is checked,
+        scaled and added as soon as it's parsed, so recipes can be used while the load is running
+        and the whole file never has to be in memory at once. It yields the number of recipes loaded
+        so far after every batch_size recipes (and once at the end) so that the caller can do
+        something else in between.
+        progress is passed on to RecipeLoader.iter_recipe_file, called with (bytes_read, total_bytes).
+        Raises IOError/ValueError if the file can't be read or isn't valid JSON.
+
+        filename can also be a directory of shards (see RecipeShards), which are loaded in parallel
+        and yielded shard by shard, or a recipe database (see RecipeDB), which is only opened: its
+        recipes are fetched as they're used.
+
+        If snapshot is set and there's an up-to-date RecipeSnapshot next to the file, the recipes are
+        mmap'd from that instead of parsing the json. Otherwise a new snapshot is written after loading.
+        """
+        self._default_config()
+        self._storage = storage_for(self, filename)
+        for count in self._storage.load(filename, progress, batch_size, snapshot):
+            yield count
+
+    def is_database(self):
+        return self._storage.database
+
+    def get_conflicts(self):
+        """ What was in more than one shard of a library directory when it was loaded, as a list of
+        (recipe name, shard it was taken from, shard it was ignored in). A recipe name of '_config'
+        means the shards have different _configs. """
+        return list(self._conflicts)
+
+    def is_sharded(self):
+        return self._shards is not None
 
+    @timer('backend.check_recipes')
     def _check_recipes(self, recipes):
         """ parse the recipes dict given to make sure they're valid
         and automatically remove invalid recipes
-        TODO: actually implement this
         TODO: incorporate Qt signals for GUI warning messages"""
 
         ret = {}
@@ -60,45 +214,104 @@ class Backend(object):
             return ret
 
         for (recipe, flavors) in recipes.items():
-            if type(flavors) is not dict:
-                print("Error: recipe %s does not contain a dict of flavors"%recipe)
-                continue
-            ret[recipe] = {}
-            for (flav, amount) in flavors.items():
-                if type(amount) is not int and type(amount) is not float:
-                    print("Error: flavor %s has non-numeric amount: %s"%(flav, amount))
-                    continue
-                # always assume percent
-                amount = amount / 100.0
-                ret[recipe][flav] = amount
+            checked = self._check_recipe(recipe, flavors)
+            if checked is not None:
+                ret[recipe] = checked
+
+        return ret
 
+    def _check_recipe(self, recipe, flavors):
+        """ check one recipe from a file, and convert its percents to fractions.
+        Returns None if it's not a dict, and drops any flavors that aren't numbers """
+        if type(flavors) is not dict:
+            print("Error: recipe %s does not contain a dict of flavors"%recipe)
+            return None
+        ret = {}
+        for (flav, amount) in flavors.items():
+            if type(amount) is not int and type(amount) is not float:
+                print("Error: flavor %s has non-numeric amount: %s"%(flav, amount))
+                continue
+            # always assume percent
+            ret[flav] = amount / 100.0
         return ret
 
     def calculate_mix(self, recipe_name, totalvol=10, nic=3, vg=70, mix='juice_from_ingredients'):
-        """ Calculate the mix for the given recipe and parameters
-        TODO: check for max PG/VG and correct appropriately
+        """ Calculate the mix for the given recipe and parameters.
+        Returns a MixResult (use str() on it to get the text for the output box),
+        or None if the recipe doesn't exist.
+
+        Results are kept in a bounded LRU cache keyed on the recipe and the normalized parameters,
+        so asking for the same mix again returns the same MixResult (with its text already rendered).
+        Entries remember the recipe's version, and are dropped when update_recipe(s) changes it.
+        Safe to call from a worker thread, it runs under the same lock as the changes to the recipes.
         """
+        with self._lock:
+            return self._cached_mix(recipe_name, totalvol, nic, vg, mix)
+
+    def _cached_mix(self, recipe_name, totalvol, nic, vg, mix):
+        if self._mix_cache_size <= 0:
+            return self._calculate_mix(recipe_name, totalvol, nic, vg, mix)
+
+        # nic and VG don't matter when making concentrate, and VG can be a percent or a fraction
+        if mix == 'concentrate':
+            key = (recipe_name, mix, float(totalvol), None, None)
+        else:
+            key = (recipe_name, mix, float(totalvol), float(nic), vg / 100.0 if vg > 1 else float(vg))
+        version = self._recipe_versions.get(recipe_name, 0)
+
+        cache = self._mix_cache
+        stats = self._cache_stats
         try:
-            #pdb.set_trace()
-            recipe = self._recipes[recipe_name]
+            (cached_version, result) = cache[key]
         except KeyError:
+            pass
+        else:
+            if cached_version == version:
+                cache.move_to_end(key)
+                stats['hits'] += 1
+                return result
+            del cache[key]
+            stats['invalidations'] += 1
+
+        stats['misses'] += 1
+        result = self._calculate_mix(recipe_name, totalvol, nic, vg, mix)
+        if result is not None:
+            cache[key] = (version, result)
+            if len(cache) > self._mix_cache_size:
+                cache.popitem(last=False)
+                stats['evictions'] += 1
+        return result
+
+    # only what the cache missed, hits are counted in get_cache_stats
+    @timer('backend.calculate_mix')
+    def _calculate_mix(self, recipe_name, totalvol, nic, vg, mix):
+        """ The actual (uncached) calculate_mix """
+        info = self._store.info(recipe_name)
+        if info is None:
             print("Error: recipe %s not found!"%recipe_name)
             return None
 
         # assumes all flavors are PG, will fix this later
-        totalflav = sum([1.0*totalvol*recipe[f] for f in recipe.keys()])
-        totalflav_part = totalflav / float(totalvol)
+        flavors = info.flavors
+        totalflav_part = info.total_flavor
+        totalflav = totalvol * totalflav_part
         message = None
+        addvg = addpg = 0.0
+        makes = 0.0
 
-        if mix != 'concentrate':
+        if mix == 'concentrate':
+            volumes = tuple((totalvol * frac) / totalflav_part for frac in info.fractions)
+            makes = totalvol / totalflav_part
+            nic = 0.0
+        else:
+            volumes = tuple(1.0*totalvol*frac for frac in info.fractions)
             if vg > 1:
                 vg = vg / 100.0
 
-            message = None
             nic = 1.0*nic*totalvol / self._nic_strength
 
             # make sure we're within Max VG/Min VG range
-            max_vg = 1.0 - self.get_total_flavor(recipe_name) - (nic if self._nic_base=='pg' else 0)
+            max_vg = info.max_vg - (nic if self._nic_base=='pg' else 0)
             if vg > max_vg:
                 vg = max_vg
                 message = 'Using Max VG: %.1f%%'%(max_vg*100.0)
@@ -124,88 +337,580 @@ class Backend(object):
             if addvg < 0:
                 addvg = 0
 
-        # generate string to return for the output box
-        max_flavor_name_len = max(len(f) for f in (list(recipe.keys()) + ['Nicotine']))
-        ret = ''
+        return MixResult(recipe_name, mix, flavors, volumes, totalflav, nic, addvg, addpg, makes, message,
+                         info.width)
+
+    @timer('backend.calculate_mix_batch')
+    def calculate_mix_batch(self, recipe_names, totalvol=10, nic=3, vg=70, mix='from_ingredients'):
+        """ Vectorized calculate_mix for lots of orders at once, using numpy.
+        recipe_names is a sequence with one entry per order. totalvol, nic, vg and mix can each be
+        either a sequence of the same length or a single value which applies to every order.
+        The math (including Max VG/Max PG clamping) is the same as calculate_mix, there's just
+        no display string.
+
+        Returns a dict of numpy arrays, indexed by order unless noted:
+            valid:          False if the recipe wasn't found (all volumes are 0 for that order)
+            flavor_offsets: length n+1. Order i's flavors are
+                            flavors[flavor_offsets[i]:flavor_offsets[i+1]], sorted by name
+            flavors:        flavor names for every (order, flavor) pair
+            flavor_vol:     mL of each flavor (scaled up to the full batch in 'concentrate' mode)
+            concentrate:    total mL of flavor, what 'from_concentrate' shows as "Concentrate"
+            nic, vg, pg:    mL of nicotine base, VG and PG to add (0 in 'concentrate' mode)
+            vg_used:        VG fraction after clamping
+            clamp:          +1 if clamped to Max VG, -1 if clamped to Max PG, 0 otherwise
+            makes:          mL of concentrate made in 'concentrate' mode (0 otherwise)
+        Safe to call from a worker thread, like calculate_mix. The store's columns are read under the
+        lock, and everything returned is a copy.
+        """
+        with self._lock:
+            return self._calculate_mix_batch(recipe_names, totalvol, nic, vg, mix)
+
+    def _calculate_mix_batch(self, recipe_names, totalvol, nic, vg, mix):
+        """ The actual calculate_mix_batch, with _lock held """
+        # numpy is only needed for batch calculations, so don't make the GUI depend on it
+        import numpy as np
+
+        res = self._mix_batch_orders(recipe_names, totalvol, nic, vg, mix)
+        rows = res.pop('rows')
+        totalvol = res.pop('totalvol')
+        totalflav_part = res.pop('totalflav_part')
+        is_conc = res.pop('is_conc')
+        del res['scale']
+
+        # expand each order's recipe row into its own flavor row
+        (col_offsets, col_ids, col_fracs, col_totals) = self._store.columns()
+        col_offsets = np.frombuffer(col_offsets, dtype=np.int64)
+        col_ids = np.frombuffer(col_ids, dtype=np.int64)
+        col_fracs = np.frombuffer(col_fracs, dtype=np.float64)
+        valid = res['valid']
+        n = len(valid)
+        starts = np.zeros(n, dtype=np.intp)
+        lengths = np.zeros(n, dtype=np.intp)
+        starts[valid] = col_offsets[rows[valid]]
+        lengths[valid] = col_offsets[rows[valid] + 1] - starts[valid]
+        offsets = np.zeros(n + 1, dtype=np.intp)
+        np.cumsum(lengths, out=offsets[1:])
+        owner = np.repeat(np.arange(n), lengths)
+        src = starts[owner] + (np.arange(offsets[-1]) - offsets[:-1][owner])
+        flavor_vol = totalvol[owner] * col_fracs[src]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            flavor_vol = np.where(is_conc[owner], flavor_vol / totalflav_part[owner], flavor_vol)
+
+        res['flavor_offsets'] = offsets
+        res['flavors'] = np.array(self._store.vocab, dtype=object)[col_ids[src]]
+        res['flavor_vol'] = flavor_vol
+        return res
+
+    def _mix_batch_orders(self, recipe_names, totalvol, nic, vg, mix):
+        """ The per-order part of calculate_mix_batch, everything but the flavor breakdown. Call it with
+        _lock held (see _mix_batch_matrix), it reads the store's columns and rows change under a put().
+        Returns calculate_mix_batch's valid/concentrate/nic/vg/pg/vg_used/clamp/makes arrays plus
+            rows:           each order's row in the store (only meaningful where valid)
+            scale:          mL of each flavor per unit of its fraction (0 for invalid orders)
+            totalvol, totalflav_part, is_conc: the broadcast inputs
+        """
+        import numpy as np
+
+        names = np.asarray(recipe_names, dtype=object).ravel()
+        n = len(names)
+        totalvol = np.broadcast_to(np.asarray(totalvol, dtype=float), (n,))
+        nic = np.broadcast_to(np.asarray(nic, dtype=float), (n,))
+        vg = np.broadcast_to(np.asarray(vg, dtype=float), (n,))
+        mix = np.broadcast_to(np.asarray(mix, dtype=object), (n,))
+        is_conc = (mix == 'concentrate')
+        is_juice = ~is_conc
+
+        # Only loop over the distinct recipes, which is a small number compared to the orders,
+        # to find their rows in the store. Everything else works directly on the store's columns.
+        uniq, inv = np.unique(names.astype(str), return_inverse=True)
+        inv = inv.ravel()
+        store = self._store
+        u_rows = np.zeros(len(uniq), dtype=np.intp)
+        u_valid = np.zeros(len(uniq), dtype=bool)
+        for (i, name) in enumerate(uniq):
+            row = store.row(name)
+            if row is None:
+                print("Error: recipe %s not found!"%name)
+                continue
+            u_rows[i] = row
+            u_valid[i] = True
+
+        col_totals = np.frombuffer(store.columns()[3], dtype=np.float64)
+        u_total = np.zeros(len(uniq))
+        u_total[u_valid] = col_totals[u_rows[u_valid]]
 
-        if mix != 'from_concentrate':
-            for f in sorted(recipe.keys()):
-                if mix == 'from_ingredients':
-                    f_vol = 1.0*totalvol*recipe[f]
-                else: # 'concentrate'
-                    f_vol = (totalvol * recipe[f]) / totalflav_part
-
-                spaces = max_flavor_name_len - len(f)
-                ret += '\n%s: %5.2f mL'%(' '*spaces + f, f_vol)
-            # the first character will always be a newline from the loop above, which we don't want, so kill it
-            ret = ret[1:]
-
-        elif mix == 'from_concentrate':
-            # "Concentrate" is longer than Nicotine, so it gets the max
-            max_flavor_name_len = len('Concentrate')
-            ret = 'Concentrate: %5.2f mL'%totalflav
+        valid = u_valid[inv]
+        totalflav_part = u_total[inv]
+        totalflav = totalvol * totalflav_part
 
-        if mix != 'concentrate':
-            # add nic/VG/PG
-            ret += '\n\n' + ' '*(max_flavor_name_len-8) + 'Nicotine: %5.2f mL'%nic
-            ret += '\n'   + ' '*(max_flavor_name_len-2) + 'VG: %5.2f mL'%addvg
-            ret += '\n'   + ' '*(max_flavor_name_len-2) + 'PG: %5.2f mL'%addpg
-        else:
-            ctotal = totalvol / totalflav_part
-            message = ' '*(max_flavor_name_len-5) + 'Makes: %5.2f mL'%ctotal
+        with np.errstate(divide='ignore', invalid='ignore'):
+            vg = np.where(vg > 1, vg / 100.0, vg)
+            nicvol = nic * totalvol / self._nic_strength
 
-        if message is not None:
-            ret += '\n\n' + message
+            # same Max VG/Min VG rules as calculate_mix
+            max_vg = 1.0 - totalflav_part - (nicvol if self._nic_base == 'pg' else 0.0)
+            clamp_hi = vg > max_vg
+            vg = np.where(clamp_hi, max_vg, vg)
+            if self._nic_base == 'vg':
+                min_vg = nicvol / totalvol
+            else:
+                min_vg = np.zeros(n)
+            clamp_lo = ~clamp_hi & (vg < min_vg)
+            vg = np.where(clamp_lo, min_vg, vg)
 
-        return ret
+            totalvg = totalvol * vg
+            totalpg = totalvol - totalvg
+            if self._nic_base == 'vg':
+                addpg = totalpg - totalflav
+                addvg = totalvg - nicvol
+            else:
+                addpg = totalpg - totalflav - nicvol
+                addvg = totalvg
 
+            makes = np.where(is_conc, totalvol / totalflav_part, 0.0)
+
+        # force nonnegative numbers, and zero out everything that doesn't apply to the order's mix type
+        juice = is_juice & valid
+        addpg = np.where(juice, np.maximum(addpg, 0.0), 0.0)
+        addvg = np.where(juice, np.maximum(addvg, 0.0), 0.0)
+        nicvol = np.where(juice, nicvol, 0.0)
+        vg = np.where(juice, vg, 0.0)
+        clamp = np.where(juice & clamp_hi, 1, np.where(juice & clamp_lo, -1, 0)).astype(np.int8)
+        makes = np.where(valid, makes, 0.0)
+        totalflav = np.where(valid, totalflav, 0.0)
+        # concentrate mode scales the recipe up so the flavors alone make totalvol
+        scale = np.where(valid, np.where(is_conc, makes, totalvol), 0.0)
+
+        return {'valid': valid,
+                'concentrate': totalflav,
+                'nic': nicvol,
+                'vg': addvg,
+                'pg': addpg,
+                'vg_used': vg,
+                'clamp': clamp,
+                'makes': makes,
+                'rows': u_rows[inv],
+                'scale': scale,
+                'totalvol': totalvol,
+                'totalflav_part': totalflav_part,
+                'is_conc': is_conc}
+
+    def _mix_batch_matrix(self, recipe_names, totalvol, nic, vg, mix):
+        """ _mix_batch_orders and the RecipeMatrix its rows are for, taken together under the lock so
+        they agree with each other """
+        with self._lock:
+            return (self._mix_batch_orders(recipe_names, totalvol, nic, vg, mix), self._get_matrix())
+
+    def get_matrix(self):
+        """ RecipeMatrix (sparse recipe x flavor fractions) of the current recipes """
+        with self._lock:
+            return self._get_matrix()
+
+    def _get_matrix(self):
+        if self._matrix is None:
+            from RecipeMatrix import RecipeMatrix
+            self._store.load_all()
+            self._matrix = RecipeMatrix(self._store)
+        return self._matrix
+
+    @timer('backend.shopping_list')
+    def shopping_list(self, recipe_names, totalvol=10, nic=3, vg=70, mix='from_ingredients'):
+        """ Totals for a whole book of orders, given the same way as for calculate_mix_batch.
+        Rather than working out every order's flavors, the orders' volumes are summed per recipe
+        and multiplied through RecipeMatrix once, so this scales with the library, not the orders.
+        Returns a dict:
+            flavors:     flavor name -> total mL, for the flavors that are needed
+            flavor:      total mL of all flavors
+            nic, vg, pg: total mL of nicotine base, VG and PG
+            orders:      number of orders counted
+            not_found:   sorted names of the recipes that weren't found (their orders aren't counted)
+        """
+        import numpy as np
+
+        (res, matrix) = self._mix_batch_matrix(recipe_names, totalvol, nic, vg, mix)
+        valid = res['valid']
+        rows = matrix.row_of_store_row[res['rows'][valid]]
+        per_recipe = np.bincount(rows, weights=res['scale'][valid], minlength=len(matrix.names))
+        per_flavor = matrix.rmatvec(per_recipe)
+
+        needed = np.flatnonzero(per_flavor)
+        names = np.asarray(recipe_names, dtype=object).ravel()
+        return {'flavors': {matrix.flavors[j]: float(per_flavor[j]) for j in needed},
+                'flavor': float(per_flavor.sum()),
+                'nic': float(res['nic'].sum()),
+                'vg': float(res['vg'].sum()),
+                'pg': float(res['pg'].sum()),
+                'orders': int(valid.sum()),
+                'not_found': sorted(set(str(name) for name in names[~valid]))}
+
+    def plan_production(self, skus, stock, default_stock=0.0):
+        """ What to make from the stock on hand, see Planner.plan """
+        import Planner
+        return Planner.plan(self, skus, stock, default_stock)
 
     def get_total_flavor(self, recipe_name):
-        try:
-            recipe = self._recipes[recipe_name]
-        except KeyError:
+        total = self._store.total_flavor(recipe_name)
+        if total is None:
             print("Error: recipe %s not found!"%recipe_name)
-            return None
-        return sum(recipe.values())
+        return total
+
+    def get_max_vg(self, recipe_name):
+        """ Max VG fraction for the recipe, not counting nicotine """
+        total = self.get_total_flavor(recipe_name)
+        return None if total is None else 1.0 - total
 
     def get_recipe(self, recipe):
-        try:
-            return self._recipes[recipe]
-        except KeyError:
-            return None
+        """ Returns a new dict of flavor -> fraction, or None """
+        return self._store.get(recipe)
     
     def get_recipes(self):
-        recs = list(self._recipes.keys())
-        recs.sort()
-        return recs
+        # the index keeps the names sorted, just hand out a copy
+        return list(self._store.names())
+
+    def _search_index(self):
+        if self._search is None:
+            self._store.load_all()
+            self._search = SearchIndex.from_store(self._store)
+        return self._search
+
+    def has_search_index(self):
+        return self._search is not None
+
+    def build_search_index(self):
+        """ Build the search index ahead of the first search, which is slow on a big library, so this
+        is meant for a worker thread. It's built from a frozen copy of the recipes, whatever changed
+        meanwhile is caught up on at the end. """
+        if self._search is not None:
+            return
+        self._store.load_all()
+        with self._lock:
+            store = self._store.freeze()
+            versions = dict(self._recipe_versions)
+        index = SearchIndex.from_store(store)
+        with self._lock:
+            if self._search is not None:
+                return
+            for (name, version) in self._recipe_versions.items():
+                if versions.get(name) != version:
+                    recipe = self._store.get(name)
+                    if recipe is None:
+                        index.remove(name)
+                    else:
+                        index.put(name, recipe)
+            self._search = index
+
+    def quick_search(self, query):
+        """ search(query) for the GUI thread, which mustn't build the search index: until it's been
+        built (see build_search_index) this is a plain substring match on the recipe names, flavor
+        terms have to wait for the index """
+        if not query or self._search is not None:
+            return self.search(query)
+        text = parse_query(query)[0].lower()
+        return [name for name in self._store.names() if text in name.lower()]
+
+    @timer('backend.search')
+    def search(self, query='', flavors=(), limit=None):
+        """ Sorted names of the recipes matching a filter box query (see RecipeSearch.parse_query)
+        and all of the (flavor, min_fraction) terms in flavors, at most limit of them.
+        e.g. search(flavors=[('strawberry', 0.02), ('vanilla', 0.02)]) or the same thing as
+        search('with: strawberry > 2, vanilla > 2') """
+        (text, terms) = parse_query(query)
+        terms += list(flavors)
+        if not text and not terms:
+            names = self._store.names()
+            return list(names if limit is None else names[:limit])
+        return self._search_index().search(text, terms, limit)
+
+    def get_cache_stats(self):
+        """ Counters for the calculate_mix cache """
+        ret = dict(self._cache_stats)
+        ret['size'] = len(self._mix_cache)
+        ret['max_size'] = self._mix_cache_size
+        return ret
+
+    def clear_cache(self):
+        self._mix_cache.clear()
+
+    def get_stats(self):
+        """ Operation counts and latencies (see Stats.get_stats, the GUI's timings are in there too),
+        plus the mix cache counters and a few sizes """
+        with self._lock:
+            (n_recipes, n_dirty) = (len(self._store), len(self._dirty))
+        return {'ops': Stats.get_stats(),
+                'mix_cache': self.get_cache_stats(),
+                'recipes': n_recipes,
+                'dirty': n_dirty,
+                'journal_bytes': self._journal.size() if self._journal is not None else None}
 
     def get_config(self):
-        return {'n_recipes': len(self._recipes.keys()),
+        return {'n_recipes': len(self._store),
                 'nic_strength': self._nic_strength,
                 'nic_base': self._nic_base}
 
     def update_recipe(self, recipe_name, recipe_data):
-        self._recipes[recipe_name] = recipe_data
+        self.update_recipes({recipe_name: recipe_data})
 
     def update_recipes(self, recipes):
-        for r in recipes:
-            self._recipes[r] = recipes[r]
+        self._storage.update(recipes)
+
+    def remove_recipe(self, recipe_name):
+        self.remove_recipes([recipe_name])
+
+    def remove_recipes(self, recipe_names):
+        self._storage.remove(recipe_names)
+
+    def attach_journal(self, filename=None):
+        """ Start logging changes to a RecipeJournal next to the json file (by default the one we
+        loaded), so they survive a crash before they're saved. Whatever is in the journal from last
+        time is replayed first, those recipes end up changed but not saved (see is_dirty).
+        Returns the number of changes replayed.
+        A recipe database doesn't need one, changes are in it as soon as they're made. """
+        if filename is None:
+            filename = self.filename
+        if filename is None:
+            print('Backend.attach_journal: no filename given!')
+            return 0
+        return self._storage.attach_journal(filename)
+
+    def close_journal(self):
+        """ Stop logging changes. Waits for a running compaction, the journal file stays. """
+        if self._compaction is not None:
+            self._compaction.join()
+            self._compaction = None
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    def get_journal_staged(self):
+        """ Recipes the editor had staged, according to the journal, name -> recipe """
+        return {} if self._journal is None else self._journal.staged()
+
+    def log_staged(self, recipe_name, recipe_data):
+        """ Journal a recipe being staged in the editor (recipe_data None when it's unstaged) """
+        if self._journal is not None:
+            self._journal.log_stage(recipe_name, recipe_data)
+            self._check_journal()
+
+    def _check_journal(self):
+        if self._journal.size() >= JOURNAL_COMPACT_BYTES:
+            self.compact_journal()
+
+    def compact_journal(self, background=True):
+        """ Write the library out to the json file we loaded and cut the journal down to what
+        came after. By default that happens in a background thread, working on a frozen copy of the
+        store (see RecipeStore.freeze), so changes can keep coming in meanwhile; they stay in the
+        journal and stay dirty. Only one compaction runs at a time.
+        Returns the thread, or None if it didn't start one. """
+        if self._journal is None or self.filename is None:
+            return None
+        if self._compaction is not None and self._compaction.is_alive():
+            return None
+        args = (self.filename, self._prepare_write())
+        if not background:
+            self._compact(*args)
+            return None
+        # not a daemon thread, exiting waits for it instead of leaving a temp file behind
+        self._compaction = threading.Thread(target=self._compact, args=args, name='journal compaction')
+        self._compaction.start()
+        return self._compaction
+
+    @timer('backend.compact_journal')
+    def _compact(self, filename, prepared):
+        try:
+            self._write_prepared(filename, prepared)
+        except OSError as e:
+            print('Warning: unable to compact journal into %s: %s'%(filename, e))
+
+    def is_dirty(self):
+        """ True if any recipes changed since the file was loaded or saved """
+        return len(self._dirty) > 0
+
+    def freeze(self):
+        """ Frozen copy of the recipes plus the set of dirty ones, for diff() on another thread.
+        (None, empty set) for a recipe database, which doesn't need either to reload. """
+        return self._storage.freeze()
+
+    def diff(self, new, frozen=None):
+        """ (added, removed, modified) recipe names going from our recipes to those of new (another
+        Backend), leaving out the ones with unsaved changes. frozen is a freeze() to compare against
+        instead of the live recipes, which is what a worker thread has to do.
+        For a recipe database it's what other stations changed since we last looked, new isn't used. """
+        return self._storage.diff(new, frozen)
+
+    @timer('backend.reload')
+    def reload(self, filename=None, loaded=None, changes=None):
+        """ Re-read the recipe file (by default the one we loaded) and apply only what changed,
+        keeping this Backend object so everything holding on to it stays valid.
+        Recipes with unsaved changes (see is_dirty) keep the local version.
+        Returns (added, removed, modified) lists of recipe names.
+        Raises IOError/ValueError if the file can't be loaded, in which case nothing changes.
+        The slow parts can be done on a worker thread first: loaded is a Backend the file has
+        already been loaded into, and changes is what diff() returned for it.
+        A recipe database we have open is only asked what changed since we last looked, there's
+        nothing slow to do first, and loaded and changes are ignored.
+        """
+        if filename is None:
+            filename = self.filename
+        return self._storage.reload(filename, loaded, changes)
+
+    def save_snapshot(self, filename=None, json_sha=None, json_stat=None, store=None, config=None):
+        """ Write a RecipeSnapshot for the json file (by default the one we loaded), with store and
+        config (nic_base, nic_strength) if what's in the file isn't ours (a shard's, say).
+        Failing to write one isn't fatal, it just means the next load parses the json. """
+        if filename is None:
+            filename = self.filename
+        if os.path.isdir(filename):
+            # every shard has its own
+            return
+        if store is None:
+            store = self._store
+        if config is None:
+            config = (self._nic_base, self._nic_strength)
+        try:
+            RecipeSnapshot.write(filename, store, config[0], config[1], json_sha, json_stat)
+        except (OSError, ValueError) as e:
+            print('Warning: unable to write snapshot for %s: %s'%(filename, e))
 
+    @timer('backend.write_file')
     def write_file(self, filename=None):
+        """ Save the config and all recipes (as percents) to a json file, by default the one we loaded.
+        Does nothing if that's the file we loaded and no recipes changed since then.
+        The json is streamed out one recipe at a time into a temp file in the same directory, which is
+        fsync'd and then renamed over the original, so a crash never leaves a half-written library.
+        Returns True if the file was written. Safe to call from a worker thread, the recipes are
+        frozen first and can keep changing while it's writing.
+        For a library directory (see RecipeShards) only the shards with changed recipes are written,
+        each the same way. Given another directory, it writes all the shards there.
+        A recipe database (see RecipeDB) is never dirty, changes are saved to it as they're made.
+        Given a filename ending in .db (etc), it writes all the recipes into that database.
+        """
         print('Backend.write_file')
         if filename is None:
             filename = self.filename
             if filename is None:
                 print('Backend.write_file: no filename given!')
-                return
-
-        # convert floats to percents
-        rout = {}
-        for r in self._recipes:
-            rout[r] = {}
-            for f in self._recipes[r]:
-                rout[r][f] = self._recipes[r][f] * 100.0
-
-        js = json.dumps(rout, sort_keys=True, indent=4, separators=(',', ': '))
-        with open(filename, 'w') as fp:
-            fp.write(js)
+                return False
+
+        if filename == self.filename:
+            return self._storage.save()
+        if is_database(filename):
+            (store, _, _, _, _) = self._prepare_write()
+            import RecipeDB
+            RecipeDB.write_store(filename, store, self._nic_base, self._nic_strength)
+            return True
+        return self._write_prepared(filename, self._prepare_write(all_shards=True), ours=False)
+
+    def _prepare_write(self, all_shards=False):
+        # Freeze what's going to be written (see RecipeStore.freeze), so the writing itself can be
+        # done on another thread while the recipes keep changing. Writes are numbered here, so one
+        # that reaches the file after a newer one can skip itself.
+        with self._lock:
+            self._write_seq += 1
+            versions = {name: self._recipe_versions.get(name) for name in self._dirty}
+            mark = self._journal.tell() if self._journal is not None else None
+            shards = None
+            if self._shards is not None:
+                # the shards to write, with the names of everything that goes in them
+                if all_shards:
+                    written = self._shards
+                else:
+                    written = set(self._shard_of[name] for name in self._dirty)
+                shards = {shard: (list(self._shards[shard]), self._shard_files.get(shard))
+                          for shard in written}
+            return (self._store.freeze(), versions, mark, self._write_seq, shards)
+
+    def _write_prepared(self, filename, prepared, ours=True):
+        (store, versions, mark, seq, shards) = prepared
+        with self._write_lock:
+            if ours and seq < self._written_seq:
+                # a newer write got there first
+                return False
+            if shards is not None and os.path.isdir(filename):
+                for (shard, (names, extra)) in sorted(shards.items()):
+                    # removed recipes are still listed, until now
+                    names = [name for name in names if name in store]
+                    path = os.path.join(filename, shard)
+                    if not names and not extra and not os.path.exists(path):
+                        # e.g. a new recipe that was removed again
+                        continue
+                    shard_store = RecipeStore()
+                    shard_store.merge(store, names)
+                    (nic_base, nic_strength) = (self._nic_base, self._nic_strength)
+                    if extra is not None:
+                        # put back what the shard had that we didn't use
+                        (ignored, nic_base, nic_strength) = extra
+                        shard_store.merge(ignored, [name for name in ignored.names() if name not in shard_store])
+                    sha = self._write_json(path, shard_store, nic_base, nic_strength)
+                    self.save_snapshot(path, json_sha=sha, store=shard_store, config=(nic_base, nic_strength))
+            else:
+                sha = self._write_json(filename, store, self._nic_base, self._nic_strength)
+                self.save_snapshot(filename, json_sha=sha, store=store)
+            if ours:
+                self._written_seq = seq
+                with self._lock:
+                    # recipes changed again since the copy was made are still dirty
+                    for (name, version) in versions.items():
+                        if self._recipe_versions.get(name) == version:
+                            self._dirty.discard(name)
+                            if self._shard_of is not None and name not in self._store and name in self._shard_of:
+                                # removed, and now gone from its shard too
+                                self._shards[self._shard_of.pop(name)].discard(name)
+                # the rest is in the json now
+                if mark is not None and self._journal is not None:
+                    self._journal.cut(mark)
+        return True
+
+    def _write_json(self, filename, store, nic_base, nic_strength):
+        """ Write store out to filename, returns the sha256 digest of what was written """
+        import tempfile # only needed for saving, keep it out of startup
+        config = json.dumps({'nic_base': nic_base, 'nic_strength': nic_strength},
+                            sort_keys=True, indent=4, separators=(',', ': '))
+        sha = hashlib.sha256()
+        (fd, tmp_name) = tempfile.mkstemp(prefix='.' + os.path.basename(filename) + '.',
+                                          dir=os.path.dirname(os.path.abspath(filename)))
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                def write(text):
+                    data = text.encode('utf-8')
+                    sha.update(data)
+                    fp.write(data)
+
+                write('{\n    "_config": %s,\n    "_recipes": {'%config.replace('\n', '\n    '))
+                sep = '\n'
+                for r in store:
+                    # convert floats to percents
+                    rout = {f: amount * 100.0 for (f, amount) in store.get(r).items()}
+                    js = json.dumps(rout, sort_keys=True, indent=4, separators=(',', ': '))
+                    write('%s        %s: %s'%(sep, json.dumps(r), js.replace('\n', '\n        ')))
+                    sep = ',\n'
+                write('\n    }\n}\n')
+                fp.flush()
+                os.fsync(fp.fileno())
+
+            # mkstemp makes the file 0600, keep the original's permissions (or the default ones for a new file)
+            try:
+                mode = os.stat(filename).st_mode & 0o7777
+            except OSError:
+                umask = os.umask(0)
+                os.umask(umask)
+                mode = 0o666 & ~umask
+            os.chmod(tmp_name, mode)
+            os.replace(tmp_name, filename)
+        except:
+            os.unlink(tmp_name)
+            raise
+        self._fsync_dir(os.path.dirname(os.path.abspath(filename)))
+        return sha.digest()
+
+    def _fsync_dir(self, dirname):
+        # make the rename itself durable. Not possible (or needed) on Windows.
+        try:
+            fd = os.open(dirname, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
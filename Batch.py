@@ -0,0 +1,319 @@
+# Headless batch processing of mix orders. Orders are read from CSV or JSONL a chunk at a time,
+# each chunk is run through Backend.calculate_mix_batch in a pool of worker processes (each of
+# which loads the recipe library once), and the results are written out as CSV or JSONL in the
+# same order as the input. Only a few chunks are ever in flight, so memory stays bounded no matter
+# how long the order file is. Nothing here imports Qt.
+
+import csv, io, json, math, os, sys
+import multiprocessing
+from collections import deque
+from contextlib import redirect_stdout
+from itertools import islice
+from Backend import Backend, CONFIG_FILE
+
+# input columns/keys, and what they default to when they're missing (same as calculate_mix)
+ORDER_FIELDS = ('recipe', 'totalvol', 'nic', 'vg', 'mix')
+ORDER_DEFAULTS = {'totalvol': 10.0, 'nic': 3.0, 'vg': 70.0, 'mix': 'from_ingredients'}
+FIELD_ALIASES = {'recipe_name': 'recipe'}
+RESULT_FIELDS = ('status', 'nicotine_ml', 'vg_ml', 'pg_ml', 'concentrate_ml', 'makes_ml', 'message', 'flavors')
+
+FORMATS = ('csv', 'jsonl')
+CHUNK_SIZE = 5000
+
+# the worker process's Backend, see _init_worker
+_backend = None
+
+def _init_worker(library):
+    global _backend
+    # Backend prints its errors, keep them out of the results on stdout
+    with redirect_stdout(sys.stderr):
+        _backend = Backend(library)
+
+def _parse_orders(rows, in_fmt, columns):
+    """ Turn raw input rows (csv rows as lists, or jsonl lines) into a list of order dicts.
+    Returns (orders, errors) where errors[i] is a message or None """
+    orders = []
+    errors = []
+    for row in rows:
+        if in_fmt == 'csv':
+            order = {field: row[col] for (field, col) in columns.items() if col < len(row) and row[col] != ''}
+        else:
+            try:
+                obj = json.loads(row)
+                order = {FIELD_ALIASES.get(k, k): v for (k, v) in obj.items()}
+            except (ValueError, AttributeError):
+                orders.append({})
+                errors.append('invalid input: not a JSON object')
+                continue
+        orders.append(order)
+        errors.append(check_order(order))
+    return (orders, errors)
+
+def check_order(order):
+    """ Fill in the defaults and convert the fields of an order dict, in place. totalvol has to be a
+    positive number, nic and vg nonnegative ones (no nan/inf).
+    Returns an error message, or None if the order is good """
+    err = None
+    for field in ORDER_FIELDS:
+        if field not in order or order[field] is None:
+            if field == 'recipe':
+                err = 'invalid input: no recipe'
+                order[field] = ''
+            else:
+                order[field] = ORDER_DEFAULTS[field]
+        elif field in ('totalvol', 'nic', 'vg'):
+            try:
+                value = float(order[field])
+                if not math.isfinite(value) or value < 0 or (field == 'totalvol' and value == 0):
+                    raise ValueError
+                order[field] = value
+            except (TypeError, ValueError):
+                err = 'invalid input: bad %s'%field
+                # it's echoed back with the error, as given (nan isn't valid JSON)
+                order[field] = str(order[field])
+        else:
+            order[field] = str(order[field])
+    return err
+
+def calculate_orders(backend, orders, errors):
+    """ Calculate checked orders (see check_order) in one calculate_mix_batch call.
+    Returns a list with a result dict per order: status 'ok' with the RESULT_FIELDS, flavors as
+    a list of (flavor, mL), or just the status (the error message) for the ones that failed.
+    Every number in an 'ok' result is finite, so it can always be written out as JSON. """
+    ok = [i for (i, e) in enumerate(errors) if e is None]
+    res = backend.calculate_mix_batch([orders[i]['recipe'] for i in ok],
+                                      [orders[i]['totalvol'] for i in ok],
+                                      [orders[i]['nic'] for i in ok],
+                                      [orders[i]['vg'] for i in ok],
+                                      [orders[i]['mix'] for i in ok])
+
+    # pull everything out of numpy once, indexing numpy arrays one element at a time is slow
+    res = {k: v.tolist() for (k, v) in res.items()}
+    results = [{'status': err} for err in errors]
+    for (j, i) in enumerate(ok):
+        if not res['valid'][j]:
+            results[i] = {'status': 'recipe not found'}
+            continue
+        (start, end) = (res['flavor_offsets'][j], res['flavor_offsets'][j+1])
+        if orders[i]['mix'] == 'concentrate' and res['concentrate'][j] == 0:
+            results[i] = {'status': 'recipe has no flavors to make concentrate from'}
+            continue
+        values = [res[k][j] for k in ('nic', 'vg', 'pg', 'concentrate', 'makes')] + res['flavor_vol'][start:end]
+        if not all(math.isfinite(v) for v in values):
+            results[i] = {'status': 'unable to calculate mix'}
+            continue
+        message = ''
+        if res['clamp'][j] > 0:
+            message = 'Using Max VG: %.1f%%'%(res['vg_used'][j]*100.0)
+        elif res['clamp'][j] < 0:
+            message = 'Using Max PG: %.1f%%'%(100.0*(1.0-res['vg_used'][j]))
+        results[i] = {'status': 'ok',
+                      'nicotine_ml': round(res['nic'][j], 4),
+                      'vg_ml': round(res['vg'][j], 4),
+                      'pg_ml': round(res['pg'][j], 4),
+                      'concentrate_ml': round(res['concentrate'][j], 4),
+                      'makes_ml': round(res['makes'][j], 4),
+                      'message': message,
+                      'flavors': [(f, round(v, 4)) for (f, v) in
+                                  zip(res['flavors'][start:end], res['flavor_vol'][start:end])]}
+    return results
+
+def process_chunk(rows, in_fmt, out_fmt, columns=None, backend=None):
+    """ Calculate a chunk of orders and return the formatted output for them as one string """
+    if backend is None:
+        backend = _backend
+    (orders, errors) = _parse_orders(rows, in_fmt, columns)
+    # Backend prints recipes that aren't found, keep that out of the results on stdout
+    with redirect_stdout(sys.stderr):
+        results = calculate_orders(backend, orders, errors)
+
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator='\n') if out_fmt == 'csv' else None
+    for (order, result) in zip(orders, results):
+        if writer is not None:
+            flavors = ';'.join('%s=%s'%(f, v) for (f, v) in result.get('flavors', []))
+            writer.writerow([order.get(f, '') for f in ORDER_FIELDS] +
+                            [result.get(f, '') for f in RESULT_FIELDS[:-1]] + [flavors])
+        else:
+            obj = {f: order.get(f) for f in ORDER_FIELDS}
+            obj.update(result)
+            if 'flavors' in obj:
+                obj['flavors'] = dict(obj['flavors'])
+            out.write(json.dumps(obj))
+            out.write('\n')
+    return out.getvalue()
+
+def _process_chunk_worker(rows, in_fmt, out_fmt, columns):
+    return process_chunk(rows, in_fmt, out_fmt, columns)
+
+def read_chunks(infile, in_fmt, chunk_size=CHUNK_SIZE):
+    """ Yields (rows, columns) chunks from the input file. columns maps order fields to csv
+    column numbers (from the csv header), and is None for jsonl """
+    if in_fmt == 'csv':
+        reader = csv.reader(infile)
+        header = next(reader, None)
+        if header is None:
+            return
+        columns = {}
+        for (col, name) in enumerate(header):
+            name = name.strip().lower()
+            name = FIELD_ALIASES.get(name, name)
+            if name in ORDER_FIELDS:
+                columns[name] = col
+        if 'recipe' not in columns:
+            raise ValueError('CSV input has no "recipe" column')
+        rows = reader
+    else:
+        columns = None
+        rows = (line for line in infile if line.strip())
+
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield (chunk, columns)
+
+def run(library, infile, outfile, in_fmt='csv', out_fmt=None, jobs=None, chunk_size=CHUNK_SIZE):
+    """ Process all orders from infile and write the results to outfile.
+    jobs is the number of worker processes (default: one per CPU), 1 means do everything here. """
+    if out_fmt is None:
+        out_fmt = in_fmt
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+
+    if out_fmt == 'csv':
+        csv.writer(outfile, lineterminator='\n').writerow(ORDER_FIELDS + RESULT_FIELDS)
+
+    chunks = read_chunks(infile, in_fmt, chunk_size)
+    if jobs <= 1:
+        _init_worker(library)
+        for (rows, columns) in chunks:
+            outfile.write(process_chunk(rows, in_fmt, out_fmt, columns))
+        return
+
+    with multiprocessing.Pool(jobs, _init_worker, (library,)) as pool:
+        # keep a couple of chunks queued per worker, and write results out in input order
+        pending = deque()
+        for (rows, columns) in chunks:
+            pending.append(pool.apply_async(_process_chunk_worker, (rows, in_fmt, out_fmt, columns)))
+            if len(pending) >= 2*jobs:
+                outfile.write(pending.popleft().get())
+        while pending:
+            outfile.write(pending.popleft().get())
+
+def shopping_list(library, infile, in_fmt='csv', chunk_size=CHUNK_SIZE, backend=None):
+    """ Total up the ingredients for all the orders in infile (see Backend.shopping_list).
+    This runs in one process: each chunk is a single matrix product, a pool wouldn't buy much.
+    Returns Backend.shopping_list's dict for the whole file, plus 'invalid', the number of input
+    rows that couldn't be parsed. """
+    if backend is None:
+        with redirect_stdout(sys.stderr):
+            backend = Backend(library)
+
+    totals = {'flavors': {}, 'flavor': 0.0, 'nic': 0.0, 'vg': 0.0, 'pg': 0.0, 'orders': 0, 'invalid': 0}
+    not_found = set()
+    for (rows, columns) in read_chunks(infile, in_fmt, chunk_size):
+        (orders, errors) = _parse_orders(rows, in_fmt, columns)
+        ok = [orders[i] for (i, e) in enumerate(errors) if e is None]
+        totals['invalid'] += len(orders) - len(ok)
+        with redirect_stdout(sys.stderr):
+            res = backend.shopping_list([o['recipe'] for o in ok], [o['totalvol'] for o in ok],
+                                        [o['nic'] for o in ok], [o['vg'] for o in ok], [o['mix'] for o in ok])
+        for (flavor, ml) in res['flavors'].items():
+            totals['flavors'][flavor] = totals['flavors'].get(flavor, 0.0) + ml
+        for key in ('flavor', 'nic', 'vg', 'pg', 'orders'):
+            totals[key] += res[key]
+        not_found.update(res['not_found'])
+    totals['not_found'] = sorted(not_found)
+    return totals
+
+def _guess_format(filename, default='csv'):
+    ext = os.path.splitext(filename)[1].lower()
+    if ext in ('.jsonl', '.ndjson', '.json'):
+        return 'jsonl'
+    if ext == '.csv':
+        return 'csv'
+    return default
+
+def add_arguments(parser):
+    parser.add_argument('-l', '--library', default=CONFIG_FILE,
+                        help='recipe library json file, directory of shards or database (default: %(default)s)')
+    parser.add_argument('-i', '--input', default='-', help='order file, - for stdin (default)')
+    parser.add_argument('-o', '--output', default='-', help='result file, - for stdout (default)')
+    parser.add_argument('--input-format', choices=FORMATS,
+                        help='default: from the input file extension, or csv')
+    parser.add_argument('--output-format', choices=FORMATS, help='default: same as the input')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='worker processes (default: number of CPUs, 1 = no pool)')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help='orders per work unit (default: %(default)s)')
+
+def add_shop_arguments(parser):
+    parser.add_argument('-l', '--library', default=CONFIG_FILE,
+                        help='recipe library json file, directory of shards or database (default: %(default)s)')
+    parser.add_argument('-i', '--input', default='-', help='order file, - for stdin (default)')
+    parser.add_argument('-o', '--output', default='-', help='shopping list file, - for stdout (default)')
+    parser.add_argument('--input-format', choices=FORMATS,
+                        help='default: from the input file extension, or csv')
+    parser.add_argument('--json', action='store_true', help='write json instead of csv')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help='orders per chunk (default: %(default)s)')
+
+def shop_main(args):
+    if not os.path.exists(args.library):
+        print('Error: recipe library %s not found'%args.library, file=sys.stderr)
+        return 1
+
+    in_fmt = args.input_format or _guess_format(args.input)
+    infile = sys.stdin if args.input == '-' else open(args.input, newline='', encoding='utf-8')
+    try:
+        totals = shopping_list(args.library, infile, in_fmt, args.chunk_size)
+    except ValueError as e:
+        print('Error: %s'%e, file=sys.stderr)
+        return 1
+    finally:
+        if infile is not sys.stdin:
+            infile.close()
+
+    outfile = sys.stdout if args.output == '-' else open(args.output, 'w', newline='', encoding='utf-8')
+    try:
+        if args.json:
+            json.dump(totals, outfile, indent=4, sort_keys=True)
+            outfile.write('\n')
+        else:
+            writer = csv.writer(outfile, lineterminator='\n')
+            writer.writerow(('item', 'ml'))
+            for flavor in sorted(totals['flavors']):
+                writer.writerow((flavor, round(totals['flavors'][flavor], 4)))
+            for (item, key) in (('Nicotine', 'nic'), ('VG', 'vg'), ('PG', 'pg')):
+                writer.writerow((item, round(totals[key], 4)))
+    finally:
+        if outfile is not sys.stdout:
+            outfile.close()
+
+    print('%d orders, %d invalid'%(totals['orders'], totals['invalid']), file=sys.stderr)
+    if totals['not_found']:
+        print('Recipes not found: %s'%', '.join(totals['not_found']), file=sys.stderr)
+    return 0
+
+def main(args):
+    if not os.path.exists(args.library):
+        print('Error: recipe library %s not found'%args.library, file=sys.stderr)
+        return 1
+
+    in_fmt = args.input_format or _guess_format(args.input)
+    out_fmt = args.output_format or (in_fmt if args.output == '-' else _guess_format(args.output, in_fmt))
+
+    infile = sys.stdin if args.input == '-' else open(args.input, newline='', encoding='utf-8')
+    outfile = sys.stdout if args.output == '-' else open(args.output, 'w', newline='', encoding='utf-8')
+    try:
+        run(args.library, infile, outfile, in_fmt, out_fmt, args.jobs, args.chunk_size)
+    except ValueError as e:
+        print('Error: %s'%e, file=sys.stderr)
+        return 1
+    finally:
+        if infile is not sys.stdin:
+            infile.close()
+        if outfile is not sys.stdout:
+            outfile.close()
+    return 0
@@ -1,17 +1,62 @@
 #! /usr/bin/env python
 
-import sys, os
+import sys, os, time
 import platform
 from PyQt4 import QtCore, QtGui
-from PyQt4.QtCore import pyqtSignal, pyqtSlot
+from PyQt4.QtCore import pyqtSlot
 from PyQt4.QtGui import QFont, QFontInfo
 from yacc_main_window import Ui_yacc_main_window
-from RecipeEditor import RecipeEditor
-from Backend import Backend
-import pdb
-
-CONFIG_FILE_NAME = 'vaperecipes.json'
-CONFIG_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), CONFIG_FILE_NAME)
+from Backend import Backend, CONFIG_FILE
+import RecipeShards
+from RecipeModels import RecipeListModel
+from Workers import TaskRunner
+import Stats
+from Stats import timer
+
+# how long to wait after the last input change before recalculating the mix
+UPDATE_DELAY_MS = 100
+# and after the recipe file changes on disk before reloading it
+RELOAD_DELAY_MS = 500
+# and after typing in the search box before filtering the recipes
+FILTER_DELAY_MS = 150
+# how often the stats readout in the status bar is refreshed
+STATS_INTERVAL_MS = 1000
+# show the stats readout from the start
+STATS_VAR = 'YACC_STATS'
+
+# TaskRunner workers, these run on a pool thread
+
+def load_backend(task, filename):
+    """ A new Backend with filename loaded and its journal replayed, returns (backend, changes replayed) """
+    be = Backend()
+    for _ in be.iter_load(filename, progress=task.progress):
+        task.check()
+    return (be, be.attach_journal())
+
+def load_for_reload(task, be, filename, frozen):
+    """ filename loaded into a new Backend, and how it differs from be's recipes as they were
+    when frozen (Backend.freeze). Returns the arguments Backend.reload needs to apply it. """
+    if be.is_database() and filename == be.filename:
+        # nothing to load, the database says what changed
+        return (None, be.diff(None, frozen))
+    new = Backend(cache_size=0)
+    for _ in new.iter_load(filename, progress=task.progress):
+        task.check()
+    return (new, be.diff(new, frozen))
+
+def build_search_index(task, be):
+    """ Build be's search index, so the first search doesn't hold up the GUI. Returns be. """
+    be.build_search_index()
+    return be
+
+def calculate_mix_text(task, be, mix_inputs):
+    mix = be.calculate_mix(**mix_inputs)
+    if mix is None:
+        # calculate_mix returns None if the recipe can't be found, so just bail
+        # This shouldn't really happen since recipe_box is only populated by items that
+        # backend.get_recipes returns
+        return 'Backend Error!'
+    return mix.render()
 
 class YaccMain(QtGui.QMainWindow):
     def __init__(self, parent=None):
@@ -24,10 +69,48 @@ class YaccMain(QtGui.QMainWindow):
         mfont = self.get_monospace_font()
         self.ui.output_box.setFont(mfont)
 
-        # set up backend and load recipes
+        # Input changes don't recalculate right away, they (re)start this timer so that a burst of
+        # typing or several signals from the same change only run update_mix once.
+        self.update_timer = QtCore.QTimer(self)
+        self.update_timer.setSingleShot(True)
+        self.update_timer.setInterval(UPDATE_DELAY_MS)
+        self.update_timer.timeout.connect(self.update_mix)
+        self.filter_timer = QtCore.QTimer(self)
+        self.filter_timer.setSingleShot(True)
+        self.filter_timer.setInterval(FILTER_DELAY_MS)
+        self.filter_timer.timeout.connect(self.apply_recipe_filter)
+
+        # what update_mix did last time, so it can skip work when nothing changed
+        self.last_mix_inputs = None
+        self.last_output = None
+        self.error_boxes = set()
+        # when the running mix calculation was asked for, the mix latency is until it's shown
+        self.mix_requested = None
+
+        # file loading and mix calculation happen in the background, see the handle_task_* slots
+        self.runner = TaskRunner(self)
+        self.runner.progress.connect(self.handle_task_progress)
+        self.runner.finished.connect(self.handle_task_finished)
+        self.runner.failed.connect(self.handle_task_failed)
+
+        # set up backend and load recipes. The empty backend is there until the load finishes.
+        self.be = Backend()
+        self.recipe_model = RecipeListModel(self)
+        self.ui.recipe_box.setModel(self.recipe_model)
         self.config_file = CONFIG_FILE
+        self.config_stat = None
         self.load_config()
 
+        # watch the recipe file so that changes from other stations show up automatically
+        self.reload_timer = QtCore.QTimer(self)
+        self.reload_timer.setSingleShot(True)
+        self.reload_timer.setInterval(RELOAD_DELAY_MS)
+        self.reload_timer.timeout.connect(self.handle_reload_timer)
+        self.watcher = QtCore.QFileSystemWatcher(self)
+        self.watcher.fileChanged.connect(self.handle_config_file_change)
+        self.watcher.directoryChanged.connect(self.handle_config_file_change)
+        self.watch_config_file()
+
         # Fill in UI defaults
         self.ui.totalvol_box.setText('10')
         self.ui.nic_box.setText('3')
@@ -42,6 +125,17 @@ class YaccMain(QtGui.QMainWindow):
         self.status_config_message_label = QtGui.QLabel()
         self.ui.status_bar.addPermanentWidget(self.status_config_message_label)
 
+        # operation stats readout (see Stats), off unless turned on in the File menu or with YACC_STATS
+        self.stats_label = QtGui.QLabel()
+        self.stats_label.hide()
+        self.ui.status_bar.addPermanentWidget(self.stats_label)
+        self.stats_timer = QtCore.QTimer(self)
+        self.stats_timer.setInterval(STATS_INTERVAL_MS)
+        self.stats_timer.timeout.connect(self.update_stats_status)
+        self.actionShow_Stats = QtGui.QAction('Show &Stats', self)
+        self.actionShow_Stats.setCheckable(True)
+        self.ui.menuFile.insertAction(self.ui.actionExit, self.actionShow_Stats)
+
         # recipe editor
         self.recipe_editor = None
 
@@ -51,20 +145,23 @@ class YaccMain(QtGui.QMainWindow):
 
         # signals/slots
         self.ui.actionExit.triggered.connect(self.exit)
-        self.ui.update_button.clicked.connect(self.update_mix)
-        self.ui.recipe_box.currentIndexChanged.connect(self.update_mix)
+        self.ui.update_button.clicked.connect(self.force_update_mix)
+        self.ui.recipe_box.currentIndexChanged.connect(self.schedule_update_mix)
         self.ui.recipe_box.currentIndexChanged.connect(self.update_recipe_status)
         self.ui.mix_box.currentIndexChanged.connect(self.handle_mixtype_change)
-        self.ui.totalvol_box.textChanged.connect(self.update_mix)
-        self.ui.nic_box.textChanged.connect(self.update_mix)
-        self.ui.vg_box.textChanged.connect(self.update_mix)
+        self.ui.totalvol_box.textChanged.connect(self.schedule_update_mix)
+        self.ui.nic_box.textChanged.connect(self.schedule_update_mix)
+        self.ui.vg_box.textChanged.connect(self.schedule_update_mix)
+        self.ui.filter_box.textChanged.connect(self.filter_timer.start)
         self.ui.reload_button.clicked.connect(self.load_config)
         self.ui.redit_button.clicked.connect(self.launch_redit)
         self.ui.actionAdd_Recipes.triggered.connect(self.launch_redit)
+        self.actionShow_Stats.toggled.connect(self.show_stats)
+        self.actionShow_Stats.setChecked(bool(os.environ.get(STATS_VAR)))
 
         self.is_init = True
         self.update_mix_type()
-        self.update_mix()
+        self.update_mix(force=True)
         self.update_config_status()
         self.update_recipe_status()
 
@@ -90,22 +187,70 @@ class YaccMain(QtGui.QMainWindow):
         info = QFontInfo(font)
         print('Selected font family: %s'%info.family())
 
-    def update_mix(self):
+    def schedule_update_mix(self):
+        """ Slot for all the input change signals. Restarts the update timer, so update_mix
+        runs once things settle down """
+        if self.is_init:
+            self.update_timer.start()
+
+    def force_update_mix(self):
+        self.update_mix(force=True)
+
+    def update_mix(self, force=False):
+        """ Recalculate the mix and update the output box. Unless force is set, this does nothing
+        if the inputs are the same as last time. force is for when the recipes themselves change. """
         if not self.is_init:
             return
+        self.update_timer.stop()
 
         mix_inputs = self.check_inputs()
         if mix_inputs is None:
+            self.last_mix_inputs = None
             return
 
-        mix = self.be.calculate_mix(**mix_inputs)
-        if mix is None:
-            # calculate_mix returns None if the recipe can't be found, so just bail
-            # This shouldn't really happen since recipe_box is only populated by items that
-            # backend.get_recipes returns
-            mix = 'Backend Error!'
+        if not force and mix_inputs == self.last_mix_inputs:
+            return
+        self.last_mix_inputs = mix_inputs
 
-        self.ui.output_box.setPlainText(mix)
+        if not mix_inputs['recipe_name']:
+            # no recipes (yet)
+            self.runner.cancel('mix')
+            self.show_output('')
+            return
+        # a newer calculation cancels this one, so output_box only ever gets the latest inputs' mix
+        self.mix_requested = time.perf_counter()
+        self.runner.start('mix', calculate_mix_text, self.be, mix_inputs)
+
+    def show_output(self, text):
+        if text != self.last_output:
+            self.ui.output_box.setPlainText(text)
+            self.last_output = text
+
+    @pyqtSlot(str, int, int)
+    def handle_task_progress(self, kind, done, total):
+        if kind in ('load', 'reload') and total > 0:
+            self.ui.status_bar.showMessage('Loading %s: %d%%'%(self.config_file, done * 100 // total))
+
+    @pyqtSlot(str, object)
+    def handle_task_finished(self, kind, result):
+        if kind == 'mix':
+            self.show_output(result)
+            Stats.record('gui.mix', time.perf_counter() - self.mix_requested)
+        elif kind == 'load':
+            self.finish_load_config(*result)
+        elif kind == 'reload':
+            self.finish_reload_config(*result)
+        elif kind == 'index':
+            if result is self.be and self.filter_text():
+                # the filter was only matching names until now
+                self.apply_recipe_filter()
+
+    @pyqtSlot(str, str)
+    def handle_task_failed(self, kind, message):
+        if kind == 'mix':
+            self.show_output('Backend Error!')
+        elif kind in ('load', 'reload'):
+            self.ui.status_bar.showMessage('Unable to load %s: %s'%(self.config_file, message))
 
     def update_mix_type(self):
         if not self.is_init:
@@ -139,28 +284,136 @@ class YaccMain(QtGui.QMainWindow):
                                                 cfg['nic_strength'], cfg['nic_base'].upper(), cfg['n_recipes']))
     
     def load_config(self):
+        """ Load the recipe file in the background, finish_load_config takes over from there """
+        if self.be.filename == self.config_file:
+            # already loaded, just apply whatever changed
+            self.reload_config()
+            return
+
+        self.config_stat = self.get_config_stat()
+        self.ui.status_bar.showMessage('Loading %s...'%self.config_file)
+        # a reload would be for the backend that's about to be replaced
+        self.runner.cancel('reload')
+        self.runner.start('load', load_backend, self.config_file)
+
+    @timer('gui.load_apply')
+    def finish_load_config(self, be, replayed):
         is_init_last = self.is_init
         self.is_init = False # make sure update_mix doesn't fail when the config is cleared out
-        self.be = Backend(self.config_file)
+        self.be.close_journal()
+        self.be = be
         selected_recipe = self.ui.recipe_box.currentText()
         self.populate_recipe_box(selected_recipe)
-
         self.is_init = is_init_last
-        self.update_mix()
 
+        # the journal logs changes next to the recipe file, and brought back the ones that weren't saved last time
+        conflicts = be.get_conflicts()
+        if replayed:
+            self.ui.status_bar.showMessage('Recovered %d unsaved change%s from the journal'%(
+                                           replayed, '' if replayed == 1 else 's'))
+        elif conflicts:
+            # the details were printed while loading
+            self.ui.status_bar.showMessage('%d recipe%s in more than one shard, using the first'%(
+                                           len(conflicts), '' if len(conflicts) == 1 else 's'))
+        else:
+            self.ui.status_bar.clearMessage()
+        self.update_config_status()
+        self.update_recipe_status()
+        self.update_mix(force=True)
+        self.runner.start('index', build_search_index, be)
+
+    def reload_config(self):
+        """ Re-read the recipe file, and only apply the added/removed/modified recipes to the
+        backend and the widgets rather than rebuilding everything. The file is read and compared
+        in the background, finish_reload_config applies the result. """
+        self.config_stat = self.get_config_stat()
+        self.runner.start('reload', load_for_reload, self.be, self.config_file, self.be.freeze())
+
+    @timer('gui.reload_apply')
+    def finish_reload_config(self, loaded, changes):
+        (added, removed, modified) = self.be.reload(self.config_file, loaded, changes)
+        self.ui.status_bar.clearMessage()
+
+        self.update_recipe_box(added, removed)
+        if self.recipe_editor is not None:
+            self.recipe_editor.handle_backend_reloaded(added, removed, modified)
+        self.update_config_status()
+        self.update_recipe_status()
+        self.update_mix(force=True)
+
+    def get_config_stat(self):
+        return RecipeShards.library_stat(self.config_file)
+
+    def watch_config_file(self):
+        """ Make sure the recipe file is being watched. Saving replaces the file by renaming a new
+        one over it, which makes QFileSystemWatcher forget it, so watch the directory as well and
+        add the file back after every change. A library directory gets its shards watched too, and
+        a recipe database its -wal file. """
+        watched = set(self.watcher.files()) | set(self.watcher.directories())
+        paths = [self.config_file, os.path.dirname(self.config_file)]
+        if os.path.isdir(self.config_file):
+            paths += [os.path.join(self.config_file, name) for name in RecipeShards.list_shards(self.config_file)]
+        elif self.be.is_database():
+            # other stations' commits only touch the write-ahead log until it's checkpointed
+            paths.append(self.config_file + '-wal')
+        for path in paths:
+            if path not in watched and os.path.exists(path):
+                self.watcher.addPath(path)
+
+    def handle_config_file_change(self, path):
+        # writers often touch the file several times in a row, wait for things to settle
+        self.reload_timer.start()
+
+    def handle_reload_timer(self):
+        self.watch_config_file()
+        # directory changes fire for every file in there, only reload if the recipe file changed
+        if self.get_config_stat() != self.config_stat:
+            # reloads, or starts the load over if it hadn't finished yet
+            self.load_config()
+
+    @timer('gui.populate_recipe_box')
     def populate_recipe_box(self, selected_recipe=None):
         is_init_last = self.is_init
         self.is_init = False
-        self.ui.recipe_box.clear()
-        for recipe in self.be.get_recipes():
-            self.ui.recipe_box.addItem(recipe)
+        self.recipe_model.set_names(self.filtered_recipes())
 
         if selected_recipe is not None:
-            selected_index = self.ui.recipe_box.findText(selected_recipe)
+            selected_index = self.recipe_model.row_of(str(selected_recipe))
             if selected_index != -1:
+                # the model only hands rows to the combo box as they're needed
+                self.recipe_model.fetch_to(selected_index)
                 self.ui.recipe_box.setCurrentIndex(selected_index)
         self.is_init = is_init_last
 
+    def update_recipe_box(self, added, removed):
+        """ Insert/remove just the given recipes in recipe_box, keeping it sorted and keeping the selection """
+        if self.filter_text():
+            # added recipes might not match the filter, just run it again
+            self.populate_recipe_box(self.ui.recipe_box.currentText())
+            return
+        is_init_last = self.is_init
+        self.is_init = False
+        for recipe in removed:
+            self.recipe_model.remove(recipe)
+        for recipe in added:
+            self.recipe_model.insert(recipe)
+        self.is_init = is_init_last
+
+    def filter_text(self):
+        return str(self.ui.filter_box.text()).strip()
+
+    def filtered_recipes(self):
+        """ Names of the recipes matching the search box, or all of them """
+        # the index is built in the background (see build_search_index), this doesn't wait for it
+        return self.be.quick_search(self.filter_text())
+
+    @timer('gui.filter')
+    def apply_recipe_filter(self):
+        self.populate_recipe_box(self.ui.recipe_box.currentText())
+        # the selection may well have changed while is_init was off
+        self.update_recipe_status()
+        self.schedule_update_mix()
+
     def update_recipe_status(self):
         if not self.is_init:
             return
@@ -170,9 +423,9 @@ class YaccMain(QtGui.QMainWindow):
         if total_flav is None:
             self.ui.status_bar.showMessage('Recipe %s not found!'%current_recipe)
         else:
-            total_flav = total_flav * 100.0
+            max_vg = self.be.get_max_vg(current_recipe)
             self.ui.status_bar.showMessage('Recipe: %s; Total Flavor: %.1f%%; Max VG: %.1f%%'%(
-                                            current_recipe, total_flav, 100.0-total_flav))
+                                            current_recipe, total_flav*100.0, max_vg*100.0))
 
     def check_inputs(self):
         """ Read the mix parameters from the UI elements and convert numbers to type float.
@@ -202,15 +455,32 @@ class YaccMain(QtGui.QMainWindow):
                 inputs_out[field] = float(box.text())
                 if inputs_out[field] < 0:
                     raise ValueError
-                box.setStyleSheet('')
+                self.set_box_error(box, False)
             except ValueError:
-                box.setStyleSheet('background-color: rgb(255, 102, 102);')
+                self.set_box_error(box, True)
                 err = True
 
         return None if err else inputs_out
 
+    def set_box_error(self, box, error):
+        """ Mark an input box red (or not). setStyleSheet makes Qt re-polish the widget,
+        so only call it when the state actually changes """
+        if error == (box in self.error_boxes):
+            return
+        if error:
+            box.setStyleSheet('background-color: rgb(255, 102, 102);')
+            self.error_boxes.add(box)
+        else:
+            box.setStyleSheet('')
+            self.error_boxes.discard(box)
+
     def launch_redit(self):
+        if self.runner.is_running('load'):
+            self.ui.status_bar.showMessage('Still loading %s...'%self.config_file)
+            return
         if self.recipe_editor is None:
+            # the editor is only needed once someone opens it, so don't import it at startup
+            from RecipeEditor import RecipeEditor
             self.recipe_editor = RecipeEditor(self, self.be)
             self.recipe_editor.signal_exit.connect(self.handle_redit_exit)
             self.recipe_editor.signal_backend_updated.connect(self.handle_redit_backend_update)
@@ -220,25 +490,46 @@ class YaccMain(QtGui.QMainWindow):
         # wrapper here for change event on mix type box
         # Do this rather than assigning 2 slots so it executes in definite order
         self.update_mix_type()
-        self.update_mix()
+        self.schedule_update_mix()
 
     @pyqtSlot()
     def handle_redit_backend_update(self):
         selected_recipe = self.ui.recipe_box.currentText()
         self.populate_recipe_box(selected_recipe)
         self.update_recipe_status()
-        self.update_mix()
+        self.update_mix(force=True)
 
     @pyqtSlot(str)
     def handle_redit_exit(self, text):
-        self.ui.output_box.setPlainText('RBUILD EXIT:' + text)
+        self.show_output('RBUILD EXIT:' + text)
         self.recipe_editor = None
 
+    def show_stats(self, show):
+        self.stats_label.setVisible(show)
+        if show:
+            self.update_stats_status()
+            self.stats_timer.start()
+        else:
+            self.stats_timer.stop()
+
+    def update_stats_status(self):
+        stats = self.be.get_stats()
+        cache = stats['mix_cache']
+        lookups = cache['hits'] + cache['misses']
+        text = Stats.summary() or 'No stats yet'
+        if lookups:
+            text += ' | mix cache %d%% hits'%(cache['hits'] * 100 // lookups)
+        if stats['journal_bytes']:
+            text += ' | journal %d kB'%(stats['journal_bytes'] // 1024)
+        self.stats_label.setText(text)
+
     def exit(self):
+        self.runner.cancel_all()
         QtCore.QCoreApplication.instance().quit()
 
 
 if __name__ == "__main__":
+    Stats.start_profiling()
     app = QtGui.QApplication(sys.argv)
     myapp = YaccMain()
     myapp.show()
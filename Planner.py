@@ -0,0 +1,343 @@
+# Production planner: given what's in stock (flavor concentrates, nicotine base, VG, PG) and the
+# demand per SKU (a recipe at a given size/strength/VG/mix type, like a Batch order, plus a number
+# of units), work out how many units of each SKU to make.
+#
+# Each SKU's ingredient usage per unit comes from the same volume model as calculate_mix
+# (Backend._mix_batch_matrix, so Max VG/Max PG clamping included) and RecipeMatrix for the flavors.
+# If the whole demand fits in the stock that's the plan. Otherwise it's a linear program
+#     maximize value @ x   subject to   usage @ x <= stock,   0 <= x <= demand
+# which is solved with a small dense simplex (numpy only, no scipy), rounded down to whole units,
+# topped up greedily with whatever still fits, and then improved by trading units of some SKUs for
+# a unit of another while that adds value (see _improve). Whole units make it an integer program, so this is an
+# approximation: it's usually the optimum, but not always. The LP's shadow prices say which
+# ingredients are the binding constraints, and for every SKU that falls short the ingredient that
+# keeps it from getting one more unit is reported.
+# The simplex tableau is dense, (ingredients + SKUs) x (ingredients + 2*SKUs) floats, so plans are
+# limited to MAX_SKUS SKUs: 1000 SKUs using 1000 different ingredients make a 48 MB tableau.
+
+import csv, json, os, sys
+from contextlib import redirect_stdout
+import numpy as np
+from Backend import Backend, CONFIG_FILE
+from Batch import ORDER_FIELDS, ORDER_DEFAULTS, FIELD_ALIASES
+
+# names of the non-flavor ingredients in stock lists (the same as `yacc shop` writes)
+BASE_INGREDIENTS = ('Nicotine', 'VG', 'PG')
+
+TOLERANCE = 1e-9
+# most rounds of _improve, each one tries every SKU that's short
+IMPROVE_PASSES = 20
+# most SKUs in one plan, see the top of the file
+MAX_SKUS = 1000
+
+def _fits(used, have):
+    # relative, stock levels go from a few mL of a flavor to liters of VG
+    return used <= have * (1.0 + TOLERANCE) + 1e-12
+
+def simplex(c, A, b, max_iter=None):
+    """ Maximize c @ x subject to A @ x <= b and x >= 0, where b >= 0 (so x = 0 is feasible and
+    there's no phase 1). Dense tableau, steepest reduced cost pivoting, switching to Bland's rule
+    while pivots are degenerate so it can't cycle.
+    Returns (x, y) where y are the shadow prices (dual values) of the rows of A.
+    Raises ValueError if the problem is unbounded. """
+    A = np.asarray(A, dtype=float)
+    (m, n) = A.shape
+    if max_iter is None:
+        max_iter = 50 * (m + n)
+    T = np.zeros((m + 1, n + m + 1))
+    T[:m, :n] = A
+    T[:m, n:n+m] = np.eye(m)
+    T[:m, -1] = b
+    T[m, :n] = -np.asarray(c, dtype=float)
+    basis = np.arange(n, n + m)
+
+    degenerate = 0
+    for _ in range(max_iter):
+        costs = T[m, :-1]
+        candidates = np.flatnonzero(costs < -TOLERANCE)
+        if len(candidates) == 0:
+            break
+        col = candidates[0] if degenerate > 10 else candidates[np.argmin(costs[candidates])]
+
+        column = T[:m, col]
+        positive = column > TOLERANCE
+        if not positive.any():
+            raise ValueError('LP is unbounded')
+        ratios = np.full(m, np.inf)
+        ratios[positive] = T[:m, -1][positive] / column[positive]
+        best = ratios.min()
+        # ties go to the lowest basic variable, which is the other half of Bland's rule
+        ties = np.flatnonzero(ratios <= best + TOLERANCE)
+        row = ties[np.argmin(basis[ties])]
+        degenerate = degenerate + 1 if best <= TOLERANCE else 0
+
+        pivot_row = T[row] / T[row, col]
+        T -= np.outer(T[:, col], pivot_row)
+        T[row] = pivot_row
+        basis[row] = col
+    else:
+        print('Warning: simplex hit the iteration limit, plan may not be optimal')
+
+    x = np.zeros(n + m)
+    x[basis] = T[:m, -1]
+    return (x[:n], T[m, n:n+m].copy())
+
+def _fill(units, demand, order, usage, have):
+    """ Greedily top up units (in place) with whatever still fits, SKUs in the given order """
+    left = have - usage @ units
+    slack = have * TOLERANCE + 1e-12
+    # what's left only goes down, so a SKU that doesn't fit one more unit now never will
+    fits = (units < demand) & usage.any(axis=0) & np.all(usage <= (left + slack)[:, None], axis=0)
+    for k in order:
+        if not fits[k]:
+            continue
+        need = usage[:, k]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            room = np.where(need > 0, (left + slack) / need, np.inf)
+        extra = min(max(np.floor(room.min()), 0.0), demand[k] - units[k])
+        if extra > 0:
+            units[k] += extra
+            left -= need * extra
+
+def _make_room(units, j, value, usage, have):
+    """ The ways _improve tries of fitting one more unit of SKU j: taking off as few units of a single
+    SKU as will do, and taking off the units that free up each overdrawn ingredient for the least
+    value. Returns a list of new units arrays. """
+    trial = units.copy()
+    trial[j] += 1
+    short = usage @ trial - have * (1.0 + TOLERANCE) - 1e-12
+    over = np.flatnonzero(short > 0)
+    if len(over) == 0:
+        return [trial]
+
+    # units of each SKU k it would take off on its own, inf if k doesn't free up all of it
+    with np.errstate(divide='ignore', invalid='ignore'):
+        needed = np.ceil(short[over, None] / usage[over]).max(axis=0)
+    needed[j] = np.inf
+    needed[needed > units] = np.inf
+    trials = []
+    if np.isfinite(needed).any():
+        k = int(np.argmin(np.where(np.isfinite(needed), needed * value, np.inf)))
+        single = trial.copy()
+        single[k] -= needed[k]
+        if np.all(_fits(usage @ single, have)):
+            trials.append(single)
+
+    while True:
+        i = over[0]
+        # value given up per mL of ingredient i freed, never touching j itself
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cost = np.where((usage[i] > 0) & (trial > 0), value / usage[i], np.inf)
+        cost[j] = np.inf
+        k = int(np.argmin(cost))
+        if not np.isfinite(cost[k]):
+            break
+        trial[k] -= 1
+        over = np.flatnonzero(~_fits(usage @ trial, have))
+        if len(over) == 0:
+            trials.append(trial)
+            break
+    return trials
+
+def _improve(units, demand, value, order, usage, have):
+    """ Local search after rounding: force one more unit of a SKU that's short, make room for it
+    (see _make_room), fill up again, and keep the result if it's worth more. Changes units in place. """
+    for _ in range(IMPROVE_PASSES):
+        improved = False
+        for j in np.flatnonzero(units < demand):
+            if not usage[:, j].any():
+                continue
+            for trial in _make_room(units, j, value, usage, have):
+                _fill(trial, demand, order, usage, have)
+                if value @ trial > (value @ units) * (1.0 + TOLERANCE) + 1e-12:
+                    units[:] = trial
+                    improved = True
+        if not improved:
+            break
+
+def usage_matrix(backend, skus):
+    """ Ingredient usage per unit of each SKU.
+    Returns (ingredients, usage, valid): usage[i, k] is mL of ingredients[i] per unit of skus[k],
+    valid[k] is False if the SKU's recipe wasn't found (its column is all 0).
+    Raises ValueError if the library is empty or none of the recipes are in it. """
+    cols = [[sku[f] for sku in skus] for f in ORDER_FIELDS]
+    (res, matrix) = backend._mix_batch_matrix(*cols)
+    valid = res['valid']
+    if len(matrix.names) == 0:
+        raise ValueError('the recipe library is empty')
+    if not valid.any():
+        raise ValueError('none of the recipes are in the library')
+
+    flavor_usage = np.zeros((len(matrix.flavors), len(skus)))
+    rows = matrix.row_of_store_row[res['rows'][valid]]
+    flavor_usage[:, valid] = (matrix.toarray(rows) * res['scale'][valid, None]).T
+    used = np.flatnonzero(flavor_usage.any(axis=1))
+    ingredients = [matrix.flavors[j] for j in used] + list(BASE_INGREDIENTS)
+    usage = np.vstack([flavor_usage[used], res['nic'], res['vg'], res['pg']])
+    return (ingredients, usage, valid)
+
+def plan(backend, skus, stock, default_stock=0.0):
+    """ Plan production of skus (dicts with the Batch order fields plus 'units' demanded, and
+    optionally 'value' per unit, which defaults to the SKU's volume so the plan makes as many mL as
+    it can) from stock (ingredient name -> mL on hand, see BASE_INGREDIENTS). Ingredients that
+    aren't in stock get default_stock, use float('inf') to only constrain what's listed.
+    The plan is an approximation (see the top of the file), it never uses more than the stock.
+    Returns a dict:
+        units:       units to make, per SKU
+        feasible:    True if that's the whole demand
+        volume:      total mL made
+        usage:       ingredient -> mL used
+        binding:     [(ingredient, shadow price)] for the ingredients limiting the plan, most
+                     limiting first. The shadow price is how much value one more mL would add.
+        limited_by:  per SKU, the ingredient stopping it from getting one more unit (None if the
+                     SKU's demand is met, its recipe wasn't found or it uses no ingredients)
+        not_found:   sorted names of recipes that weren't found (none of those get made)
+    Raises ValueError for more than MAX_SKUS skus, an empty library, or if none of the recipes are found.
+    """
+    skus = [dict(ORDER_DEFAULTS, **sku) for sku in skus]
+    n = len(skus)
+    if n == 0:
+        return {'units': [], 'feasible': True, 'volume': 0.0, 'usage': {}, 'binding': [], 'limited_by': [],
+                'not_found': []}
+    if n > MAX_SKUS:
+        raise ValueError('%d SKUs, at most %d can be planned at once'%(n, MAX_SKUS))
+    demand = np.array([max(int(sku.get('units', 1)), 0) for sku in skus], dtype=float)
+    volume = np.array([float(sku['totalvol']) for sku in skus])
+    value = np.array([float(sku.get('value', v)) for (sku, v) in zip(skus, volume)])
+
+    with redirect_stdout(sys.stderr):
+        (ingredients, usage, valid) = usage_matrix(backend, skus)
+    demand[~valid] = 0.0
+    have = np.array([float(stock.get(name, default_stock)) for name in ingredients])
+
+    units = demand.copy()
+    binding = []
+    feasible = bool(np.all(_fits(usage @ demand, have)))
+    if not feasible:
+        # Only rows that can actually run out go into the LP, plus an upper bound row per SKU.
+        # Every row is scaled to a largest coefficient of 1, flavors at 0.01% in a 10 mL bottle
+        # and liters of VG in the same tableau don't mix well otherwise.
+        scale = usage.max(axis=1)
+        limited = np.flatnonzero(np.isfinite(have) & (scale > 0))
+        A = np.vstack([usage[limited] / scale[limited, None], np.eye(n)])
+        b = np.concatenate([np.maximum(have[limited], 0.0) / scale[limited], demand])
+        (x, duals) = simplex(value, A, b)
+        duals = duals[:len(limited)] / scale[limited]
+
+        # round down (using less never breaks a constraint, apart from the LP's rounding errors),
+        # then fit in what we can
+        units = np.minimum(np.floor(x + 1e-6), demand)
+        left = have - usage @ units
+        for i in np.flatnonzero(~_fits(usage @ units, have)):
+            # take units off the SKUs using the most of this ingredient until it fits
+            for k in np.argsort(-usage[i]):
+                while units[k] > 0 and left[i] < -have[i] * TOLERANCE - 1e-12:
+                    units[k] -= 1
+                    left += usage[:, k]
+        order = np.argsort(-value / np.maximum(volume, TOLERANCE))
+        _fill(units, demand, order, usage, have)
+        _improve(units, demand, value, order, usage, have)
+
+        order = np.argsort(-duals)
+        binding = [(ingredients[limited[i]], float(duals[i])) for i in order if duals[i] > TOLERANCE]
+
+    left = have - usage @ units
+    limited_by = []
+    for k in range(n):
+        if units[k] >= demand[k]:
+            limited_by.append(None)
+            continue
+        need = usage[:, k]
+        if not need.any():
+            # nothing to run out of
+            limited_by.append(None)
+            continue
+        # the ingredient that runs out first if one more unit were made
+        with np.errstate(divide='ignore', invalid='ignore'):
+            room = np.where(need > 0, left / need, np.inf)
+        limited_by.append(ingredients[int(np.argmin(room))])
+
+    return {'units': [int(u) for u in units],
+            'feasible': feasible,
+            'volume': float(volume @ units),
+            'usage': {name: float(u) for (name, u) in zip(ingredients, usage @ units) if u > 0},
+            'binding': binding,
+            'limited_by': limited_by,
+            'not_found': sorted(set(str(sku['recipe']) for (sku, ok) in zip(skus, valid) if not ok))}
+
+def read_stock(filename):
+    """ Stock list from a csv with item,ml columns (like `yacc shop` writes) or a json object """
+    with open(filename, newline='', encoding='utf-8') as fp:
+        if os.path.splitext(filename)[1].lower() == '.json':
+            return {name: float(ml) for (name, ml) in json.load(fp).items()}
+        return {row['item']: float(row['ml']) for row in csv.DictReader(fp)}
+
+def read_demand(filename):
+    """ SKUs from a csv/jsonl file with the Batch order columns plus units (and optionally value) """
+    skus = []
+    with open(filename, newline='', encoding='utf-8') as fp:
+        if os.path.splitext(filename)[1].lower() in ('.jsonl', '.ndjson', '.json'):
+            rows = (json.loads(line) for line in fp if line.strip())
+        else:
+            rows = csv.DictReader(fp)
+        for row in rows:
+            sku = {}
+            for (key, val) in row.items():
+                key = key.strip().lower()
+                key = FIELD_ALIASES.get(key, key)
+                if val in ('', None):
+                    continue
+                sku[key] = str(val) if key in ('recipe', 'mix') else float(val)
+            if 'recipe' not in sku:
+                raise ValueError('%s: SKU without a recipe'%filename)
+            skus.append(sku)
+    return skus
+
+def add_arguments(parser):
+    parser.add_argument('-l', '--library', default=CONFIG_FILE,
+                        help='recipe library json file, directory of shards or database (default: %(default)s)')
+    parser.add_argument('-s', '--stock', required=True, help='stock list, csv (item,ml) or json')
+    parser.add_argument('-d', '--demand', required=True,
+                        help='SKUs to plan, csv or jsonl with recipe,totalvol,nic,vg,mix,units[,value]')
+    parser.add_argument('-o', '--output', default='-', help='plan csv file, - for stdout (default)')
+    parser.add_argument('--unlisted', choices=('none', 'unlimited'), default='none',
+                        help='how much there is of ingredients not in the stock list (default: %(default)s)')
+
+def main(args):
+    if not os.path.exists(args.library):
+        print('Error: recipe library %s not found'%args.library, file=sys.stderr)
+        return 1
+    try:
+        stock = read_stock(args.stock)
+        skus = read_demand(args.demand)
+    except (OSError, ValueError, KeyError) as e:
+        print('Error: %s'%e, file=sys.stderr)
+        return 1
+
+    with redirect_stdout(sys.stderr):
+        backend = Backend(args.library)
+    try:
+        result = plan(backend, skus, stock, float('inf') if args.unlisted == 'unlimited' else 0.0)
+    except ValueError as e:
+        print('Error: %s'%e, file=sys.stderr)
+        return 1
+
+    outfile = sys.stdout if args.output == '-' else open(args.output, 'w', newline='', encoding='utf-8')
+    try:
+        writer = csv.writer(outfile, lineterminator='\n')
+        writer.writerow(ORDER_FIELDS + ('units', 'planned', 'limited_by'))
+        for (sku, units, limit) in zip(skus, result['units'], result['limited_by']):
+            sku = dict(ORDER_DEFAULTS, **sku)
+            writer.writerow([sku[f] for f in ORDER_FIELDS] + [int(sku.get('units', 1)), units, limit or ''])
+    finally:
+        if outfile is not sys.stdout:
+            outfile.close()
+
+    print('%s, %.1f mL planned'%('Whole demand fits' if result['feasible'] else 'Demand exceeds stock',
+                                 result['volume']), file=sys.stderr)
+    for (name, price) in result['binding']:
+        print('Binding: %s (%.2f mL used, shadow price %.4f)'%(name, result['usage'].get(name, 0.0), price),
+              file=sys.stderr)
+    if result['not_found']:
+        print('Recipes not found: %s'%', '.join(result['not_found']), file=sys.stderr)
+    return 0
@@ -0,0 +1,486 @@
+# SQLite storage for recipe libraries, the alternative to the json file(s) once a library gets big
+# or several stations share it. Backend takes a database (*.db, *.sqlite, *.sqlite3, or anything
+# that starts with the SQLite header) wherever it takes a recipe file.
+#
+# Tables: recipes (name, and the generations it was created/last updated in), flavors, and
+# recipe_flavors joining them with the fraction (fractions like in RecipeStore, not the json's
+# percents), all indexed for lookups by name, plus meta (the _config) and removed (when each
+# removed recipe went away).
+#
+# Backend talks to it through DatabaseStorage (see Storage).
+# Nothing is read up front: Backend's store is a LazyRecipeStore, which fetches each recipe the first
+# time it's used, so opening a library and using a few recipes costs the same whatever its size.
+# Searching and the matrix need everything and load the rest then (LazyRecipeStore.load_all).
+# Changes are written through, each update_recipes/remove_recipes call is one transaction, so
+# there's nothing to save (or journal) and saving costs what was changed.
+#
+# The database is in WAL mode, so every station can read while one writes. Every write transaction
+# bumps a generation number and stamps what it changed with it, so picking up other stations'
+# changes (Backend.reload) is a query for what changed since the generation we last saw.
+#
+# To move a json library over: python -m yacc import vaperecipes.json recipes.db
+# (or save it as a .db, see Backend.write_file). Saving a database as json works the other way.
+
+import os, sqlite3, sys, threading, time
+from bisect import bisect_left
+from contextlib import contextmanager
+from RecipeStore import RecipeStore
+from Storage import Storage
+import Stats
+
+SCHEMA_VERSION = 1
+# seconds to wait for another station's write transaction to finish
+BUSY_TIMEOUT = 10.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS recipes (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    created INTEGER NOT NULL,
+    updated INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS recipes_created ON recipes (created);
+CREATE INDEX IF NOT EXISTS recipes_updated ON recipes (updated);
+CREATE TABLE IF NOT EXISTS flavors (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS recipe_flavors (
+    recipe_id INTEGER NOT NULL REFERENCES recipes (id) ON DELETE CASCADE,
+    flavor_id INTEGER NOT NULL REFERENCES flavors (id),
+    fraction REAL NOT NULL,
+    PRIMARY KEY (recipe_id, flavor_id)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS recipe_flavors_flavor ON recipe_flavors (flavor_id);
+CREATE TABLE IF NOT EXISTS removed (name TEXT PRIMARY KEY, generation INTEGER NOT NULL) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS removed_generation ON removed (generation);
+"""
+
+# one recipe with its flavors, one row per flavor (a single row of NULLs for a recipe without any)
+_GET_RECIPE = """
+SELECT f.name, rf.fraction FROM recipes r
+    LEFT JOIN recipe_flavors rf ON rf.recipe_id = r.id
+    LEFT JOIN flavors f ON f.id = rf.flavor_id
+WHERE r.name = ?"""
+
+_ALL_RECIPES = """
+SELECT r.name, f.name, rf.fraction FROM recipes r
+    LEFT JOIN recipe_flavors rf ON rf.recipe_id = r.id
+    LEFT JOIN flavors f ON f.id = rf.flavor_id
+ORDER BY r.name"""
+
+class RecipeDB(object):
+    def __init__(self, path):
+        self.path = path
+        # one connection, shared by the GUI and worker threads, so every use of it goes through _lock
+        self._conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+        self._lock = threading.RLock()
+        # flavor name -> id. Flavors are never deleted, so ids stay good whoever added them.
+        self._flavor_ids = {}
+        conn = self._conn
+        conn.execute('PRAGMA journal_mode = WAL')
+        # in WAL mode this only risks the last few transactions on a power cut, never corruption
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute('PRAGMA foreign_keys = ON')
+        try:
+            version = conn.execute("SELECT value FROM meta WHERE key = 'schema'").fetchone()[0]
+        except (sqlite3.OperationalError, TypeError):
+            # a new database. Only take the write lock then, opening shouldn't wait for other stations.
+            with self._transaction() as cur:
+                # not executescript, that commits first
+                for statement in SCHEMA.split(';'):
+                    if statement.strip():
+                        cur.execute(statement)
+                cur.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('schema', ?)", (SCHEMA_VERSION,))
+                cur.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('generation', 0)")
+                version = cur.execute("SELECT value FROM meta WHERE key = 'schema'").fetchone()[0]
+        if version != SCHEMA_VERSION:
+            conn.close()
+            raise ValueError('%s is a version %s recipe database, expected %d'%(path, version, SCHEMA_VERSION))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    @contextmanager
+    def _transaction(self):
+        """ A write transaction. IMMEDIATE takes the write lock up front, so two stations writing at
+        once wait for each other (up to BUSY_TIMEOUT) instead of one failing halfway through. """
+        with self._lock:
+            cur = self._conn.cursor()
+            cur.execute('BEGIN IMMEDIATE')
+            try:
+                yield cur
+            except:
+                cur.execute('ROLLBACK')
+                # flavor ids handed out in the transaction that was rolled back don't exist
+                self._flavor_ids.clear()
+                raise
+            cur.execute('COMMIT')
+
+    def _next_generation(self, cur):
+        cur.execute("UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+        return cur.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()[0]
+
+    def generation(self):
+        with self._lock:
+            return self._conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()[0]
+
+    def config(self):
+        """ (nic_base, nic_strength), the defaults if they were never set """
+        with self._lock:
+            meta = dict(self._conn.execute("SELECT key, value FROM meta WHERE key IN ('nic_base', 'nic_strength')"))
+        return (meta.get('nic_base', 'vg'), meta.get('nic_strength', 100.0))
+
+    def set_config(self, nic_base, nic_strength):
+        with self._transaction() as cur:
+            self._next_generation(cur)
+            self._set_config(cur, nic_base, nic_strength)
+
+    def _set_config(self, cur, nic_base, nic_strength):
+        cur.executemany('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                        [('nic_base', nic_base), ('nic_strength', nic_strength)])
+
+    def names(self):
+        """ Sorted recipe names (SQLite's default ordering is the same as Python's for str) """
+        with self._lock:
+            return [name for (name,) in self._conn.execute('SELECT name FROM recipes ORDER BY name')]
+
+    def get(self, name):
+        """ The recipe as a dict of flavor -> fraction, or None """
+        with self._lock:
+            rows = self._conn.execute(_GET_RECIPE, (name,)).fetchall()
+        if not rows:
+            return None
+        return {flavor: fraction for (flavor, fraction) in rows if flavor is not None}
+
+    def iter_all(self):
+        """ Yields (name, recipe) for every recipe, in name order. Holds the lock until it's done,
+        so don't use the RecipeDB for anything else while iterating. """
+        with self._lock:
+            (current, recipe) = (None, None)
+            for (name, flavor, fraction) in self._conn.execute(_ALL_RECIPES):
+                if name != current:
+                    if current is not None:
+                        yield (current, recipe)
+                    (current, recipe) = (name, {})
+                if flavor is not None:
+                    recipe[flavor] = fraction
+            if current is not None:
+                yield (current, recipe)
+
+    def _flavor_id(self, cur, flavor):
+        fid = self._flavor_ids.get(flavor)
+        if fid is None:
+            cur.execute('INSERT OR IGNORE INTO flavors (name) VALUES (?)', (flavor,))
+            fid = cur.execute('SELECT id FROM flavors WHERE name = ?', (flavor,)).fetchone()[0]
+            self._flavor_ids[flavor] = fid
+        return fid
+
+    def _put(self, cur, gen, name, recipe):
+        cur.execute('INSERT INTO recipes (name, created, updated) VALUES (?, ?, ?) '
+                    'ON CONFLICT (name) DO UPDATE SET updated = excluded.updated', (name, gen, gen))
+        rid = cur.execute('SELECT id FROM recipes WHERE name = ?', (name,)).fetchone()[0]
+        cur.execute('DELETE FROM recipe_flavors WHERE recipe_id = ?', (rid,))
+        cur.executemany('INSERT INTO recipe_flavors (recipe_id, flavor_id, fraction) VALUES (?, ?, ?)',
+                        [(rid, self._flavor_id(cur, flavor), frac) for (flavor, frac) in recipe.items()])
+        cur.execute('DELETE FROM removed WHERE name = ?', (name,))
+
+    def _remove(self, cur, gen, name):
+        cur.execute('DELETE FROM recipes WHERE name = ?', (name,))
+        if cur.rowcount:
+            cur.execute('INSERT OR REPLACE INTO removed (name, generation) VALUES (?, ?)', (name, gen))
+
+    def put(self, recipes):
+        """ Add or replace recipes (name -> dict of flavor -> fraction), in one transaction.
+        Returns the generation it was written as. """
+        with self._transaction() as cur:
+            gen = self._next_generation(cur)
+            for (name, recipe) in recipes.items():
+                self._put(cur, gen, name, recipe)
+        return gen
+
+    def remove(self, names):
+        """ Remove recipes in one transaction, returns the generation it was written as """
+        with self._transaction() as cur:
+            gen = self._next_generation(cur)
+            for name in names:
+                self._remove(cur, gen, name)
+        return gen
+
+    def replace_all(self, store, nic_base, nic_strength):
+        """ Make the database hold exactly the recipes in a RecipeStore and its config, in one
+        transaction, so other stations see either the old library or the new one and a crash halfway
+        leaves the old one. Returns the generation it was written as. """
+        with self._transaction() as cur:
+            gen = self._next_generation(cur)
+            names = store.names()
+            keep = set(names)
+            for name in [name for (name,) in cur.execute('SELECT name FROM recipes') if name not in keep]:
+                self._remove(cur, gen, name)
+            self._set_config(cur, nic_base, nic_strength)
+            for name in names:
+                self._put(cur, gen, name, store.get(name))
+        return gen
+
+    def changes_since(self, generation):
+        """ What changed after generation, by this or any other station.
+        Returns (added, removed, modified, current generation), the first three sorted name lists. """
+        with self._lock:
+            cur = self._conn.cursor()
+            # a read transaction, so the lists and the generation all come from the same moment
+            cur.execute('BEGIN')
+            try:
+                added = [n for (n,) in cur.execute('SELECT name FROM recipes WHERE created > ? ORDER BY name',
+                                                   (generation,))]
+                modified = [n for (n,) in cur.execute('SELECT name FROM recipes WHERE updated > ? AND created <= ? '
+                                                      'ORDER BY name', (generation, generation))]
+                removed = [n for (n,) in cur.execute('SELECT name FROM removed WHERE generation > ? ORDER BY name',
+                                                     (generation,))]
+                current = cur.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()[0]
+            finally:
+                cur.execute('COMMIT')
+        return (added, removed, modified, current)
+
+class LazyRecipeStore(RecipeStore):
+    """ RecipeStore over a RecipeDB: recipes are fetched from the database the first time they're
+    used and kept in the columns like any other. Only Backend changes it, after writing to the
+    database, and refresh() drops what other stations changed. """
+    def __init__(self, db):
+        RecipeStore.__init__(self)
+        self.db = db
+        self._all_names = None      # every name in the database, fetched on the first names()
+        self._loaded_all = False
+        # faulting recipes in changes the store, and happens on whatever thread reads it
+        self._fault_lock = threading.RLock()
+
+    def _fault(self, recipe_name):
+        """ Make sure the recipe is in the columns, returns False if it doesn't exist """
+        if recipe_name in self._rows:
+            return True
+        if self._loaded_all:
+            return False
+        with self._fault_lock:
+            if recipe_name in self._rows:
+                return True
+            recipe = self.db.get(recipe_name)
+            if recipe is None:
+                return False
+            RecipeStore.put(self, recipe_name, recipe)
+            return True
+
+    def load_all(self):
+        """ Fetch everything that isn't loaded yet, for the things that need the whole library """
+        if self._loaded_all:
+            return
+        with self._fault_lock:
+            for (name, recipe) in self.db.iter_all():
+                if name not in self._rows:
+                    RecipeStore.put(self, name, recipe)
+            self._loaded_all = True
+
+    def refresh(self, added, removed, modified):
+        """ Forget recipes changed in the database by someone else, they're fetched again when used """
+        with self._fault_lock:
+            for name in removed + modified + added:
+                if name in self._rows:
+                    RecipeStore.remove(self, name)
+            self._loaded_all = False
+            if self._all_names is not None:
+                for name in removed:
+                    i = bisect_left(self._all_names, name)
+                    if i < len(self._all_names) and self._all_names[i] == name:
+                        del self._all_names[i]
+                for name in added:
+                    i = bisect_left(self._all_names, name)
+                    if i == len(self._all_names) or self._all_names[i] != name:
+                        self._all_names.insert(i, name)
+
+    def names(self):
+        if self._all_names is None:
+            with self._fault_lock:
+                if self._all_names is None:
+                    self._all_names = self.db.names()
+        return self._all_names
+
+    def __len__(self):
+        return len(self.names())
+
+    def __contains__(self, recipe_name):
+        return self._fault(recipe_name)
+
+    def put(self, recipe_name, recipe):
+        with self._fault_lock:
+            RecipeStore.put(self, recipe_name, recipe)
+            if self._all_names is not None:
+                i = bisect_left(self._all_names, recipe_name)
+                if i == len(self._all_names) or self._all_names[i] != recipe_name:
+                    self._all_names.insert(i, recipe_name)
+
+    def remove(self, recipe_name):
+        """ Backend removes it from the database first, so this is only about what we have of it.
+        Returns True if it was loaded or in the name list. """
+        with self._fault_lock:
+            found = recipe_name in self._rows
+            if found:
+                RecipeStore.remove(self, recipe_name)
+            if self._all_names is not None:
+                i = bisect_left(self._all_names, recipe_name)
+                if i < len(self._all_names) and self._all_names[i] == recipe_name:
+                    del self._all_names[i]
+                    found = True
+            return found
+
+    def row(self, recipe_name):
+        self._fault(recipe_name)
+        return RecipeStore.row(self, recipe_name)
+
+    def get(self, recipe_name):
+        self._fault(recipe_name)
+        return RecipeStore.get(self, recipe_name)
+
+    def info(self, recipe_name):
+        self._fault(recipe_name)
+        return RecipeStore.info(self, recipe_name)
+
+    def total_flavor(self, recipe_name):
+        self._fault(recipe_name)
+        return RecipeStore.total_flavor(self, recipe_name)
+
+    def export_columns(self):
+        self.load_all()
+        return RecipeStore.export_columns(self)
+
+    def freeze(self):
+        self.load_all()
+        return RecipeStore.freeze(self)
+
+class DatabaseStorage(Storage):
+    """ Storage for a recipe database: changes are written through, one transaction per
+    update/remove, and reloading asks the database what changed since the generation we last saw """
+    database = True
+
+    def __init__(self, backend):
+        Storage.__init__(self, backend)
+        self.db = None
+        self.generation = None
+
+    def load(self, filename, progress, batch_size, snapshot):
+        be = self.be
+        if not os.path.exists(filename):
+            # don't create an empty database for a typo
+            raise IOError('%s not found'%filename)
+        start = time.perf_counter()
+        try:
+            db = RecipeDB(filename)
+            # the generation before anything else, so a change made in between is picked up again
+            self.generation = db.generation()
+            (be._nic_base, be._nic_strength) = db.config()
+        except sqlite3.Error as e:
+            raise IOError('%s: %s'%(filename, e))
+        self.db = db
+        be._store = LazyRecipeStore(db)
+        be.filename = filename
+        Stats.record('backend.open_db', time.perf_counter() - start)
+        yield len(be._store)
+
+    def _written(self, generation):
+        # our own write, nothing to reload for it unless another station wrote in between
+        with self.be._lock:
+            if generation == self.generation + 1:
+                self.generation = generation
+
+    def update(self, recipes):
+        be = self.be
+        # written through, in one transaction, before anything changes here
+        self._written(self.db.put(recipes))
+        with be._lock:
+            for r in recipes:
+                be._put_recipe(r, recipes[r])
+
+    def remove(self, recipe_names):
+        be = self.be
+        self._written(self.db.remove(recipe_names))
+        with be._lock:
+            for r in recipe_names:
+                if be._store.remove(r):
+                    be._bump_version(r)
+                    if be._search is not None:
+                        be._search.remove(r)
+
+    def freeze(self):
+        # nothing needed to reload
+        return (None, set())
+
+    def diff(self, new, frozen):
+        with self.be._lock:
+            generation = self.generation
+        return self.db.changes_since(generation)[:3]
+
+    def reload(self, filename, loaded, changes):
+        be = self.be
+        if filename != be.filename:
+            raise ValueError("can't reload %s from %s"%(be.filename, filename))
+        with be._lock:
+            (added, removed, modified, generation) = self.db.changes_since(self.generation)
+            # forget what changed, it's fetched again the next time it's used
+            be._store.refresh(added, removed, modified)
+            self.generation = generation
+            config = self.db.config()
+            if config != (be._nic_base, be._nic_strength):
+                (be._nic_base, be._nic_strength) = config
+                be._mix_cache.clear()
+            for name in added + removed + modified:
+                be._bump_version(name)
+        if be._search is not None:
+            for name in removed:
+                be._search.remove(name)
+            for name in added + modified:
+                recipe = be._store.get(name)
+                if recipe is not None:
+                    be._search.put(name, recipe)
+        return (added, removed, modified)
+
+    def save(self):
+        print("Backend.write_file: changes are saved as they're made")
+        return False
+
+def write_store(db_path, store, nic_base, nic_strength):
+    """ Replace everything in the database (created if needed) with the recipes in a RecipeStore,
+    see RecipeDB.replace_all """
+    db = RecipeDB(db_path)
+    try:
+        db.replace_all(store, nic_base, nic_strength)
+    finally:
+        db.close()
+
+def import_library(source, db_path, replace=False):
+    """ One-shot import of a json library (file or directory of shards) into a database.
+    Refuses to import into a database that already has recipes unless replace is set.
+    Returns the number of recipes imported. """
+    from Backend import Backend
+    be = Backend()
+    be.load_file(source, snapshot=False)
+    if not replace and os.path.exists(db_path):
+        db = RecipeDB(db_path)
+        try:
+            n = len(db.names())
+        finally:
+            db.close()
+        if n:
+            raise ValueError('%s already has %d recipes, use --replace to replace them'%(db_path, n))
+    write_store(db_path, be._store, be._nic_base, be._nic_strength)
+    return len(be._store)
+
+def add_arguments(parser):
+    parser.add_argument('source', help='recipe library json file or directory of shards')
+    parser.add_argument('database', help='SQLite database to create (or add to)')
+    parser.add_argument('--replace', action='store_true', help='replace the recipes already in the database')
+
+def main(args):
+    if not os.path.exists(args.source):
+        print('Error: recipe library %s not found'%args.source, file=sys.stderr)
+        return 1
+    try:
+        n = import_library(args.source, args.database, args.replace)
+    except (IOError, ValueError, sqlite3.Error) as e:
+        print('Error: %s'%e, file=sys.stderr)
+        return 1
+    print('Imported %d recipes into %s'%(n, args.database), file=sys.stderr)
+    return 0
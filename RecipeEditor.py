@@ -1,63 +1,51 @@
 from PyQt4 import QtCore, QtGui
-from PyQt4.QtCore import pyqtSignal, pyqtSlot, Qt
-from PyQt4.QtGui import QTableWidgetItem, QListWidgetItem, QColor, QMessageBox, QInputDialog
-from yacc_main_window import Ui_yacc_main_window
+from PyQt4.QtCore import pyqtSignal, pyqtSlot
+from PyQt4.QtGui import QMessageBox, QInputDialog, QKeySequence
 from recipe_builder_window import Ui_MainWindow
 from Backend import Backend
-import pdb
-
-# role constants for YQListWidgetItem
-RECIPE_ITEM_NAME   = 33
-RECIPE_ITEM_STAGED = 34
-RECIPE_ITEM_DATA   = 35
-
-class RecipeItem(QListWidgetItem):
-    """ Child class of QListWidgetItem, so that I can store the recipe name and staged status
-    directly in RecipeEditor.recipe_list_items
-    I'm also just gonna use these instance variables directly without dealing with roles and the data()
-    because why wrap basic calls in get/set methods? This isn't CS class, I can do what I want!
-    """
-    def __init__(self, recipe_name='', staged=False, recipe_data=None):
-        QListWidgetItem.__init__(self, recipe_name)
-        self.recipe_name = recipe_name
-        self.staged = staged
-        self.recipe_data = recipe_data
-        self.setText(recipe_name)
-
-    def stage(self, stage=True, recipe_data=None):
-        if stage:
-            self.staged = True
-            self.recipe_data = recipe_data
-            self.setText(self.recipe_name + ' (*)')
-        else:
-            self.staged = False
-            self.recipe_data = None
-            self.setText(self.recipe_name)
+from RecipeModels import RecipeListModel, RecipeTableModel
+from RecipeHistory import CellEdit, AddRecipe, RevertRecipe, CommitRecipes
+from Workers import TaskRunner
+from Stats import timer
+
+# how long to wait after typing in the search box before filtering the recipes
+FILTER_DELAY_MS = 150
+
+def write_backend(task, be):
+    # TaskRunner worker, Backend.write_file is fine with the recipes changing while it writes
+    return be.write_file()
 
 class RecipeEditor(QtGui.QMainWindow):
     signal_exit = pyqtSignal(str)
     signal_backend_updated = pyqtSignal()
 
+    @timer('editor.open')
     def __init__(self, parent=None, backend=None):
         QtGui.QWidget.__init__(self, parent)
         self.ui = Ui_MainWindow()
         self.ui.setupUi(self)
         self.updating_internal = False
-        self.recipes_to_commit = {}
+        self.replaying = False
         self.current_recipe = None
-        self.error_cells = []
 
         # store backend from Main
         self.be = backend if backend is not None else Backend()
 
-        # init recipe table
-        self.ui.recipe_table.setColumnCount(2)
-        self.ui.recipe_table.setRowCount(0)
-        self.ui.recipe_table.setHorizontalHeaderLabels(['Flavor', 'Strength (%)'])
+        # models. list_model also holds the staged recipes, see stage_recipe
+        self.list_model = RecipeListModel(self, self.be.get_recipes())
+        self.ui.recipe_list.setModel(self.list_model)
+        # pick up whatever was staged when the editor was closed (or the program died), see Backend.attach_journal
+        for (recipe_name, recipe_data) in sorted(self.be.get_journal_staged().items()):
+            self.list_model.insert(recipe_name)
+            self.list_model.stage(recipe_name, recipe_data)
+        self.table_model = RecipeTableModel(self)
+        self.ui.recipe_table.setModel(self.table_model)
 
         # signals/slots
-        self.ui.recipe_list.currentItemChanged.connect(self.handle_rlist_item_change)
-        self.ui.recipe_table.cellChanged.connect(self.handle_rtable_cell_change)
+        self.ui.recipe_list.selectionModel().currentChanged.connect(self.handle_rlist_current_change)
+        self.table_model.cell_edited.connect(self.handle_rtable_cell_change)
+        self.table_model.cell_changed.connect(self.handle_rtable_cell_edit)
+        self.list_model.stage_changed.connect(self.handle_stage_change)
         self.ui.revertrecipe_button.clicked.connect(self.handle_revert_click)
         self.ui.save_button.clicked.connect(self.handle_save_click)
         self.ui.update_button.clicked.connect(self.update_backend)
@@ -67,35 +55,96 @@ class RecipeEditor(QtGui.QMainWindow):
         self.ui.addflavor_button.clicked.connect(self.handle_addflavor_click)
         self.ui.delflavor_button.clicked.connect(self.handle_delflavor_click)
 
-        # initialize recipe list
-        self.recipe_list_items = {}
-        for recipe_name in self.be.get_recipes():
-            self.add_recipe_to_list(recipe_name)
-        self.ui.recipe_list.setCurrentRow(0)
+        self.filter_timer = QtCore.QTimer(self)
+        self.filter_timer.setSingleShot(True)
+        self.filter_timer.setInterval(FILTER_DELAY_MS)
+        self.filter_timer.timeout.connect(self.apply_recipe_filter)
+        self.ui.filter_box.textChanged.connect(self.filter_timer.start)
+
+        # saving happens in the background
+        self.runner = TaskRunner(self)
+        self.runner.finished.connect(self.handle_save_finished)
+        self.runner.failed.connect(self.handle_save_failed)
+
+        # undo/redo, see RecipeHistory
+        self.undo_stack = QtGui.QUndoStack(self)
+        undo_action = self.undo_stack.createUndoAction(self, 'Undo')
+        undo_action.setShortcut(QKeySequence.Undo)
+        redo_action = self.undo_stack.createRedoAction(self, 'Redo')
+        redo_action.setShortcut(QKeySequence.Redo)
+        toolbar = self.addToolBar('History')
+        toolbar.addAction(undo_action)
+        toolbar.addAction(redo_action)
+
+        self.select_recipe_row(0)
+
+    def select_recipe_row(self, row):
+        self.list_model.fetch_to(row)
+        index = self.list_model.index(row)
+        if index.isValid():
+            self.ui.recipe_list.setCurrentIndex(index)
+            self.ui.recipe_list.scrollTo(index)
+
+    @timer('editor.filter')
+    def apply_recipe_filter(self):
+        """ Show only the recipes matching the search box in recipe_list. Staged recipes are
+        always shown, so work in progress doesn't get lost. """
+        query = str(self.ui.filter_box.text()).strip()
+        # Main builds the search index in the background, see Backend.quick_search
+        names = self.be.quick_search(query)
+        if self.list_model.staged:
+            names = sorted(set(names).union(self.list_model.staged))
+        self.list_model.set_names(names)
+
+        row = self.list_model.row_of(self.current_recipe) if self.current_recipe is not None else -1
+        if row != -1:
+            self.updating_internal = True
+            self.select_recipe_row(row)
+            self.updating_internal = False
+
+    def show_recipe(self, recipe_name, reload=False):
+        """ Select a recipe and show it in the table, if it isn't already. reload loads it again even
+        if it's the one being shown. None selects the first recipe. """
+        if recipe_name is None:
+            self.select_recipe_row(0)
+            return
+        if recipe_name == self.current_recipe:
+            if reload:
+                self.load_recipe(recipe_name)
+            return
+        row = self.list_model.row_of(recipe_name)
+        if row != -1:
+            # loads it through handle_rlist_current_change
+            self.select_recipe_row(row)
+        if self.current_recipe != recipe_name:
+            # filtered out of the list
+            self.load_recipe(recipe_name)
 
-    def add_recipe_to_list(self, recipe_name, stage=False, recipe_data=None):
-        item = RecipeItem(recipe_name, stage, recipe_data)
-        self.recipe_list_items[recipe_name] = item
-        self.ui.recipe_list.addItem(item)
+    def replay_cell(self, recipe_name, key, col, text):
+        """ Set a cell of a recipe's table for undo/redo. The row is the one of flavor key. """
+        self.show_recipe(recipe_name)
+        row = self.table_model.row_of_key(key)
+        if row == -1:
+            print('RecipeEditor.replay_cell: flavor %s not in recipe %s!'%(key, recipe_name))
+            return
+        self.replaying = True
+        self.table_model.set_cell(row, col, text)
+        self.replaying = False
+        self.ui.recipe_table.setCurrentIndex(self.table_model.index(row, col))
 
     def get_recipe_data(self, recipe_name):
-        try:
-            if self.recipe_list_items[recipe_name].staged:
-                return self.recipe_list_items[recipe_name].recipe_data
-            else:
-                return self.be.get_recipe(recipe_name)
-        except KeyError:
-            print('RecipeEditor.get_recipe_data: KeyError caught!')
+        if self.list_model.is_staged(recipe_name):
+            return self.list_model.staged[recipe_name]
+        recipe = self.be.get_recipe(recipe_name)
+        if recipe is None:
+            print('RecipeEditor.get_recipe_data: recipe %s not found!'%recipe_name)
             return {}
+        return recipe
 
     def get_staged_recipes_data(self):
-        ret = {}
-        for (name, item) in self.recipe_list_items.items():
-            if item.staged:
-                ret[name] = item.recipe_data
-
-        return ret
+        return dict(self.list_model.staged)
 
+    @timer('editor.load_recipe')
     def load_recipe(self, recipe_name=None, create_new=False):
         if self.updating_internal or (recipe_name is None and not create_new):
             return
@@ -103,43 +152,55 @@ class RecipeEditor(QtGui.QMainWindow):
 
         self.current_recipe = recipe_name if recipe_name is not None else 'New Recipe'
 
+        # changes are tracked against what the backend has, nothing for a new recipe
+        original = self.be.get_recipe(self.current_recipe) or {}
         if create_new:
-            recipe = {'New Flavor 1':0}
-            #self.stage_recipe(recipe_name, recipe)
-            self.add_recipe_to_list(recipe_name, True, recipe)
-            self.ui.recipe_list.setCurrentItem(self.recipe_list_items[recipe_name])
+            self.table_model.set_recipe({'New Flavor 1':0}, original)
+            self.list_model.insert(self.current_recipe)
+            self.stage_recipe()
+            self.select_recipe_row(self.list_model.row_of(self.current_recipe))
         else:
-            recipe = self.get_recipe_data(recipe_name)
-        
-        self.ui.recipe_table.clearContents()
-        self.ui.recipe_table.setRowCount(len(recipe))
-
-        for (i, flavor) in enumerate(sorted(recipe)):
-            self.ui.recipe_table.setItem(i, 0, QTableWidgetItem(flavor))
-            self.ui.recipe_table.setItem(i, 1, QTableWidgetItem('%.1f'%(recipe[flavor]*100.0)))
+            self.table_model.set_recipe(self.get_recipe_data(recipe_name), original)
 
         self.ui.recipe_table.resizeColumnToContents(0)
         self.updating_internal = False
-        self.error_cells = []
 
-    def update_backend(self):
-        self.be.update_recipes(self.get_staged_recipes_data())
-        
-        # unstage all staged recipes
-        for (r, item) in self.recipe_list_items.items():
-            item.stage(False)
+    def handle_backend_reloaded(self, added, removed, modified):
+        """ Called by YaccMain when the recipe file changed on disk and the backend was updated.
+        Only the affected rows are touched, and recipes with staged changes are left alone. """
+        if str(self.ui.filter_box.text()).strip():
+            # added recipes might not match the filter, just run it again
+            self.apply_recipe_filter()
+        else:
+            self.updating_internal = True
+            for recipe_name in removed:
+                if not self.list_model.is_staged(recipe_name):
+                    self.list_model.remove(recipe_name)
+            for recipe_name in added:
+                self.list_model.insert(recipe_name)
+            self.updating_internal = False
 
-        self.signal_backend_updated.emit()
+        # reload the table if the recipe being shown went away or changed underneath us
+        current = self.list_model.name_at(self.ui.recipe_list.currentIndex().row())
+        if current is not None and not self.list_model.is_staged(current) and \
+                (current != self.current_recipe or current in modified):
+            self.load_recipe(current)
 
-    def compile_current_recipe(self):
-        recipe = {}
-        nrows = self.ui.recipe_table.rowCount()
-        for r in range(nrows):
-            flavor = self.ui.recipe_table.item(r, 0).text()
-            value =  float(self.ui.recipe_table.item(r, 1).text()) / 100.0
-            recipe[flavor] = value
+    @timer('editor.commit')
+    def update_backend(self):
+        # only send the recipes that really differ from the backend's, e.g. not ones edited back
+        changed = {}
+        for (name, recipe) in self.get_staged_recipes_data().items():
+            if recipe != self.be.get_recipe(name):
+                changed[name] = dict(recipe)
+        if changed:
+            # the command does the commit
+            self.undo_stack.push(CommitRecipes(self, changed))
+        else:
+            self.list_model.unstage_all()
 
-        return recipe
+    def compile_current_recipe(self):
+        return self.table_model.recipe()
 
     def stage_recipe(self, recipe_name=None, recipe_data=None):
         if recipe_name is None:
@@ -147,69 +208,58 @@ class RecipeEditor(QtGui.QMainWindow):
         if recipe_data is None:
             recipe_data = self.compile_current_recipe()
 
-        item = self.recipe_list_items[recipe_name]
-        item.stage(True, recipe_data)
+        self.list_model.stage(recipe_name, recipe_data)
 
     def unstage_recipe(self, recipe_name=None):
         if recipe_name is None:
             recipe_name = self.current_recipe
 
-        item = self.recipe_list_items[recipe_name]
-        item.stage(False)
+        self.list_model.unstage(recipe_name)
 
     def get_recipe_row(self, recipe_name):
-        try:
-            return self.ui.recipe_list.row(self.recipe_list_items[recipe_name])
-        except KeyError:
-            return None
-
-    @pyqtSlot(QListWidgetItem, QListWidgetItem)
-    def handle_rlist_item_change(self, current, previous):
-        if current is not None:
-            recipe_name = current.recipe_name
+        row = self.list_model.row_of(recipe_name)
+        return row if row != -1 else None
+
+    @pyqtSlot(QtCore.QModelIndex, QtCore.QModelIndex)
+    def handle_rlist_current_change(self, current, previous):
+        recipe_name = self.list_model.name_at(current.row())
+        if recipe_name is not None:
             self.load_recipe(recipe_name)
 
-    @pyqtSlot(int, int)
-    def handle_rtable_cell_change(self, row, col):
+    @pyqtSlot(str)
+    def handle_stage_change(self, recipe_name):
+        # every staged edit goes to the journal, which is just an append
+        self.be.log_staged(recipe_name, self.list_model.staged.get(recipe_name))
+
+    @pyqtSlot(str, str, int, str, str)
+    def handle_rtable_cell_edit(self, key_before, key_after, col, old_text, new_text):
+        if self.updating_internal or self.replaying or old_text == new_text:
+            return
+        self.undo_stack.push(CellEdit(self, self.current_recipe, col, key_before, key_after, old_text, new_text))
+
+    @pyqtSlot(int, int, bool)
+    def handle_rtable_cell_change(self, row, col, valid):
         if self.updating_internal:
             # bail if we're loading a recipe
             return
 
         if col == 0:
-            # TODO actually stage flavor name changes
             self.ui.recipe_table.resizeColumnToContents(0)
-            return
-
-        item = self.ui.recipe_table.item(row, col)
-        value = item.text()
-        try:
-            nval = float(value)
-            if nval < 0:
-                raise ValueError
 
-            # set updating_internal while doing this to prevent the color change from triggering
-            # handle_rable_cell_change (well, it still gets triggered, but returns before doing anything)
-            self.updating_internal = True
-            item.setBackgroundColor(QColor(0xffffff))
-            self.updating_internal = False
-            if (row, col) in self.error_cells:
-                self.error_cells.remove((row, col))
-
-            # stage recipe if no errors
-            if len(self.error_cells) == 0:
-                self.stage_recipe()
-        except ValueError:
-            self.updating_internal = True
-            item.setBackgroundColor(QColor(255, 102, 102))
-            self.updating_internal = False
-            if (row, col) not in self.error_cells:
-                self.error_cells.append((row, col))
+        # The model has already applied the edit to its working copy and marked/unmarked the cell.
+        # Stage the recipe if there are no errors left and it's actually different from the backend's.
+        if not valid:
             self.unstage_recipe()
+        elif not self.table_model.error_cells:
+            if self.table_model.is_modified():
+                self.stage_recipe()
+            else:
+                self.unstage_recipe()
 
     @pyqtSlot(bool)
     def handle_revert_click(self):
-        self.unstage_recipe()
-        self.load_recipe(self.current_recipe)
+        if self.current_recipe is not None:
+            self.undo_stack.push(RevertRecipe(self, self.current_recipe))
 
     @pyqtSlot(bool)
     def handle_save_click(self):
@@ -218,17 +268,30 @@ class RecipeEditor(QtGui.QMainWindow):
 
         if reply == QMessageBox.Yes:
             self.update_backend()
-            self.be.write_file()
+            self.ui.save_button.setEnabled(False)
+            self.statusBar().showMessage('Saving...')
+            self.runner.start('save', write_backend, self.be)
+
+    @pyqtSlot(str, object)
+    def handle_save_finished(self, kind, written):
+        self.ui.save_button.setEnabled(True)
+        self.statusBar().showMessage('Saved' if written else 'No changes to save', 5000)
+
+    @pyqtSlot(str, str)
+    def handle_save_failed(self, kind, message):
+        self.ui.save_button.setEnabled(True)
+        self.statusBar().clearMessage()
+        QMessageBox.warning(self, 'Save Failed', 'Unable to write JSON data file: %s'%message)
 
     @pyqtSlot(bool)
     def handle_addrecipe_click(self):
         (recipe_name, ok) = QInputDialog.getText(self, 'New Recipe', 'Enter Recipe Name:')
         if ok:
-            self.load_recipe(recipe_name, create_new=True)
+            self.undo_stack.push(AddRecipe(self, str(recipe_name)))
 
     @pyqtSlot(bool)
     def handle_delrecipe_click(self):
-        recipe_name = self.recipe_name_staged()[0]
+        recipe_name = self.current_recipe
         reply = QMessageBox.question(self, 'Delete Recipe?', 'Really Delete the recipe "%s"?'%recipe_name,
                 QMessageBox.Yes | QMessageBox.No)
 
@@ -0,0 +1,99 @@
+# Undo/redo history for the recipe editor, as commands on a QUndoStack. Every command only holds
+# what its own change touched: a cell edit is the flavor name and the cell's text before and after,
+# adding or reverting a recipe is that one recipe, and a commit is the recipes it sent to the backend
+# and what the backend had for them before. Nothing ever copies the staged recipes or the library,
+# so the history's memory grows with the size of the edits, and undo/redo cost what the change did.
+#
+# The commands go through RecipeEditor to show the recipe they belong to and apply themselves, with
+# editor.replaying set so the editor doesn't record the replayed edits as new ones.
+
+from PyQt4.QtGui import QUndoCommand
+
+class CellEdit(QUndoCommand):
+    """ One edit of a recipe_table cell. It's recorded after the view has already made it, so the
+    first redo (the one QUndoStack.push does) does nothing. """
+    def __init__(self, editor, recipe_name, col, key_before, key_after, old_text, new_text):
+        QUndoCommand.__init__(self, 'Edit %s'%recipe_name)
+        self.editor = editor
+        self.recipe_name = recipe_name
+        self.col = col
+        (self.key_before, self.key_after) = (key_before, key_after)
+        (self.old_text, self.new_text) = (old_text, new_text)
+        self.applied = True
+
+    def redo(self):
+        if self.applied:
+            self.applied = False
+            return
+        self.editor.replay_cell(self.recipe_name, self.key_before, self.col, self.new_text)
+
+    def undo(self):
+        self.editor.replay_cell(self.recipe_name, self.key_after, self.col, self.old_text)
+
+class AddRecipe(QUndoCommand):
+    def __init__(self, editor, recipe_name):
+        QUndoCommand.__init__(self, 'Add %s'%recipe_name)
+        self.editor = editor
+        self.recipe_name = recipe_name
+        self.previous = editor.current_recipe
+        # in case a recipe by that name was already being edited
+        self.staged_before = editor.list_model.staged.get(recipe_name)
+
+    def redo(self):
+        self.editor.load_recipe(self.recipe_name, create_new=True)
+
+    def undo(self):
+        editor = self.editor
+        if self.staged_before is not None:
+            editor.list_model.stage(self.recipe_name, self.staged_before)
+        else:
+            editor.list_model.unstage(self.recipe_name)
+            if editor.be.get_recipe(self.recipe_name) is None:
+                editor.list_model.remove(self.recipe_name)
+        editor.show_recipe(self.previous, reload=True)
+
+class RevertRecipe(QUndoCommand):
+    def __init__(self, editor, recipe_name):
+        QUndoCommand.__init__(self, 'Revert %s'%recipe_name)
+        self.editor = editor
+        self.recipe_name = recipe_name
+        staged = editor.list_model.staged.get(recipe_name)
+        # the staged dict of the recipe being shown is the table's working copy, which keeps changing
+        self.staged_before = dict(staged) if staged is not None else None
+
+    def redo(self):
+        self.editor.list_model.unstage(self.recipe_name)
+        self.editor.show_recipe(self.recipe_name, reload=True)
+
+    def undo(self):
+        if self.staged_before is not None:
+            self.editor.list_model.stage(self.recipe_name, dict(self.staged_before))
+        self.editor.show_recipe(self.recipe_name, reload=True)
+
+class CommitRecipes(QUndoCommand):
+    """ Sending the staged recipes to the backend. changed is name -> recipe being sent, with only
+    the recipes that really differ from the backend's. """
+    def __init__(self, editor, changed):
+        QUndoCommand.__init__(self, 'Update %d recipe%s'%(len(changed), '' if len(changed) == 1 else 's'))
+        self.editor = editor
+        self.changed = changed
+        self.before = {name: editor.be.get_recipe(name) for name in changed}
+
+    def redo(self):
+        editor = self.editor
+        editor.be.update_recipes(self.changed)
+        editor.list_model.unstage_all()
+        if editor.current_recipe in self.changed:
+            editor.show_recipe(editor.current_recipe, reload=True)
+        editor.signal_backend_updated.emit()
+
+    def undo(self):
+        editor = self.editor
+        editor.be.update_recipes({name: r for (name, r) in self.before.items() if r is not None})
+        editor.be.remove_recipes([name for (name, r) in self.before.items() if r is None])
+        # back to staged, so the changes can be committed again or edited some more
+        for (name, recipe) in self.changed.items():
+            editor.list_model.stage(name, dict(recipe))
+        if editor.current_recipe in self.changed:
+            editor.show_recipe(editor.current_recipe, reload=True)
+        editor.signal_backend_updated.emit()
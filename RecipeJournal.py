@@ -0,0 +1,145 @@
+# Write-ahead log of recipe changes, so nothing is lost between saves if the program (or the machine)
+# dies. The journal lives next to the json file (vaperecipes.json -> vaperecipes.json.wal) and is
+# JSON lines, one record per change:
+#   {"op": "put", "recipe": name, "data": {flavor: fraction, ...}}    committed to the backend
+#   {"op": "remove", "recipe": name}
+#   {"op": "stage", "recipe": name, "data": {...} or null}            staged in the editor, null = unstaged
+# Records hold the whole recipe rather than what changed in it, so replaying one twice does no harm:
+# a crash while compacting, after the json was written but before the journal was cut, just replays
+# a few changes that are already in the json.
+#
+# Every append is flushed and fsync'd, and that's all saving a change costs. Rewriting the whole
+# library only happens when Backend.compact_journal writes it out (in a background thread) and then
+# cuts the journal down to the records that came after, plus what's still staged.
+# A torn last line (a crash in the middle of an append) is dropped when the journal is opened.
+
+import json, os, threading
+
+JOURNAL_SUFFIX = '.wal'
+
+def journal_path(json_path):
+    return json_path + JOURNAL_SUFFIX
+
+def _record(op, name, data=None):
+    rec = {'op': op, 'recipe': name}
+    if op != 'remove':
+        rec['data'] = data
+    return (json.dumps(rec, sort_keys=True, separators=(',', ':')) + '\n').encode('utf-8')
+
+class RecipeJournal(object):
+    def __init__(self, path):
+        self.path = path
+        self._fp = None
+        # Positions handed out by tell() count every byte ever appended, so they stay valid after a
+        # cut: the file is the staged records (_prefix bytes) followed by everything from _tail_pos on.
+        self._pos = 0
+        self._tail_pos = 0
+        self._prefix = 0
+        # appends come from the GUI thread, cut() from the compaction thread
+        self._lock = threading.Lock()
+        # name -> stage record of what's staged now, so cutting the journal doesn't lose it
+        self._staged = {}
+
+    def open(self):
+        """ Read what's in the journal from last time and open it for appending.
+        Returns the committed changes as a list of (name, recipe), recipe is None for removed ones. """
+        changes = []
+        good = 0
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as fp:
+                for line in fp:
+                    if not line.endswith(b'\n'):
+                        print('Warning: dropping incomplete record at the end of %s'%self.path)
+                        break
+                    good += len(line)
+                    try:
+                        rec = json.loads(line.decode('utf-8'))
+                        (op, name) = (rec['op'], rec['recipe'])
+                    except (ValueError, KeyError, TypeError):
+                        print('Warning: skipping damaged record in %s'%self.path)
+                        continue
+                    if op == 'put':
+                        changes.append((name, rec['data']))
+                    elif op == 'remove':
+                        changes.append((name, None))
+                    elif op == 'stage':
+                        if rec.get('data') is None:
+                            self._staged.pop(name, None)
+                        else:
+                            self._staged[name] = line
+
+        self._fp = open(self.path, 'ab')
+        if self._fp.tell() != good:
+            self._fp.truncate(good)
+            self._fp.seek(good)
+        (self._pos, self._tail_pos, self._prefix) = (good, 0, 0)
+        return changes
+
+    def close(self):
+        with self._lock:
+            if self._fp is not None:
+                self._fp.close()
+                self._fp = None
+
+    def staged(self):
+        """ Recipes staged in the editor, name -> recipe """
+        with self._lock:
+            return {name: json.loads(line.decode('utf-8'))['data'] for (name, line) in self._staged.items()}
+
+    def size(self):
+        """ Bytes logged since the journal was last cut """
+        return self._pos - self._tail_pos
+
+    def tell(self):
+        """ Where the journal is now, for cut() """
+        with self._lock:
+            return self._pos
+
+    def _append(self, data):
+        with self._lock:
+            self._fp.write(data)
+            self._fp.flush()
+            os.fsync(self._fp.fileno())
+            self._pos += len(data)
+
+    def log_put(self, recipes):
+        self._append(b''.join(_record('put', name, recipe) for (name, recipe) in recipes.items()))
+
+    def log_remove(self, names):
+        self._append(b''.join(_record('remove', name) for name in names))
+
+    def log_stage(self, name, recipe):
+        """ recipe is None when it's unstaged """
+        data = _record('stage', name, recipe)
+        with self._lock:
+            if recipe is None:
+                self._staged.pop(name, None)
+            else:
+                self._staged[name] = data
+        self._append(data)
+
+    def cut(self, mark):
+        """ Drop the records before mark (a tell()), which are in the json file now. The records
+        after it and everything that's staged are kept, in a new file renamed over the old one. """
+        with self._lock:
+            if mark <= self._tail_pos:
+                return
+            # staged records first, the tail has the same or newer versions of them
+            prefix = b''.join(self._staged.values())
+            tmp_path = self.path + '.tmp'
+            try:
+                with open(self.path, 'rb') as fp:
+                    fp.seek(self._prefix + mark - self._tail_pos)
+                    tail = fp.read()
+                with open(tmp_path, 'wb') as fp:
+                    fp.write(prefix + tail)
+                    fp.flush()
+                    os.fsync(fp.fileno())
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                # not fatal, the records just get replayed again (see the top of the file)
+                print('Warning: unable to cut journal %s: %s'%(self.path, e))
+                return
+            self._fp.close()
+            self._fp = open(self.path, 'ab')
+            (self._tail_pos, self._prefix) = (mark, len(prefix))
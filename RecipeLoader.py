@@ -0,0 +1,143 @@
+# Streaming reader for recipe json files. Instead of json.load-ing the whole file into one
+# giant dict, this walks the top level (and the _recipes object) incrementally and hands out
+# one recipe at a time, so Backend can validate and store each recipe as soon as it's parsed.
+
+import codecs, json, os, re
+
+# how much of the file to read at a time
+CHUNK_SIZE = 1 << 16
+
+_whitespace = re.compile(r'[ \t\n\r]*')
+_decoder = json.JSONDecoder()
+
+class JsonStream(object):
+    """ Minimal pull parser over a binary file object containing utf-8 JSON.
+    Only the structure of objects is walked by hand (members()); everything else is decoded
+    with the stdlib decoder one value at a time (value()), so only one value plus one chunk
+    of the file is ever held in memory.
+    """
+    def __init__(self, fp, chunk_size=CHUNK_SIZE, progress=None, hasher=None):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.progress = progress
+        self.hasher = hasher
+        try:
+            self.total_bytes = os.fstat(fp.fileno()).st_size
+        except (AttributeError, OSError):
+            self.total_bytes = None
+        self.bytes_read = 0
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _read(self):
+        """ Append the next chunk of the file to the buffer, dropping the part that's already
+        been parsed. Returns False at the end of the file. """
+        if self.eof:
+            return False
+        data = self.fp.read(self.chunk_size)
+        self.buf = self.buf[self.pos:]
+        self.pos = 0
+        if not data:
+            self.eof = True
+            self.buf += self.utf8.decode(b'', final=True)
+            return False
+        self.bytes_read += len(data)
+        self.buf += self.utf8.decode(data)
+        if self.hasher is not None:
+            self.hasher.update(data)
+        if self.progress is not None:
+            self.progress(self.bytes_read, self.total_bytes)
+        return True
+
+    def peek(self):
+        """ Skip whitespace and return the next character, or '' at the end of the file """
+        while True:
+            self.pos = _whitespace.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._read():
+                return ''
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError('Expected %r at byte %d'%(char, self.bytes_read))
+        self.pos += 1
+
+    def value(self):
+        """ Decode and return the next complete JSON value """
+        self.peek()
+        while True:
+            try:
+                (val, end) = _decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                # probably cut off at the end of the buffer, get more and try again
+                if self._read():
+                    continue
+                raise
+            # a number (or true/false/null) right at the end of the buffer might keep going
+            # in the next chunk, so only trust it once there's something after it
+            if end == len(self.buf) and self._read():
+                continue
+            self.pos = end
+            return val
+
+    def members(self):
+        """ Iterate over the keys of the object starting at the current position.
+        After each key is yielded, the caller must consume its value (with value(), or by
+        iterating members() of a nested object) before asking for the next key. """
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            if type(key) is not str:
+                raise ValueError('Object key is not a string at byte %d'%self.bytes_read)
+            self.expect(':')
+            yield key
+            char = self.peek()
+            self.pos += 1
+            if char == '}':
+                return
+            if char != ',':
+                raise ValueError('Expected "," or "}" at byte %d'%self.bytes_read)
+
+def iter_recipe_file(filename, progress=None, chunk_size=CHUNK_SIZE, hasher=None):
+    """ Stream the contents of a recipe json file. Yields tuples of
+        ('config', None, config_dict) for the _config section
+        ('recipe', recipe_name, flavors) for every recipe, exactly as it appears in the file
+    Either layout Backend understands works: recipes inside a _recipes object, or the whole file
+    being a dict of recipes. Other top-level keys are only taken as recipes if there's no _recipes,
+    so they're held back until the end of the file (only the second layout loses the streaming).
+    progress, if given, is called as progress(bytes_read, total_bytes) after every chunk.
+    hasher, if given, is a hashlib object that gets updated with the raw file contents.
+    Raises ValueError if the file isn't valid JSON.
+    """
+    with open(filename, 'rb') as fp:
+        js = JsonStream(fp, chunk_size, progress, hasher)
+        has_recipes = False
+        others = []
+        for key in js.members():
+            if key == '_recipes':
+                has_recipes = True
+                # anything else at the top level isn't a recipe after all
+                del others[:]
+                if js.peek() != '{':
+                    js.value()
+                    print("Error: recipes is not type 'dict'!")
+                    continue
+                for recipe_name in js.members():
+                    yield ('recipe', recipe_name, js.value())
+            elif key == '_config':
+                yield ('config', None, js.value())
+            elif has_recipes:
+                js.value()
+            else:
+                others.append((key, js.value()))
+
+        if js.peek() != '':
+            raise ValueError('Extra data after the end of %s'%filename)
+        for (key, value) in others:
+            yield ('recipe', key, value)
@@ -0,0 +1,72 @@
+# Sparse recipe x flavor matrix of the whole library, for questions about lots of orders at once,
+# like how much of each flavor a day's orders need. It's kept in CSR form (indptr/indices/data, the
+# same layout as scipy.sparse.csr_matrix, but only needing numpy) and built straight from
+# RecipeStore's columns: row i is recipe names[i], column j is flavor flavors[j], and the values
+# are the fractions. The per-flavor totals for a set of orders are then one product with the
+# transposed matrix (rmatvec) of a vector holding how many mL of each recipe are being made.
+# The matrix is a copy, Backend.get_matrix makes a new one after the recipes change.
+
+import numpy as np
+
+class RecipeMatrix(object):
+    def __init__(self, store):
+        (offsets, ids, fracs, totals) = store.columns()
+        offsets = np.frombuffer(offsets, dtype=np.int64)
+        self.names = list(store.names())
+        self.flavors = list(store.vocab)
+
+        # rows in name order, skipping the store's dead rows
+        n = len(self.names)
+        self.store_rows = np.fromiter((store.row(name) for name in self.names), dtype=np.intp, count=n)
+        starts = offsets[self.store_rows]
+        lengths = offsets[self.store_rows + 1] - starts
+        self.indptr = np.zeros(n + 1, dtype=np.intp)
+        np.cumsum(lengths, out=self.indptr[1:])
+        src = np.repeat(starts - self.indptr[:-1], lengths) + np.arange(self.indptr[-1])
+        # fancy indexing copies, so nothing here keeps the store's arrays locked
+        self.indices = np.frombuffer(ids, dtype=np.int64)[src]
+        self.data = np.frombuffer(fracs, dtype=np.float64)[src]
+        self.totals = np.frombuffer(totals, dtype=np.float64)[self.store_rows]
+        self._entry_rows = np.repeat(np.arange(n), lengths)
+
+        # store row -> matrix row, -1 for dead rows
+        self.row_of_store_row = np.full(len(offsets) - 1, -1, dtype=np.intp)
+        self.row_of_store_row[self.store_rows] = np.arange(n)
+        self._rows = None
+
+    @property
+    def shape(self):
+        return (len(self.names), len(self.flavors))
+
+    @property
+    def nnz(self):
+        return len(self.data)
+
+    def row(self, recipe_name):
+        """ Matrix row of a recipe, or None """
+        if self._rows is None:
+            self._rows = {name: i for (i, name) in enumerate(self.names)}
+        return self._rows.get(recipe_name)
+
+    def matvec(self, x):
+        """ M @ x: x has a value per flavor (e.g. price per mL), the result has one per recipe """
+        x = np.asarray(x, dtype=float)
+        return np.bincount(self._entry_rows, weights=self.data * x[self.indices], minlength=len(self.names))
+
+    def rmatvec(self, y):
+        """ M.T @ y: y has a value per recipe (e.g. mL being made), the result has one per flavor """
+        y = np.asarray(y, dtype=float)
+        return np.bincount(self.indices, weights=self.data * y[self._entry_rows], minlength=len(self.flavors))
+
+    def toarray(self, rows=None):
+        """ Dense copy of the matrix, or of just the given rows """
+        if rows is None:
+            rows = np.arange(len(self.names))
+        rows = np.asarray(rows, dtype=np.intp)
+        starts = self.indptr[rows]
+        lengths = self.indptr[rows + 1] - starts
+        owner = np.repeat(np.arange(len(rows)), lengths)
+        src = np.repeat(starts, lengths) + (np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths))
+        dense = np.zeros((len(rows), len(self.flavors)))
+        dense[owner, self.indices[src]] = self.data[src]
+        return dense
@@ -0,0 +1,267 @@
+# Qt item models for the recipe widgets (recipe_box in the main window, recipe_list and
+# recipe_table in the editor). They read straight from Backend's data and the editor's staged
+# recipes instead of allocating a widget item per recipe or per flavor, and RecipeListModel hands
+# its rows to the view in batches through canFetchMore/fetchMore, so filling a view with a huge
+# library only costs what has actually been scrolled into view.
+
+from bisect import bisect_left
+from PyQt4 import QtCore
+from PyQt4.QtCore import Qt, QModelIndex, pyqtSignal
+from PyQt4.QtGui import QColor
+
+# how many rows RecipeListModel makes visible per fetchMore
+FETCH_BATCH = 256
+
+# data role for the bare recipe name (DisplayRole has the staged marker on it)
+RECIPE_NAME_ROLE = Qt.UserRole
+
+ERROR_COLOR = QColor(255, 102, 102)
+
+class RecipeListModel(QtCore.QAbstractListModel):
+    """ Sorted list of recipe names. Recipes can be staged (changed in the editor but not sent to
+    the backend yet): the model keeps their staged data, and shows them with a (*) after the name.
+    stage_changed(name) is emitted whenever a recipe is staged or unstaged.
+    """
+    stage_changed = pyqtSignal(str)
+
+    def __init__(self, parent=None, names=()):
+        QtCore.QAbstractListModel.__init__(self, parent)
+        self.names = []
+        self.fetched = 0
+        self.staged = {}
+        self.set_names(names)
+
+    def set_names(self, names):
+        """ Replace the whole list. names must be sorted. """
+        self.beginResetModel()
+        self.names = list(names)
+        # always have the first batch ready, QComboBox doesn't ask for more until its popup scrolls
+        self.fetched = min(FETCH_BATCH, len(self.names))
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self.fetched
+
+    def canFetchMore(self, parent):
+        return not parent.isValid() and self.fetched < len(self.names)
+
+    def fetchMore(self, parent):
+        count = min(FETCH_BATCH, len(self.names) - self.fetched)
+        if parent.isValid() or count <= 0:
+            return
+        self.beginInsertRows(QModelIndex(), self.fetched, self.fetched + count - 1)
+        self.fetched += count
+        self.endInsertRows()
+
+    def fetch_to(self, row):
+        """ Make sure rows up to and including row have been fetched """
+        if row >= self.fetched and row < len(self.names):
+            self.beginInsertRows(QModelIndex(), self.fetched, row)
+            self.fetched = row + 1
+            self.endInsertRows()
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= self.fetched:
+            return None
+        name = self.names[index.row()]
+        if role == Qt.DisplayRole:
+            return name + ' (*)' if name in self.staged else name
+        if role == RECIPE_NAME_ROLE:
+            return name
+        return None
+
+    def name_at(self, row):
+        return self.names[row] if 0 <= row < len(self.names) else None
+
+    def row_of(self, name):
+        """ Row of the recipe, or -1. The row might not be fetched yet, see fetch_to. """
+        row = bisect_left(self.names, name)
+        return row if row < len(self.names) and self.names[row] == name else -1
+
+    def insert(self, name):
+        """ Add a recipe at its sorted position, returns its row """
+        row = bisect_left(self.names, name)
+        if row < len(self.names) and self.names[row] == name:
+            return row
+        if row < self.fetched:
+            self.beginInsertRows(QModelIndex(), row, row)
+            self.names.insert(row, name)
+            self.fetched += 1
+            self.endInsertRows()
+        else:
+            # past what the view has seen, it'll show up whenever it's fetched
+            self.names.insert(row, name)
+        return row
+
+    def remove(self, name):
+        row = self.row_of(name)
+        if row == -1:
+            return
+        self.staged.pop(name, None)
+        if row < self.fetched:
+            self.beginRemoveRows(QModelIndex(), row, row)
+            del self.names[row]
+            self.fetched -= 1
+            self.endRemoveRows()
+        else:
+            del self.names[row]
+
+    def _name_changed(self, name):
+        row = self.row_of(name)
+        if 0 <= row < self.fetched:
+            index = self.index(row)
+            self.dataChanged.emit(index, index)
+
+    def stage(self, name, recipe_data):
+        self.staged[name] = recipe_data
+        self._name_changed(name)
+        self.stage_changed.emit(name)
+
+    def unstage(self, name):
+        if self.staged.pop(name, None) is not None:
+            self._name_changed(name)
+            self.stage_changed.emit(name)
+
+    def is_staged(self, name):
+        return name in self.staged
+
+    def unstage_all(self):
+        """ Unstage everything, returns the names that were staged """
+        names = list(self.staged)
+        for name in names:
+            self.unstage(name)
+        return names
+
+class RecipeTableModel(QtCore.QAbstractTableModel):
+    """ The flavors of one recipe as (flavor, strength %) rows, sorted by flavor.
+    Edits are applied one cell at a time to a working copy of the recipe (working), and changed
+    keeps track of which flavors now differ from the original, so nothing ever has to re-read the
+    whole table. A cell that isn't valid (strength that isn't a non-negative number, flavor name
+    that's empty or already used) keeps the typed text, is marked red (error_cells) and isn't
+    applied to the working copy until it's fixed.
+    Every edit emits cell_changed(key_before, key_after, col, old_text, new_text) and then
+    cell_edited(row, col, valid). The first one is all it takes to redo or undo the edit later,
+    the rows are found again by flavor name (row_of_key) since they change when a recipe is reloaded.
+    """
+    cell_edited = pyqtSignal(int, int, bool)
+    cell_changed = pyqtSignal(str, str, int, str, str)
+
+    HEADERS = ('Flavor', 'Strength (%)')
+
+    def __init__(self, parent=None):
+        QtCore.QAbstractTableModel.__init__(self, parent)
+        self.flavors = []           # text shown in the flavor column
+        self.values = []            # text shown in the strength column
+        self.keys = []              # row -> flavor name in working
+        self.working = {}
+        self.original = {}
+        self.changed = set()        # flavors whose value in working differs from original
+        self.error_cells = set()
+
+    def set_recipe(self, recipe, original=None):
+        """ Show a recipe, given as a dict of flavor -> fraction. original is what the changes are
+        relative to (the backend's version), by default the recipe itself. """
+        self.beginResetModel()
+        self.working = dict(recipe)
+        self.original = dict(recipe) if original is None else original
+        self.keys = sorted(self.working)
+        self.flavors = list(self.keys)
+        self.values = ['%.1f'%(self.working[f]*100.0) for f in self.keys]
+        self.changed = {f for f in set(self.working).union(self.original) if self._differs(f)}
+        self.error_cells = set()
+        self.endResetModel()
+
+    def _differs(self, flavor):
+        return self.working.get(flavor) != self.original.get(flavor)
+
+    def _mark(self, flavor):
+        if self._differs(flavor):
+            self.changed.add(flavor)
+        else:
+            self.changed.discard(flavor)
+
+    def recipe(self):
+        """ The working copy as a dict of flavor -> fraction, or None if any cells have errors.
+        This is the model's own dict, it keeps changing as the table is edited. """
+        if self.error_cells:
+            return None
+        return self.working
+
+    def row_of_key(self, key):
+        """ Row of a flavor in working, or -1 """
+        try:
+            return self.keys.index(key)
+        except ValueError:
+            return -1
+
+    def is_modified(self):
+        return len(self.changed) > 0
+
+    def mark_committed(self):
+        """ The working copy is now what the backend has """
+        self.original = dict(self.working)
+        self.changed.clear()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.flavors)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else 2
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal and section < len(self.HEADERS):
+            return self.HEADERS[section]
+        return None
+
+    def flags(self, index):
+        return Qt.ItemIsEnabled | Qt.ItemIsSelectable | Qt.ItemIsEditable
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        (row, col) = (index.row(), index.column())
+        if role in (Qt.DisplayRole, Qt.EditRole):
+            return self.flavors[row] if col == 0 else self.values[row]
+        if role == Qt.BackgroundRole and (row, col) in self.error_cells:
+            return ERROR_COLOR
+        return None
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if not index.isValid() or role != Qt.EditRole:
+            return False
+        self.set_cell(index.row(), index.column(), str(value))
+        return True
+
+    def set_cell(self, row, col, text):
+        """ Apply an edit, like the view typing text into the cell. Returns True if it was valid. """
+        key = self.keys[row]
+        old_text = self.flavors[row] if col == 0 else self.values[row]
+        if col == 0:
+            self.flavors[row] = text
+            valid = text.strip() != '' and (text == key or text not in self.working)
+            if valid and text != key:
+                # rename: move the value over to the new name
+                self.working[text] = self.working.pop(key)
+                self.keys[row] = text
+                self._mark(key)
+                self._mark(text)
+        else:
+            self.values[row] = text
+            try:
+                frac = float(text) / 100.0
+                valid = frac >= 0
+            except ValueError:
+                valid = False
+            if valid:
+                self.working[key] = frac
+                self._mark(key)
+
+        if valid:
+            self.error_cells.discard((row, col))
+        else:
+            self.error_cells.add((row, col))
+        index = self.index(row, col)
+        self.dataChanged.emit(index, index)
+        self.cell_changed.emit(key, self.keys[row], col, old_text, text)
+        self.cell_edited.emit(row, col, valid)
+        return valid
@@ -0,0 +1,201 @@
+# Search index over the recipe library, for the recipe filter boxes (see Backend.search).
+#   - names: every lowercased recipe name is split into trigrams, padded at the front with two
+#     \x02's so its first one or two characters make trigrams of their own. A query only looks at
+#     the recipes in the shortest posting list among its trigrams, instead of at every name in the
+#     library. Queries of 3+ characters match anywhere in the name, one or two character queries
+#     match the start of it (that's all their padded trigram can say).
+#   - flavors: an inverted index from lowercased flavor name to the recipes using it and the
+#     fraction they use, so "contains X and Y above 2%" only reads X's and Y's posting lists.
+# Postings are arrays of recipe ids rather than sets of names, to keep a 100k recipe index small.
+# Changing a recipe gives it a new id and appends its postings; the old id is only marked dead.
+# Queries skip dead ids, and they get dropped once they're half the index, like RecipeStore's rows.
+
+import re
+from array import array
+from collections import defaultdict
+
+PAD = '\x02\x02'
+
+# don't bother compacting until there are at least this many dead postings
+COMPACT_MIN_DEAD = 4096
+
+_with = re.compile(r'\bwith:', re.IGNORECASE)
+_flavor_term = re.compile(r'^(.*?)\s*(?:>=?\s*([0-9]*\.?[0-9]+)\s*%?)?$')
+
+def trigrams(text):
+    text = PAD + text
+    return {text[i:i+3] for i in range(len(text) - 2)}
+
+def parse_query(query):
+    """ Split a filter box query into (name_text, flavor_terms).
+    Everything before 'with:' is matched against recipe names. After it comes a list of flavors
+    separated by commas or '&', each optionally followed by a minimum strength in percent:
+        straw with: vanilla > 2, cream
+    flavor_terms is a list of (flavor_text, min_fraction), min_fraction is None if not given.
+    """
+    m = _with.search(query)
+    if m is None:
+        return (query.strip(), [])
+    terms = []
+    for part in re.split('[,&]', query[m.end():]):
+        part = part.strip()
+        if not part:
+            continue
+        (flavor, pct) = _flavor_term.match(part).groups()
+        terms.append((flavor, None if pct is None else float(pct) / 100.0))
+    return (query[:m.start()].strip(), terms)
+
+class SearchIndex(object):
+    def __init__(self):
+        self._id_names = []         # recipe id -> name, None for dead ids
+        self._id_sizes = array('i') # recipe id -> number of postings
+        self._ids = {}              # name -> recipe id
+        self._trigrams = {}         # name trigram -> array of recipe ids
+        self._flavors = {}          # lowercased flavor -> (array of recipe ids, array of fractions)
+        self._dead = 0              # number of postings belonging to dead ids
+        self._total = 0
+
+    @classmethod
+    def from_store(cls, store):
+        """ Index everything in a RecipeStore, straight from its columns """
+        index = cls()
+        (offsets, ids, fracs, totals) = store.columns()
+        vocab = [flavor.lower() for flavor in store.vocab]
+        names = list(store.names())
+        # collect postings in lists first, appending to lists is quite a bit faster than to arrays
+        grams = defaultdict(list)
+        flavor_ids = defaultdict(list)
+        flavor_fracs = defaultdict(list)
+        for (rid, name) in enumerate(names):
+            row = store.row(name)
+            (start, end) = (offsets[row], offsets[row+1])
+            name_grams = trigrams(name.lower())
+            for tri in name_grams:
+                grams[tri].append(rid)
+            for k in range(start, end):
+                flavor = vocab[ids[k]]
+                flavor_ids[flavor].append(rid)
+                flavor_fracs[flavor].append(fracs[k])
+            index._id_sizes.append(len(name_grams) + end - start)
+
+        index._id_names = names
+        index._ids = {name: rid for (rid, name) in enumerate(names)}
+        index._trigrams = {tri: array('i', rids) for (tri, rids) in grams.items()}
+        index._flavors = {flavor: (array('i', rids), array('d', flavor_fracs[flavor]))
+                          for (flavor, rids) in flavor_ids.items()}
+        index._total = sum(index._id_sizes)
+        return index
+
+    def __len__(self):
+        return len(self._ids)
+
+    def _add(self, name, flavors):
+        rid = len(self._id_names)
+        self._id_names.append(name)
+        self._ids[name] = rid
+        size = 0
+        for tri in trigrams(name.lower()):
+            postings = self._trigrams.get(tri)
+            if postings is None:
+                postings = self._trigrams[tri] = array('i')
+            postings.append(rid)
+            size += 1
+        for (flavor, frac) in flavors:
+            postings = self._flavors.get(flavor)
+            if postings is None:
+                postings = self._flavors[flavor] = (array('i'), array('d'))
+            postings[0].append(rid)
+            postings[1].append(frac)
+            size += 1
+        self._id_sizes.append(size)
+        self._total += size
+
+    def put(self, name, recipe):
+        """ Add or replace a recipe, given as a dict of flavor name -> fraction """
+        self.remove(name)
+        self._add(name, [(flavor.lower(), frac) for (flavor, frac) in recipe.items()])
+
+    def remove(self, name):
+        rid = self._ids.pop(name, None)
+        if rid is None:
+            return
+        self._id_names[rid] = None
+        self._dead += self._id_sizes[rid]
+        if self._dead > COMPACT_MIN_DEAD and self._dead > self._total // 2:
+            self.compact()
+
+    def compact(self):
+        """ Rebuild the postings without the dead ids. Ids get renumbered but keep their order,
+        so posting lists stay sorted. """
+        remap = {}
+        id_names = []
+        id_sizes = array('i')
+        for (rid, name) in enumerate(self._id_names):
+            if name is None:
+                continue
+            remap[rid] = self._ids[name] = len(id_names)
+            id_names.append(name)
+            id_sizes.append(self._id_sizes[rid])
+
+        grams = {}
+        for (tri, rids) in self._trigrams.items():
+            kept = array('i', [remap[rid] for rid in rids if rid in remap])
+            if kept:
+                grams[tri] = kept
+        flavors = {}
+        for (flavor, (rids, fracs)) in self._flavors.items():
+            kept = [(remap[rid], frac) for (rid, frac) in zip(rids, fracs) if rid in remap]
+            if kept:
+                flavors[flavor] = (array('i', [rid for (rid, frac) in kept]),
+                                   array('d', [frac for (rid, frac) in kept]))
+
+        (self._id_names, self._id_sizes, self._trigrams, self._flavors) = (id_names, id_sizes, grams, flavors)
+        self._total -= self._dead
+        self._dead = 0
+
+    def match_name(self, text):
+        """ Set of ids of the recipes whose name matches text (see the top of the file) """
+        text = text.lower()
+        names = self._id_names
+        if len(text) < 3:
+            return {rid for rid in self._trigrams.get((PAD + text)[-3:], ()) if names[rid] is not None}
+
+        shortest = None
+        for i in range(len(text) - 2):
+            postings = self._trigrams.get(text[i:i+3])
+            if postings is None:
+                return set()
+            if shortest is None or len(postings) < len(shortest):
+                shortest = postings
+        # the trigrams all being there doesn't mean they're in the right order, check the name
+        return {rid for rid in shortest if names[rid] is not None and text in names[rid].lower()}
+
+    def match_flavor(self, text, min_fraction=None):
+        """ Set of ids of the recipes using a flavor whose name contains text, at min_fraction or more """
+        text = text.lower()
+        names = self._id_names
+        ret = set()
+        for (flavor, (rids, fracs)) in self._flavors.items():
+            if text not in flavor:
+                continue
+            if min_fraction is None:
+                ret.update(rid for rid in rids if names[rid] is not None)
+            else:
+                ret.update(rid for (rid, frac) in zip(rids, fracs) if frac >= min_fraction and names[rid] is not None)
+        return ret
+
+    def search(self, text='', flavors=(), limit=None):
+        """ Sorted names of the recipes matching text and all of the flavor terms, which are
+        (flavor_text, min_fraction) tuples like parse_query returns """
+        matches = []
+        if text:
+            matches.append(self.match_name(text))
+        for (flavor, min_fraction) in flavors:
+            matches.append(self.match_flavor(flavor, min_fraction))
+
+        if not matches:
+            names = sorted(self._ids)
+        else:
+            matches.sort(key=len)
+            names = sorted(self._id_names[rid] for rid in matches[0].intersection(*matches[1:]))
+        return names if limit is None else names[:limit]
@@ -0,0 +1,98 @@
+# Recipe libraries split over a directory of json shards (say one per supplier) instead of a single
+# vaperecipes.json. Every *.json file in the directory is a shard in the usual recipe file format,
+# and Backend takes the directory wherever it takes a recipe file.
+#
+# Loading parses (or mmaps the RecipeSnapshot of) every shard in parallel in a process pool. Each
+# worker loads its shard into a Backend, so it's checked exactly like a single file, and sends back
+# the store's columns, which get merged into one RecipeStore row by row (RecipeStore.merge).
+# A recipe in more than one shard is a conflict: the shard that comes first in filename order wins
+# and the conflict is reported, see Backend.get_conflicts. So are shards with different _configs.
+# The ignored copies (and a shard's own _config) are kept aside and written back unchanged whenever
+# the shard they're in is saved, so nothing in a shard is lost until the conflict is resolved by hand.
+# Backend remembers which shard every recipe came from, and saving only rewrites the shards that
+# have dirty recipes. New recipes go to NEW_SHARD.
+
+import multiprocessing, os
+from RecipeStore import RecipeStore
+
+SHARD_SUFFIX = '.json'
+NEW_SHARD = 'new_recipes.json'
+
+# worker processes for loading, None for one per CPU
+JOBS = None
+# below this much json in total, starting the pool takes longer than it saves
+PARALLEL_MIN_BYTES = 4 << 20
+
+def list_shards(dirname):
+    """ Sorted shard file names in dirname. Dot files are left out, that's where temp files go. """
+    return sorted(name for name in os.listdir(dirname)
+                  if name.endswith(SHARD_SUFFIX) and not name.startswith('.')
+                  and os.path.isfile(os.path.join(dirname, name)))
+
+def library_stat(path):
+    """ Something that changes whenever the library file (or database), or any shard in a library
+    directory, changes, for polling. None if it's not there. """
+    try:
+        if not os.path.isdir(path):
+            st = os.stat(path)
+            # a recipe database (see RecipeDB) is written through its write-ahead log
+            try:
+                wal = os.stat(path + '-wal')
+                return (st.st_size, st.st_mtime, wal.st_size, wal.st_mtime)
+            except OSError:
+                return (st.st_size, st.st_mtime)
+        ret = []
+        for name in list_shards(path):
+            st = os.stat(os.path.join(path, name))
+            ret.append((name, st.st_size, st.st_mtime))
+        return tuple(ret)
+    except OSError:
+        return None
+
+def _load_shard(args):
+    """ Pool worker: load one shard. Returns (store columns, nic_base, nic_strength) """
+    (path, snapshot) = args
+    from Backend import Backend
+    be = Backend()
+    be.load_file(path, snapshot=snapshot)
+    return (be._store.export_columns(), be._nic_base, be._nic_strength)
+
+def iter_shards(dirname, snapshot=True, jobs=None, progress=None):
+    """ Load every shard in dirname, in parallel when it's worth it. Yields
+    (shard name, RecipeStore, nic_base, nic_strength) in filename order.
+    progress, if given, is called as progress(bytes_loaded, total_bytes) after every shard.
+    Raises IOError/ValueError for the first shard that can't be loaded. """
+    names = list_shards(dirname)
+    paths = [os.path.join(dirname, name) for name in names]
+    sizes = [os.path.getsize(path) for path in paths]
+    if jobs is None:
+        jobs = JOBS or os.cpu_count() or 1
+    jobs = min(jobs, len(paths))
+    # a pool's own worker processes (Batch's, say) aren't allowed pools of their own
+    if jobs <= 1 or sum(sizes) < PARALLEL_MIN_BYTES or multiprocessing.current_process().daemon:
+        results = map(_load_shard, [(path, snapshot) for path in paths])
+        pool = None
+    else:
+        # spawn rather than fork, this can run on a worker thread of the GUI
+        pool = multiprocessing.get_context('spawn').Pool(jobs)
+        results = pool.imap(_load_shard, [(path, snapshot) for path in paths])
+    try:
+        done = 0
+        for (name, size, (columns, nic_base, nic_strength)) in zip(names, sizes, results):
+            done += size
+            if progress is not None:
+                progress(done, sum(sizes))
+            yield (name, RecipeStore.from_columns(*columns), nic_base, nic_strength)
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+def assign(shards, shard_of, recipe_name, shard):
+    """ Make shard the one recipe_name gets saved to, in Backend's two-way shard maps """
+    old = shard_of.get(recipe_name)
+    if old == shard:
+        return
+    if old is not None:
+        shards[old].discard(recipe_name)
+    shard_of[recipe_name] = shard
+    shards.setdefault(shard, set()).add(recipe_name)
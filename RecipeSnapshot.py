@@ -0,0 +1,145 @@
+# Binary snapshots of a loaded recipe library, for fast startup.
+# The snapshot lives next to the json file (vaperecipes.json -> vaperecipes.json.snap) and holds
+# RecipeStore's columns as raw int64/float64 arrays, so loading it is just an mmap plus a few
+# memoryview casts: flavor data is served straight out of the page cache without being parsed.
+#
+# A snapshot remembers the size, mtime and sha256 of the json it was made from. If the size and
+# mtime still match it's used right away. If only the mtime changed, the json is hashed to see
+# whether the content actually changed, and if it didn't the new mtime goes into the snapshot's
+# header so the next load doesn't hash it again. Anything else means it's stale and load() returns None.
+#
+# Layout: header (HEADER below), then the column arrays offsets, ids, fracs, totals, widths,
+# then the recipe names and the flavor vocabulary as \0-separated utf-8 blobs. Every section
+# starts on an 8-byte boundary.
+
+import hashlib, mmap, os, struct, sys
+from RecipeStore import RecipeStore
+
+SNAPSHOT_SUFFIX = '.snap'
+MAGIC = b'YACCSNAP'
+VERSION = 1
+
+# magic, version, byte order, json size, json mtime (ns), json sha256, nic strength, nic base,
+# number of rows, number of flavor entries, names blob length, vocab blob length
+HEADER = struct.Struct('<8sIc3xQq32sd16sQQQQ')
+# where the json mtime is in the header, see _touch
+MTIME_OFFSET = struct.calcsize('<8sIc3xQ')
+MTIME = struct.Struct('<q')
+
+def snapshot_path(json_path):
+    return json_path + SNAPSHOT_SUFFIX
+
+def hash_file(filename):
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.digest()
+
+def _pad(n):
+    return (-n) % 8
+
+def write(json_path, store, nic_base, nic_strength, json_sha=None, json_stat=None):
+    """ Write a snapshot of store for json_path. json_sha/json_stat are the sha256 digest and
+    os.stat of the json the store was loaded from; if they're not given the file is hashed/stat'd
+    now. The snapshot is written to a temp file and renamed into place. """
+    if json_stat is None:
+        json_stat = os.stat(json_path)
+    if json_sha is None:
+        json_sha = hash_file(json_path)
+
+    nic_base = nic_base.encode('utf-8')
+    if len(nic_base) > 16 or b'\0' in nic_base:
+        # the header has 16 bytes for it
+        raise ValueError("can't snapshot nic_base %r"%nic_base.decode('utf-8'))
+    (vocab, names, offsets, ids, fracs, totals, widths) = store.export_columns()
+    if any('\0' in name for name in names) or any('\0' in flavor for flavor in vocab):
+        raise ValueError("can't snapshot names containing \\0")
+    names_blob = '\0'.join(names).encode('utf-8')
+    vocab_blob = '\0'.join(vocab).encode('utf-8')
+    header = HEADER.pack(MAGIC, VERSION, sys.byteorder[0].encode('ascii'),
+                         json_stat.st_size, json_stat.st_mtime_ns, json_sha,
+                         float(nic_strength), nic_base,
+                         len(names), len(ids), len(names_blob), len(vocab_blob))
+
+    path = snapshot_path(json_path)
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as fp:
+            fp.write(header)
+            fp.write(b'\0' * _pad(len(header)))
+            for col in (offsets, ids, fracs, totals, widths):
+                col.tofile(fp)
+            for blob in (names_blob, vocab_blob):
+                fp.write(blob)
+                fp.write(b'\0' * _pad(len(blob)))
+        os.replace(tmp_path, path)
+    except:
+        # don't leave a half-written snapshot lying around
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def _touch(path, header, json_mtime_ns):
+    """ Put a new json mtime into the header of the snapshot at path, if it's still the snapshot
+    whose header was read (another process may have replaced it meanwhile). Failing is harmless,
+    the json just gets hashed again next time. """
+    try:
+        with open(path, 'r+b') as fp:
+            if fp.read(len(header)) != header:
+                return
+            fp.seek(MTIME_OFFSET)
+            fp.write(MTIME.pack(json_mtime_ns))
+    except OSError:
+        pass
+
+def load(json_path):
+    """ Load the snapshot for json_path if it's there and still matches the json.
+    Returns (store, nic_base, nic_strength), or None if there's no usable snapshot. """
+    path = snapshot_path(json_path)
+    try:
+        json_stat = os.stat(json_path)
+        with open(path, 'rb') as fp:
+            buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        # ValueError is mmap refusing an empty file
+        return None
+
+    try:
+        (magic, version, byteorder, json_size, json_mtime_ns, json_sha, nic_strength, nic_base,
+         n_rows, n_entries, names_len, vocab_len) = HEADER.unpack_from(buf, 0)
+    except struct.error:
+        return None
+    if magic != MAGIC or version != VERSION or byteorder != sys.byteorder[0].encode('ascii'):
+        return None
+    if json_size != json_stat.st_size:
+        return None
+    if json_mtime_ns != json_stat.st_mtime_ns and hash_file(json_path) != json_sha:
+        return None
+
+    pos = HEADER.size + _pad(HEADER.size)
+    expected = pos + 8*(3*n_rows + 1 + 2*n_entries) + names_len + _pad(names_len) + vocab_len + _pad(vocab_len)
+    if len(buf) != expected:
+        return None
+
+    mv = memoryview(buf)
+    cols = []
+    for (fmt, count) in (('q', n_rows + 1), ('q', n_entries), ('d', n_entries), ('d', n_rows), ('q', n_rows)):
+        cols.append(mv[pos:pos + 8*count].cast(fmt))
+        pos += 8*count
+    blobs = []
+    for length in (names_len, vocab_len):
+        blob = bytes(mv[pos:pos + length]).decode('utf-8')
+        blobs.append(blob.split('\0') if blob else [])
+        pos += length + _pad(length)
+    (names, vocab) = blobs
+    if len(names) != n_rows:
+        return None
+
+    if json_mtime_ns != json_stat.st_mtime_ns:
+        # touched but not changed
+        _touch(path, bytes(buf[:HEADER.size]), json_stat.st_mtime_ns)
+    store = RecipeStore.from_columns(vocab, names, *cols, buffer=buf)
+    return (store, nic_base.rstrip(b'\0').decode('utf-8'), nic_strength)
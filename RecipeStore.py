@@ -0,0 +1,292 @@
+# Compact in-memory storage for recipes. Instead of a dict of dicts (one dict, one boxed float
+# and one copy of every flavor name string per recipe), recipes are stored as columns:
+#   - a flavor vocabulary, so every flavor name is stored once and referred to by an integer id
+#   - CSR-style rows: recipe i's flavors are ids[offsets[i]:offsets[i+1]] with the matching
+#     fractions in fracs[...], sorted by flavor name
+#   - per-row total flavor and output column width, which is what calculate_mix needs
+# Updating a recipe appends a new row and abandons the old one; dead rows get compacted away
+# once they make up most of the arrays.
+# The columns can also be read-only memoryviews (e.g. of an mmap'd RecipeSnapshot), in which case
+# they're only copied into arrays the first time something is changed.
+
+from array import array
+from bisect import bisect_left, insort
+
+# don't bother compacting until there are at least this many dead flavor entries
+COMPACT_MIN_DEAD = 4096
+
+class RecipeInfo(object):
+    """ Everything calculate_mix needs to know about one recipe.
+    flavors and fractions are parallel tuples sorted by flavor name, width is the
+    output box column width (longest flavor name, or 'Nicotine').
+    """
+    __slots__ = ('flavors', 'fractions', 'total_flavor', 'max_vg', 'width')
+
+    def __init__(self, flavors, fractions, total_flavor, width):
+        self.flavors = flavors
+        self.fractions = fractions
+        self.total_flavor = total_flavor
+        self.max_vg = 1.0 - total_flavor
+        self.width = width
+
+class RecipeStore(object):
+    def __init__(self, recipes=None):
+        self.vocab = []             # flavor id -> name
+        self._vocab_ids = {}        # flavor name -> id
+        self._rows = {}             # recipe name -> row
+        self._row_names = []        # row -> recipe name, None for dead rows
+        self._offsets = array('q', [0])
+        self._ids = array('q')
+        self._fracs = array('d')
+        self._totals = array('d')
+        self._widths = array('q')
+        self._dead = 0              # number of flavor entries in dead rows
+        self._names = []            # sorted recipe names (see defer_sorting)
+        self._names_sorted = True
+        self._buffer = None         # whatever the columns point into, if they're memoryviews
+        if recipes is not None:
+            self.update(recipes)
+
+    @classmethod
+    def from_columns(cls, vocab, names, offsets, ids, fracs, totals, widths, buffer=None):
+        """ Make a store directly from columns, like the ones export_columns returns.
+        names must be sorted, and row i is names[i]. The columns can be anything that
+        supports len/indexing/slicing (arrays or memoryviews), and are used without copying.
+        buffer is kept alive as long as the store uses the columns. """
+        store = cls()
+        store.vocab = list(vocab)
+        store._vocab_ids = {flavor: fid for (fid, flavor) in enumerate(store.vocab)}
+        store._rows = dict(zip(names, range(len(names))))
+        store._row_names = list(names)
+        store._names = list(names)
+        (store._offsets, store._ids, store._fracs) = (offsets, ids, fracs)
+        (store._totals, store._widths) = (totals, widths)
+        store._buffer = buffer
+        return store
+
+    def export_columns(self):
+        """ Returns (vocab, names, offsets, ids, fracs, totals, widths) with the rows in sorted
+        name order and no dead rows, as new arrays. The inverse of from_columns. """
+        names = list(self.names())
+        if self._dead == 0 and self._row_names == names:
+            # already like that (e.g. loaded from a snapshot), the columns can be copied whole
+            cols = []
+            for (typecode, col) in (('q', self._offsets), ('q', self._ids), ('d', self._fracs),
+                                    ('d', self._totals), ('q', self._widths)):
+                copy = array(typecode)
+                copy.frombytes(memoryview(col).cast('B'))
+                cols.append(copy)
+            return tuple([list(self.vocab), names] + cols)
+        offsets = array('q', [0])
+        ids = array('q')
+        fracs = array('d')
+        totals = array('d')
+        widths = array('q')
+        for name in names:
+            row = self._rows[name]
+            (start, end) = (self._offsets[row], self._offsets[row+1])
+            ids.extend(self._ids[start:end])
+            fracs.extend(self._fracs[start:end])
+            offsets.append(len(ids))
+            totals.append(self._totals[row])
+            widths.append(self._widths[row])
+        return (list(self.vocab), names, offsets, ids, fracs, totals, widths)
+
+    def freeze(self):
+        """ Read-only copy of the store as it is now, for writing it out from another thread.
+        Only the name -> row index is copied, the columns are shared: put/remove only ever append
+        to them, and compact/_make_writable replace them with new ones, so the rows the copy knows
+        about never change underneath it. Don't put/remove on the copy. """
+        store = RecipeStore()
+        store.vocab = self.vocab
+        store._rows = dict(self._rows)
+        store._row_names = None
+        store._names = list(self.names())
+        (store._offsets, store._ids, store._fracs) = (self._offsets, self._ids, self._fracs)
+        (store._totals, store._widths) = (self._totals, self._widths)
+        store._buffer = self._buffer
+        return store
+
+    def _make_writable(self):
+        """ Copy memoryview columns into arrays so they can be appended to """
+        if self._buffer is None:
+            return
+        self._offsets = array('q', self._offsets)
+        self._ids = array('q', self._ids)
+        self._fracs = array('d', self._fracs)
+        self._totals = array('d', self._totals)
+        self._widths = array('q', self._widths)
+        self._buffer = None
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, recipe_name):
+        return recipe_name in self._rows
+
+    def __iter__(self):
+        return iter(self.names())
+
+    def _flavor_id(self, flavor):
+        try:
+            return self._vocab_ids[flavor]
+        except KeyError:
+            fid = len(self.vocab)
+            self.vocab.append(flavor)
+            self._vocab_ids[flavor] = fid
+            return fid
+
+    def put(self, recipe_name, recipe):
+        """ Add or replace a recipe, given as a dict of flavor name -> fraction """
+        self._make_writable()
+        flavors = sorted(recipe.keys())
+        fracs = [recipe[f] for f in flavors]
+        self._ids.extend(self._flavor_id(f) for f in flavors)
+        self._fracs.extend(fracs)
+        self._offsets.append(len(self._ids))
+        self._totals.append(sum(fracs))
+        self._widths.append(max([len(f) for f in flavors] + [len('Nicotine')]))
+        self._add_row(recipe_name)
+
+    def _add_row(self, recipe_name):
+        """ Bookkeeping for a row that was just appended to the columns """
+        old_row = self._rows.get(recipe_name)
+        self._rows[recipe_name] = len(self._row_names)
+        self._row_names.append(recipe_name)
+        if old_row is None:
+            if self._names_sorted:
+                insort(self._names, recipe_name)
+            else:
+                self._names.append(recipe_name)
+        else:
+            self._kill_row(old_row)
+
+    def update(self, recipes):
+        for (name, recipe) in recipes.items():
+            self.put(name, recipe)
+
+    def merge(self, other, names=None):
+        """ Put other's recipes (all of them, or the ones in names) into this store, copying their
+        rows over column to column instead of going through a dict per recipe """
+        self._make_writable()
+        self.defer_sorting()
+        id_map = [self._flavor_id(flavor) for flavor in other.vocab]
+        # flavors are sorted by name within a row, so mapping the ids keeps them sorted
+        (offsets, ids, fracs) = (other._offsets, other._ids, other._fracs)
+        row_names = other._row_names
+        if names is None and row_names is not None and None not in row_names and \
+                not any(name in self._rows for name in row_names):
+            # all of other's rows and none of them replace one of ours, so whole columns can be
+            # copied, row for row
+            base = len(self._ids) - offsets[0]
+            self._ids.extend(map(id_map.__getitem__, ids[offsets[0]:]))
+            self._fracs.extend(fracs[offsets[0]:])
+            self._offsets.extend([offset + base for offset in offsets[1:]])
+            self._totals.extend(other._totals)
+            self._widths.extend(other._widths)
+            # and the _add_row bookkeeping, which is simple when every name is new
+            first_row = len(self._row_names)
+            self._rows.update(zip(row_names, range(first_row, first_row + len(row_names))))
+            self._row_names.extend(row_names)
+            self._names.extend(row_names)
+            return
+        for name in (other.names() if names is None else names):
+            row = other._rows[name]
+            (start, end) = (offsets[row], offsets[row+1])
+            self._ids.extend([id_map[fid] for fid in ids[start:end]])
+            self._fracs.extend(fracs[start:end])
+            self._offsets.append(len(self._ids))
+            self._totals.append(other._totals[row])
+            self._widths.append(other._widths[row])
+            self._add_row(name)
+
+    def remove(self, recipe_name):
+        """ Remove a recipe, returns False if it wasn't there """
+        row = self._rows.pop(recipe_name, None)
+        if row is None:
+            return False
+        if self._names_sorted:
+            del self._names[bisect_left(self._names, recipe_name)]
+        else:
+            self._names.remove(recipe_name)
+        self._kill_row(row)
+        return True
+
+    def _kill_row(self, row):
+        self._row_names[row] = None
+        self._dead += self._offsets[row+1] - self._offsets[row]
+        if self._dead > COMPACT_MIN_DEAD and self._dead > len(self._ids) // 2:
+            self.compact()
+
+    def compact(self):
+        """ Rebuild the arrays without the dead rows """
+        self._buffer = None
+        offsets = array('q', [0])
+        ids = array('q')
+        fracs = array('d')
+        totals = array('d')
+        widths = array('q')
+        row_names = []
+        for (row, name) in enumerate(self._row_names):
+            if name is None:
+                continue
+            (start, end) = (self._offsets[row], self._offsets[row+1])
+            ids.extend(self._ids[start:end])
+            fracs.extend(self._fracs[start:end])
+            offsets.append(len(ids))
+            totals.append(self._totals[row])
+            widths.append(self._widths[row])
+            self._rows[name] = len(row_names)
+            row_names.append(name)
+        (self._offsets, self._ids, self._fracs) = (offsets, ids, fracs)
+        (self._totals, self._widths, self._row_names) = (totals, widths, row_names)
+        self._dead = 0
+
+    def defer_sorting(self):
+        """ Stop keeping the name list sorted on every put(), for bulk loading.
+        It gets sorted again the next time names() is called. """
+        self._names_sorted = False
+
+    def load_all(self):
+        """ Everything is always loaded here, see RecipeDB.LazyRecipeStore for a store where it isn't """
+        pass
+
+    def names(self):
+        """ Sorted list of recipe names. This is the store's own list, don't modify it. """
+        if not self._names_sorted:
+            self._names.sort()
+            self._names_sorted = True
+        return self._names
+
+    def row(self, recipe_name):
+        """ Row number of a recipe in columns(), or None """
+        return self._rows.get(recipe_name)
+
+    def columns(self):
+        """ The raw (offsets, ids, fracs, totals) columns, indexed by row. Rows are only valid
+        until the next put/remove. offsets/ids are int64 and fracs/totals are float64, either
+        arrays or memoryviews, so numpy.frombuffer works on all of them. """
+        return (self._offsets, self._ids, self._fracs, self._totals)
+
+    def get(self, recipe_name):
+        """ The recipe as a new dict of flavor name -> fraction, or None """
+        row = self._rows.get(recipe_name)
+        if row is None:
+            return None
+        (start, end) = (self._offsets[row], self._offsets[row+1])
+        vocab = self.vocab
+        return {vocab[fid]: frac for (fid, frac) in zip(self._ids[start:end], self._fracs[start:end])}
+
+    def info(self, recipe_name):
+        """ RecipeInfo for the recipe, or None """
+        row = self._rows.get(recipe_name)
+        if row is None:
+            return None
+        (start, end) = (self._offsets[row], self._offsets[row+1])
+        vocab = self.vocab
+        return RecipeInfo(tuple(vocab[fid] for fid in self._ids[start:end]), tuple(self._fracs[start:end]),
+                          self._totals[row], self._widths[row])
+
+    def total_flavor(self, recipe_name):
+        row = self._rows.get(recipe_name)
+        return None if row is None else self._totals[row]
@@ -0,0 +1,415 @@
+# Local HTTP/JSON service around one Backend, for the POS terminals and label printers that need
+# mixes without running the Qt app:  python -m yacc serve [--port 8765]
+#
+#   GET  /config                    Backend.get_config
+#   GET  /recipes?q=...&limit=N     sorted recipe names, all of them or the ones matching a search
+#                                   box query (see RecipeSearch.parse_query)
+#   GET  /recipes/<name>            one recipe: flavor -> percent, total flavor and Max VG
+#   GET  /mix?recipe=...&totalvol=10&nic=3&vg=70&mix=from_ingredients
+#   POST /mix                       the same fields as a JSON object
+#   POST /mix/batch                 {"orders": [{...}, ...]}, calculated together like Batch does
+#   POST /reload                    re-read the library now
+#   GET  /stats                     Backend.get_stats plus the connection/request counters
+# Mix results have the same fields as `yacc batch` jsonl output, plus the text the GUI would show.
+# Errors come back as {"error": message} with a 4xx/5xx status. Orders are checked like Batch checks
+# them (totalvol > 0, no nan/inf), and a response never has NaN or Infinity in it.
+#
+# HTTP/1.1 with keep-alive (and pipelining), one asyncio task per connection, nothing but the
+# stdlib. Changes to the Backend are only made on the event loop thread, so a request never sees it
+# half changed. Anything slow runs on an executor thread so it doesn't hold up the other connections:
+# - reading and diffing the file for a reload, then Backend.reload applies it in one go, so
+#   reloading never blocks or drops a connection
+# - building the search index (and, for a database, fetching every recipe for it), once at startup.
+#   Searches wait for it, reloads keep it up to date
+# - big /mix/batch requests, which calculate_mix_batch does under the Backend's lock
+# The library file is checked every --watch seconds and reloaded when it
+# changes, the same way the GUI follows it.
+
+import asyncio, json, os, signal, sys, time
+from urllib.parse import urlsplit, parse_qsl, unquote
+from Backend import Backend, CONFIG_FILE
+import Batch
+import RecipeShards
+import Stats
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+# seconds between checks of the library file, 0 to only reload on POST /reload
+WATCH_INTERVAL = 2.0
+# idle keep-alive connections are closed after this many seconds
+KEEPALIVE_TIMEOUT = 30.0
+MAX_BODY = 8 << 20
+MAX_HEADERS = 100
+MAX_BATCH = 10000
+# /mix/batch bodies bigger than this (a couple of hundred orders) are done on an executor thread
+EXECUTOR_MIN_BODY = 16 << 10
+
+MIX_TYPES = ('from_ingredients', 'from_concentrate', 'concentrate')
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           413: 'Payload Too Large', 431: 'Request Header Fields Too Large', 500: 'Internal Server Error',
+           501: 'Not Implemented'}
+
+class HttpError(Exception):
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+async def read_request(reader):
+    """ Read the next request off a connection.
+    Returns (method, target, version, headers, body), or None if the client closed it """
+    try:
+        line = await reader.readline()
+        if not line.endswith(b'\n'):
+            return None
+        try:
+            (method, target, version) = line.decode('latin-1').split()
+        except ValueError:
+            raise HttpError(400, 'bad request line')
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if not line.endswith(b'\n'):
+                return None
+            if line in (b'\r\n', b'\n'):
+                break
+            if len(headers) >= MAX_HEADERS:
+                raise HttpError(431, 'too many headers')
+            (name, _, value) = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+    except (ValueError, asyncio.LimitOverrunError):
+        # a line longer than the StreamReader limit
+        raise HttpError(431, 'request line or header too long')
+
+    if 'chunked' in headers.get('transfer-encoding', '').lower():
+        raise HttpError(501, 'chunked request bodies are not supported, send a Content-Length')
+    try:
+        length = int(headers.get('content-length', 0))
+    except ValueError:
+        raise HttpError(400, 'bad Content-Length')
+    if length > MAX_BODY:
+        raise HttpError(413, 'request body is over %d bytes'%MAX_BODY)
+    body = await reader.readexactly(length) if length > 0 else b''
+    return (method.upper(), target, version.upper(), headers, body)
+
+def encode(status, obj):
+    """ (status, JSON body bytes) for a handler's result """
+    try:
+        return (status, json.dumps(obj, separators=(',', ':'), allow_nan=False).encode('utf-8'))
+    except ValueError:
+        # NaN/Infinity aren't JSON, and a client couldn't do anything with them anyway
+        print('Error: response with a non-finite number: %r'%(obj,))
+        return (500, b'{"error":"result is not a finite number"}')
+
+def response(status, obj, keep_alive):
+    """ The whole HTTP response, obj is a JSON object or an already encoded body """
+    if isinstance(obj, bytes):
+        body = obj
+    else:
+        (status, body) = encode(status, obj)
+    head = ['HTTP/1.1 %d %s'%(status, REASONS.get(status, '')),
+            'Content-Type: application/json; charset=utf-8',
+            'Content-Length: %d'%len(body)]
+    if keep_alive:
+        head.append('Keep-Alive: timeout=%d'%KEEPALIVE_TIMEOUT)
+    else:
+        head.append('Connection: close')
+    return ('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body
+
+def _json_body(body):
+    try:
+        obj = json.loads(body.decode('utf-8')) if body else {}
+    except ValueError:
+        raise HttpError(400, 'request body is not valid JSON')
+    return obj
+
+def _order(obj):
+    """ An order dict from request fields, checked (see Batch.check_order).
+    Returns (order, error message or None) """
+    if not isinstance(obj, dict):
+        return ({}, 'invalid input: not a JSON object')
+    order = {Batch.FIELD_ALIASES.get(k, k): v for (k, v) in obj.items()}
+    err = Batch.check_order(order)
+    if err is None and order['mix'] not in MIX_TYPES:
+        err = 'invalid input: mix must be one of %s'%', '.join(MIX_TYPES)
+    return (order, err)
+
+def mix_result(result):
+    """ JSON for a MixResult, the same fields as Batch's output """
+    return {'recipe': result.recipe_name,
+            'mix': result.mix,
+            'status': 'ok',
+            'nicotine_ml': round(result.nic, 4),
+            'vg_ml': round(result.vg, 4),
+            'pg_ml': round(result.pg, 4),
+            'concentrate_ml': round(result.concentrate, 4),
+            'makes_ml': round(result.makes, 4),
+            'message': result.message or '',
+            'flavors': {f: round(v, 4) for (f, v) in zip(result.flavors, result.volumes)},
+            'text': result.render()}
+
+def load_for_reload(be, filename, frozen):
+    """ Executor side of a reload: the file in a new Backend and how it differs, see Backend.reload """
+    if be.is_database() and filename == be.filename:
+        return (None, be.diff(None, frozen))
+    new = Backend(cache_size=0)
+    new.load_file(filename)
+    return (new, be.diff(new, frozen))
+
+class Server(object):
+    def __init__(self, backend, filename, watch=WATCH_INTERVAL):
+        self.be = backend
+        self.filename = filename
+        self.watch = watch
+        self.config_stat = self.get_config_stat()
+        self._reload_lock = None
+        self._indexing = None
+        self._server = None
+        self._connections = set()
+        self.counters = {'connections': 0, 'requests': 0, 'errors': 0, 'reloads': 0}
+        # (method, resource, whether a name follows it) -> handler
+        self.routes = {('GET', 'config', False): self.handle_config,
+                       ('GET', 'recipes', False): self.handle_recipes,
+                       ('GET', 'recipes', True): self.handle_recipe,
+                       ('GET', 'mix', False): self.handle_mix,
+                       ('POST', 'mix', False): self.handle_mix,
+                       ('POST', 'mix/batch', False): self.handle_mix_batch,
+                       ('POST', 'reload', False): self.handle_reload,
+                       ('GET', 'stats', False): self.handle_stats}
+
+    def get_config_stat(self):
+        return RecipeShards.library_stat(self.filename)
+
+    async def run(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        self._reload_lock = asyncio.Lock()
+        self.start_search_index()
+        self._server = await asyncio.start_server(self.handle_connection, host, port)
+        (host, port) = self._server.sockets[0].getsockname()[:2]
+        print('Serving %s (%d recipes) on http://%s:%d/'%(self.filename, len(self.be.get_recipes()), host, port))
+        sys.stdout.flush()
+
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except (NotImplementedError, RuntimeError):
+                # Windows, Ctrl-C still gets out through KeyboardInterrupt
+                pass
+        watcher = asyncio.ensure_future(self.watch_file()) if self.watch > 0 else None
+        try:
+            await stop.wait()
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+            self._server.close()
+            for writer in list(self._connections):
+                writer.close()
+            await self._server.wait_closed()
+
+    def start_search_index(self):
+        """ Build the search index on an executor thread, if it isn't built or being built """
+        if self.be.has_search_index() or (self._indexing is not None and not self._indexing.done()):
+            return
+        loop = asyncio.get_running_loop()
+        self._indexing = loop.run_in_executor(None, self.be.build_search_index)
+
+    async def search_index(self):
+        """ Wait until searches can use the index, so none of them builds it on the loop """
+        if not self.be.has_search_index():
+            # it's started again if building it failed before
+            self.start_search_index()
+            # one request going away mustn't cancel the build for everyone else
+            await asyncio.shield(self._indexing)
+
+    async def watch_file(self):
+        while True:
+            await asyncio.sleep(self.watch)
+            if self.get_config_stat() != self.config_stat:
+                try:
+                    await self.reload()
+                except Exception as e:
+                    # the old library keeps being served
+                    print('Error: unable to reload %s: %s'%(self.filename, e))
+
+    async def reload(self):
+        """ Re-read the library without holding up requests, returns (added, removed, modified) """
+        async with self._reload_lock:
+            self.config_stat = self.get_config_stat()
+            loop = asyncio.get_running_loop()
+            (loaded, changes) = await loop.run_in_executor(None, load_for_reload, self.be, self.filename,
+                                                           self.be.freeze())
+            ret = self.be.reload(self.filename, loaded, changes)
+            self.counters['reloads'] += 1
+            print('Reloaded %s: %d added, %d removed, %d modified'%((self.filename,) + tuple(map(len, ret))))
+            return ret
+
+    async def handle_connection(self, reader, writer):
+        self.counters['connections'] += 1
+        self._connections.add(writer)
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(read_request(reader), KEEPALIVE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+                except HttpError as e:
+                    self.counters['errors'] += 1
+                    writer.write(response(e.status, {'error': str(e)}, False))
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+
+                (method, target, version, headers, body) = request
+                connection = headers.get('connection', '').lower()
+                if version == 'HTTP/1.0':
+                    keep_alive = connection == 'keep-alive'
+                else:
+                    keep_alive = connection != 'close'
+                (status, obj) = await self.dispatch(method, target, body)
+                writer.write(response(status, obj, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._connections.discard(writer)
+            writer.close()
+
+    async def dispatch(self, method, target, body):
+        """ Run the handler for a request, returns (status, JSON object) """
+        self.counters['requests'] += 1
+        start = time.perf_counter()
+        url = urlsplit(target)
+        parts = url.path.strip('/').split('/', 1)
+        (resource, name) = (parts[0], unquote(parts[1]) if len(parts) > 1 else None)
+        if (resource, name) == ('mix', 'batch'):
+            (resource, name) = ('mix/batch', None)
+        handler = self.routes.get((method, resource, name is not None))
+        if handler is None:
+            self.counters['errors'] += 1
+            if any(key[1:] == (resource, name is not None) for key in self.routes):
+                return (405, {'error': '%s not allowed on %s'%(method, url.path)})
+            return (404, {'error': 'no such endpoint %s'%url.path})
+
+        query = dict(parse_qsl(url.query))
+        try:
+            ret = handler(name=name, query=query, body=body)
+            if asyncio.iscoroutine(ret):
+                ret = await ret
+        except HttpError as e:
+            ret = (e.status, {'error': str(e)})
+        except Exception as e:
+            print('Error: %s %s failed: %s: %s'%(method, target, type(e).__name__, e))
+            ret = (500, {'error': str(e)})
+        if ret[0] >= 400:
+            self.counters['errors'] += 1
+        Stats.record('server.%s'%handler.__name__[len('handle_'):], time.perf_counter() - start)
+        return ret
+
+    def handle_config(self, **kw):
+        return (200, self.be.get_config())
+
+    async def handle_recipes(self, query, **kw):
+        limit = query.get('limit')
+        try:
+            limit = int(limit) if limit else None
+        except ValueError:
+            raise HttpError(400, 'bad limit')
+        if query.get('q'):
+            await self.search_index()
+        return (200, {'recipes': self.be.search(query.get('q', ''), limit=limit)})
+
+    def handle_recipe(self, name, **kw):
+        recipe = self.be.get_recipe(name)
+        if recipe is None:
+            return (404, {'error': 'recipe %s not found'%name})
+        total = sum(recipe.values())
+        return (200, {'recipe': name,
+                      'flavors': {f: round(v * 100.0, 4) for (f, v) in recipe.items()},
+                      'total_flavor': round(total * 100.0, 4),
+                      'max_vg': round((1.0 - total) * 100.0, 4)})
+
+    def handle_mix(self, query, body, **kw):
+        (order, err) = _order(_json_body(body) if body else query)
+        if err is not None:
+            raise HttpError(400, err)
+        recipe = self.be.get_recipe(order['recipe']) if order['mix'] == 'concentrate' else None
+        if recipe is not None and sum(recipe.values()) == 0:
+            raise HttpError(400, 'recipe %s has no flavors to make concentrate from'%order['recipe'])
+        result = self.be.calculate_mix(order['recipe'], order['totalvol'], order['nic'], order['vg'], order['mix'])
+        if result is None:
+            return (404, {'error': 'recipe %s not found'%order['recipe']})
+        return (200, mix_result(result))
+
+    async def handle_mix_batch(self, body, **kw):
+        if len(body) < EXECUTOR_MIN_BODY:
+            return self.mix_batch(body)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.mix_batch, body, True)
+
+    def mix_batch(self, body, encoded=False):
+        """ The work of handle_mix_batch, on whatever thread. With encoded set, the response comes
+        back as the JSON body already (see response). """
+        obj = _json_body(body)
+        orders = obj.get('orders') if isinstance(obj, dict) else obj
+        if not isinstance(orders, list):
+            raise HttpError(400, 'expected {"orders": [...]}')
+        if len(orders) > MAX_BATCH:
+            raise HttpError(413, 'at most %d orders per batch'%MAX_BATCH)
+        (orders, errors) = zip(*[_order(o) for o in orders]) if orders else ((), ())
+        results = Batch.calculate_orders(self.be, list(orders), list(errors))
+        out = []
+        for (order, result) in zip(orders, results):
+            obj = {f: order.get(f) for f in Batch.ORDER_FIELDS}
+            obj.update(result)
+            if 'flavors' in obj:
+                obj['flavors'] = dict(obj['flavors'])
+            out.append(obj)
+        if not encoded:
+            return (200, {'results': out})
+        # one result at a time: a single json.dumps of thousands of them holds the GIL, and with it
+        # the event loop, until it's done
+        try:
+            parts = [json.dumps(obj, separators=(',', ':'), allow_nan=False) for obj in out]
+        except ValueError:
+            return encode(200, {'results': out})
+        return (200, ('{"results":[%s]}'%','.join(parts)).encode('utf-8'))
+
+    async def handle_reload(self, **kw):
+        try:
+            (added, removed, modified) = await self.reload()
+        except (IOError, ValueError) as e:
+            return (500, {'error': 'unable to reload %s: %s'%(self.filename, e)})
+        return (200, {'added': len(added), 'removed': len(removed), 'modified': len(modified)})
+
+    def handle_stats(self, **kw):
+        stats = self.be.get_stats()
+        stats['server'] = dict(self.counters, open_connections=len(self._connections))
+        return (200, stats)
+
+def add_arguments(parser):
+    parser.add_argument('-l', '--library', default=CONFIG_FILE,
+                        help='recipe library json file, directory of shards or database (default: %(default)s)')
+    parser.add_argument('--host', default=DEFAULT_HOST, help='address to listen on (default: %(default)s)')
+    parser.add_argument('-p', '--port', type=int, default=DEFAULT_PORT,
+                        help='port to listen on, 0 for any free one (default: %(default)s)')
+    parser.add_argument('--watch', type=float, default=WATCH_INTERVAL,
+                        help='seconds between checks for changes to the library, 0 = only reload on '
+                             'POST /reload (default: %(default)s)')
+
+def main(args):
+    if not os.path.exists(args.library):
+        print('Error: recipe library %s not found'%args.library, file=sys.stderr)
+        return 1
+    be = Backend(args.library)
+    try:
+        asyncio.run(Server(be, args.library, args.watch).run(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    except OSError as e:
+        print('Error: unable to listen on %s:%d: %s'%(args.host, args.port, e), file=sys.stderr)
+        return 1
+    return 0
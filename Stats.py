@@ -0,0 +1,156 @@
+# Lightweight instrumentation: call counts and latency histograms per operation, plus an environment
+# variable switch for profiling a whole session.
+#
+# Operations are timed with `with timed('backend.search'):`, the @timer(name) decorator for a whole
+# function, or record(name, seconds) when the time is already known. Each one keeps a count, the total and max time, and a histogram with a
+# bucket per power of two microseconds, so recording is a few additions and nothing grows with the
+# number of calls. Only coarse operations are timed (loading, saving, a mix that wasn't cached,
+# filling a widget...), which costs a pair of perf_counter calls each.
+# get_stats() (also part of Backend.get_stats) returns all of it, summary() is a one-line readout
+# for the status bar.
+#
+# YACC_PROFILE=cprofile or YACC_PROFILE=tracemalloc runs the session under cProfile/tracemalloc and
+# writes the report when the program exits, to YACC_PROFILE_OUT (default yacc-profile.txt), see
+# start_profiling. When it's not set none of that is even imported.
+# cProfile only sees the thread it was started on, the worker threads show up in the histograms.
+
+import functools, os, sys, threading, time
+from contextlib import contextmanager
+
+# bucket i counts the times under 2**i microseconds, the last one everything longer (~35 minutes)
+N_BUCKETS = 32
+
+PROFILE_VAR = 'YACC_PROFILE'
+PROFILE_OUT_VAR = 'YACC_PROFILE_OUT'
+PROFILE_OUT = 'yacc-profile.txt'
+
+class OpStats(object):
+    __slots__ = ('count', 'total', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * N_BUCKETS
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.buckets[min(int(seconds * 1e6).bit_length(), N_BUCKETS - 1)] += 1
+
+    def percentile(self, p):
+        """ Upper bound of the bucket holding the p-th percentile, in seconds """
+        rank = p / 100.0 * self.count
+        seen = 0
+        for (i, n) in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                return min((1 << i) / 1e6, self.max)
+        return self.max
+
+    def as_dict(self):
+        return {'count': self.count,
+                'total_ms': self.total * 1000.0,
+                'mean_ms': self.total * 1000.0 / self.count if self.count else 0.0,
+                'max_ms': self.max * 1000.0,
+                'p50_ms': self.percentile(50) * 1000.0,
+                'p90_ms': self.percentile(90) * 1000.0,
+                'p99_ms': self.percentile(99) * 1000.0,
+                # bucket upper bound in us -> count, only the ones used
+                'histogram': {(1 << i): n for (i, n) in enumerate(self.buckets) if n}}
+
+_ops = {}
+# worker threads record too
+_lock = threading.Lock()
+
+def record(name, seconds):
+    with _lock:
+        op = _ops.get(name)
+        if op is None:
+            op = _ops[name] = OpStats()
+        op.add(seconds)
+
+@contextmanager
+def timed(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+def timer(name):
+    """ Decorator version of timed, for timing a whole function """
+    def wrap(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - start)
+        return wrapper
+    return wrap
+
+def get_stats():
+    """ operation name -> dict of count, total/mean/max/percentile times in ms and the histogram """
+    with _lock:
+        return {name: op.as_dict() for (name, op) in _ops.items()}
+
+def reset():
+    with _lock:
+        _ops.clear()
+
+def summary(n=4):
+    """ One line about the n operations that took the most time in total """
+    with _lock:
+        ops = sorted(_ops.items(), key=lambda item: -item[1].total)[:n]
+        return ' | '.join('%s %dx %.1f ms (p90 %.1f)'%(name, op.count, op.total * 1000.0 / op.count,
+                                                        op.percentile(90) * 1000.0) for (name, op) in ops)
+
+def start_profiling():
+    """ Start cProfile or tracemalloc if YACC_PROFILE asks for it, with the report written at exit.
+    Returns the kind of profiling started, or None. """
+    kind = os.environ.get(PROFILE_VAR, '').strip().lower()
+    if not kind:
+        return None
+    out = os.environ.get(PROFILE_OUT_VAR) or PROFILE_OUT
+    import atexit
+    if kind == 'cprofile':
+        import cProfile
+        profiler = cProfile.Profile()
+        atexit.register(_write_cprofile, profiler, out)
+        profiler.enable()
+    elif kind == 'tracemalloc':
+        import tracemalloc
+        tracemalloc.start(25)
+        atexit.register(_write_tracemalloc, out)
+    else:
+        print('Warning: unknown %s=%s, use cprofile or tracemalloc'%(PROFILE_VAR, kind), file=sys.stderr)
+        return None
+    print('Profiling with %s, report goes to %s'%(kind, out), file=sys.stderr)
+    return kind
+
+def _write_stats(fp):
+    fp.write('\nOperation stats (ms):\n')
+    for (name, op) in sorted(get_stats().items()):
+        fp.write('  %-32s %8d calls  mean %9.3f  p90 %9.3f  max %9.3f\n'%(
+                 name, op['count'], op['mean_ms'], op['p90_ms'], op['max_ms']))
+
+def _write_cprofile(profiler, out):
+    import pstats
+    profiler.disable()
+    with open(out, 'w') as fp:
+        pstats.Stats(profiler, stream=fp).sort_stats('cumulative').print_stats(60)
+        _write_stats(fp)
+
+def _write_tracemalloc(out):
+    import tracemalloc
+    snapshot = tracemalloc.take_snapshot()
+    (current, peak) = tracemalloc.get_traced_memory()
+    with open(out, 'w') as fp:
+        fp.write('Traced memory: %.1f MB now, %.1f MB peak\n\nTop allocations:\n'%(current / 1e6, peak / 1e6))
+        for stat in snapshot.statistics('lineno')[:50]:
+            fp.write('  %s\n'%stat)
+        _write_stats(fp)
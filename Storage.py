@@ -0,0 +1,284 @@
+# Where a Backend's recipes are loaded from and where changes to them go. Backend does everything
+# that doesn't depend on that itself (mixes, search, the mix cache, writing json out) and hands the
+# rest to its storage, picked by storage_for when a library is loaded:
+#   FileStorage      a json file, or a directory of json shards (see RecipeShards). Changes are
+#                    kept in memory, marked dirty and journaled until they're saved.
+#   DatabaseStorage  a recipe database (see RecipeDB), changes are written through.
+# Deciding which one doesn't import sqlite3, that's only loaded for a database.
+
+import hashlib, os, time
+from RecipeLoader import iter_recipe_file
+from RecipeJournal import RecipeJournal, journal_path
+import RecipeShards
+from RecipeStore import RecipeStore
+import RecipeSnapshot
+import Stats
+
+DB_SUFFIXES = ('.db', '.sqlite', '.sqlite3')
+SQLITE_HEADER = b'SQLite format 3\0'
+
+def is_database(path):
+    """ True if path is (or, going by its name, is going to be) a recipe database """
+    if os.path.isdir(path):
+        return False
+    if os.path.splitext(path)[1].lower() in DB_SUFFIXES:
+        return True
+    try:
+        with open(path, 'rb') as fp:
+            return fp.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+    except OSError:
+        return False
+
+def storage_for(backend, filename):
+    if is_database(filename):
+        import RecipeDB # keep sqlite3 out of startup
+        return RecipeDB.DatabaseStorage(backend)
+    return FileStorage(backend)
+
+class Storage(object):
+    """ What a storage does for its Backend. The Backend methods these are named after (iter_load,
+    update_recipes, remove_recipes, attach_journal, freeze, diff, reload, write_file) document what's
+    expected, they're called with the defaults (filename and so on) already filled in. """
+    # True for a recipe database, see Backend.is_database
+    database = False
+
+    def __init__(self, backend):
+        self.be = backend
+
+    def load(self, filename, progress, batch_size, snapshot):
+        """ Generator doing the work of Backend.iter_load, on a Backend that was just cleared """
+        raise NotImplementedError
+
+    def update(self, recipes):
+        raise NotImplementedError
+
+    def remove(self, recipe_names):
+        raise NotImplementedError
+
+    def attach_journal(self, filename):
+        return 0
+
+    def freeze(self):
+        raise NotImplementedError
+
+    def diff(self, new, frozen):
+        raise NotImplementedError
+
+    def reload(self, filename, loaded, changes):
+        raise NotImplementedError
+
+    def save(self):
+        """ Backend.write_file to the library we loaded, returns True if it wrote anything """
+        raise NotImplementedError
+
+class FileStorage(Storage):
+    def load(self, filename, progress, batch_size, snapshot):
+        be = self.be
+        start = time.perf_counter()
+        if os.path.isdir(filename):
+            for count in self._load_shards(filename, progress, snapshot):
+                yield count
+            return
+        if snapshot:
+            loaded = RecipeSnapshot.load(filename)
+            if loaded is not None:
+                (be._store, be._nic_base, be._nic_strength) = loaded
+                be.filename = filename
+                Stats.record('backend.load_snapshot', time.perf_counter() - start)
+                yield len(be._store)
+                return
+
+        json_stat = os.stat(filename)
+        paused = 0.0
+        sha = hashlib.sha256()
+        be._store.defer_sorting()
+        count = 0
+        for (kind, name, value) in iter_recipe_file(filename, progress, hasher=sha):
+            if kind == 'config':
+                if type(value) is dict:
+                    be._nic_base = value.get('nic_base', 'vg')
+                    be._nic_strength = value.get('nic_strength', 100)
+                continue
+
+            recipe = be._check_recipe(name, value)
+            if recipe is None:
+                continue
+            be._put_recipe(name, recipe)
+            count += 1
+            if count % batch_size == 0:
+                pause = time.perf_counter()
+                yield count
+                paused += time.perf_counter() - pause
+
+        be._store.names()
+        be.filename = filename
+        if snapshot:
+            be.save_snapshot(json_sha=sha.digest(), json_stat=json_stat)
+        # parsing and validating, without the time spent by whoever was consuming the batches
+        Stats.record('backend.load_json', time.perf_counter() - start - paused)
+        yield count
+
+    def _load_shards(self, dirname, progress, snapshot):
+        """ load for a library directory """
+        be = self.be
+        start = time.perf_counter()
+        paused = 0.0
+        store = be._store
+        (shards, shard_of, shard_files, conflicts) = ({}, {}, {}, [])
+        config = None
+        for (shard, shard_store, nic_base, nic_strength) in RecipeShards.iter_shards(dirname, snapshot,
+                                                                                     progress=progress):
+            if config is None:
+                config = (nic_base, nic_strength, shard)
+            elif (nic_base, nic_strength) != config[:2]:
+                print('Warning: %s has a different _config than %s, using the one in %s'%(shard, config[2], config[2]))
+                conflicts.append(('_config', config[2], shard))
+
+            (names, ignored) = ([], [])
+            for name in shard_store.names():
+                if name in shard_of:
+                    print('Warning: recipe %s is in both %s and %s, using the one in %s'%(
+                          name, shard_of[name], shard, shard_of[name]))
+                    conflicts.append((name, shard_of[name], shard))
+                    ignored.append(name)
+                else:
+                    shard_of[name] = shard
+                    names.append(name)
+            store.merge(shard_store, None if len(names) == len(shard_store) else names)
+            shards[shard] = set(names)
+            # kept so saving the shard doesn't lose them
+            ignored_store = RecipeStore()
+            ignored_store.merge(shard_store, ignored)
+            shard_files[shard] = (ignored_store, nic_base, nic_strength)
+            pause = time.perf_counter()
+            yield len(store)
+            paused += time.perf_counter() - pause
+
+        store.names()
+        if config is not None:
+            (be._nic_base, be._nic_strength) = config[:2]
+        (be._shards, be._shard_of, be._shard_files, be._conflicts) = (shards, shard_of, shard_files, conflicts)
+        be.filename = dirname
+        Stats.record('backend.load_shards', time.perf_counter() - start - paused)
+        yield len(store)
+
+    def update(self, recipes):
+        be = self.be
+        with be._lock:
+            for r in recipes:
+                be._put_recipe(r, recipes[r])
+                be._dirty.add(r)
+                if be._shards is not None and r not in be._shard_of:
+                    RecipeShards.assign(be._shards, be._shard_of, r, RecipeShards.NEW_SHARD)
+        if be._journal is not None:
+            be._journal.log_put(recipes)
+            be._check_journal()
+
+    def remove(self, recipe_names):
+        be = self.be
+        removed = []
+        with be._lock:
+            for r in recipe_names:
+                if be._store.remove(r):
+                    be._bump_version(r)
+                    if be._search is not None:
+                        be._search.remove(r)
+                    be._dirty.add(r)
+                    removed.append(r)
+        if be._journal is not None and removed:
+            be._journal.log_remove(removed)
+            be._check_journal()
+
+    def attach_journal(self, filename):
+        be = self.be
+        be.close_journal()
+        journal = RecipeJournal(journal_path(filename))
+        try:
+            changes = journal.open()
+        except OSError as e:
+            print('Warning: unable to open journal %s: %s'%(journal.path, e))
+            return 0
+        for (name, recipe) in changes:
+            if recipe is None:
+                be.remove_recipe(name)
+            elif type(recipe) is dict:
+                be.update_recipe(name, recipe)
+            else:
+                print('Warning: skipping bad journal record for recipe %s'%name)
+        be._journal = journal
+        return len(changes)
+
+    def freeze(self):
+        be = self.be
+        with be._lock:
+            return (be._store.freeze(), set(be._dirty))
+
+    def diff(self, new, frozen):
+        (old_store, dirty) = frozen if frozen is not None else self.freeze()
+        new_store = new._store
+        added = []
+        modified = []
+        for name in new_store.names():
+            if name in dirty:
+                continue
+            if name not in old_store:
+                added.append(name)
+            elif old_store.get(name) != new_store.get(name):
+                modified.append(name)
+        removed = [name for name in old_store.names() if name not in new_store and name not in dirty]
+        return (added, removed, modified)
+
+    def reload(self, filename, loaded, changes):
+        be = self.be
+        new = loaded
+        if new is None:
+            new = type(be)(cache_size=0)
+            new.load_file(filename)
+        if changes is None:
+            changes = self.diff(new, None)
+
+        with be._lock:
+            # a compaction thread might be clearing some of these
+            dirty = set(be._dirty)
+            (added, removed, modified) = [[name for name in names if name not in dirty] for names in changes]
+
+            # take over the new store (it may well be an mmap'd snapshot), with our unsaved changes on top
+            old_store = be._store
+            new_store = new._store
+            for name in dirty:
+                recipe = old_store.get(name)
+                if recipe is None:
+                    new_store.remove(name)
+                else:
+                    new_store.put(name, recipe)
+            be._store = new_store
+            be._matrix = None
+            be.filename = filename
+            if new._shards is not None:
+                # and the new shard maps, with our unsaved changes still going where they would have
+                (shards, shard_of) = (new._shards, new._shard_of)
+                for name in dirty:
+                    shard = (be._shard_of or {}).get(name, RecipeShards.NEW_SHARD)
+                    RecipeShards.assign(shards, shard_of, name, shard)
+                (be._shards, be._shard_of) = (shards, shard_of)
+                (be._shard_files, be._conflicts) = (new._shard_files, new._conflicts)
+
+            if (new._nic_base, new._nic_strength) != (be._nic_base, be._nic_strength):
+                (be._nic_base, be._nic_strength) = (new._nic_base, new._nic_strength)
+                be._mix_cache.clear()
+            for name in added + removed + modified:
+                be._bump_version(name)
+        if be._search is not None:
+            for name in removed:
+                be._search.remove(name)
+            for name in added + modified:
+                be._search.put(name, new_store.get(name))
+
+        return (added, removed, modified)
+
+    def save(self):
+        be = self.be
+        if not be._dirty and os.path.exists(be.filename):
+            print('Backend.write_file: no changes to save')
+            return False
+        return be._write_prepared(be.filename, be._prepare_write())
@@ -0,0 +1,122 @@
+# Background work for the GUI. Loading/reloading/saving the recipe file and calculating mixes run on
+# QThreadPool threads, so a big library doesn't freeze the windows.
+#
+# TaskRunner.start(kind, fn, *args) runs fn(task, *args) on the pool. Only the newest task of each
+# kind counts: starting one cancels the one before it, and whatever an older task still delivers is
+# dropped, so results never arrive out of order. Cancelling just sets task.cancelled, fn should call
+# task.check() (or task.progress(done, total)) every so often, which raises Cancelled to get out.
+# Results come back on the GUI thread as TaskRunner signals, all carrying the task's kind:
+#   progress(kind, done, total), finished(kind, result), failed(kind, message)
+
+import traceback
+from PyQt4 import QtCore
+from PyQt4.QtCore import pyqtSignal, pyqtSlot
+
+class Cancelled(Exception):
+    pass
+
+class _TaskSignals(QtCore.QObject):
+    # QRunnable isn't a QObject, so the tasks emit through this. It lives in the GUI thread, which
+    # makes the connections to it queued when a pool thread emits.
+    progress = pyqtSignal(str, int, int, int)   # kind, generation, done, total
+    finished = pyqtSignal(str, int, object)
+    failed = pyqtSignal(str, int, str)
+    ended = pyqtSignal(object)
+
+class Task(QtCore.QRunnable):
+    def __init__(self, signals, kind, generation, fn, args):
+        QtCore.QRunnable.__init__(self)
+        # TaskRunner keeps a reference until it's done, see TaskRunner._running
+        self.setAutoDelete(False)
+        self.signals = signals
+        self.kind = kind
+        self.generation = generation
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+
+    def check(self):
+        if self.cancelled:
+            raise Cancelled()
+
+    def progress(self, done, total):
+        self.check()
+        self.signals.progress.emit(self.kind, self.generation, int(done), int(total))
+
+    def run(self):
+        try:
+            result = self.fn(self, *self.args)
+        except Cancelled:
+            pass
+        except Exception as e:
+            traceback.print_exc()
+            self.signals.failed.emit(self.kind, self.generation, str(e))
+        else:
+            self.signals.finished.emit(self.kind, self.generation, result)
+        finally:
+            self.signals.ended.emit(self)
+
+class TaskRunner(QtCore.QObject):
+    progress = pyqtSignal(str, int, int)
+    finished = pyqtSignal(str, object)
+    failed = pyqtSignal(str, str)
+
+    def __init__(self, parent=None, pool=None):
+        QtCore.QObject.__init__(self, parent)
+        self.pool = pool if pool is not None else QtCore.QThreadPool.globalInstance()
+        self._generations = {}      # kind -> generation of the newest task
+        self._current = {}          # kind -> newest task, while it runs
+        self._running = set()       # every task that hasn't ended yet, stale ones included
+        self._signals = _TaskSignals()
+        self._signals.progress.connect(self._handle_progress)
+        self._signals.finished.connect(self._handle_finished)
+        self._signals.failed.connect(self._handle_failed)
+        self._signals.ended.connect(self._handle_ended)
+
+    def start(self, kind, fn, *args):
+        """ Run fn(task, *args) on the pool, cancelling the running task of the same kind """
+        self.cancel(kind)
+        generation = self._generations.get(kind, 0) + 1
+        self._generations[kind] = generation
+        task = Task(self._signals, kind, generation, fn, args)
+        self._current[kind] = task
+        self._running.add(task)
+        self.pool.start(task)
+        return task
+
+    def cancel(self, kind):
+        task = self._current.pop(kind, None)
+        if task is not None:
+            task.cancelled = True
+
+    def cancel_all(self):
+        for kind in list(self._current):
+            self.cancel(kind)
+
+    def is_running(self, kind):
+        return kind in self._current
+
+    def _is_current(self, kind, generation):
+        task = self._current.get(kind)
+        return task is not None and task.generation == generation
+
+    @pyqtSlot(str, int, int, int)
+    def _handle_progress(self, kind, generation, done, total):
+        if self._is_current(kind, generation):
+            self.progress.emit(kind, done, total)
+
+    @pyqtSlot(str, int, object)
+    def _handle_finished(self, kind, generation, result):
+        if self._is_current(kind, generation):
+            del self._current[kind]
+            self.finished.emit(kind, result)
+
+    @pyqtSlot(str, int, str)
+    def _handle_failed(self, kind, generation, message):
+        if self._is_current(kind, generation):
+            del self._current[kind]
+            self.failed.emit(kind, message)
+
+    @pyqtSlot(object)
+    def _handle_ended(self, task):
+        self._running.discard(task)
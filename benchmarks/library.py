@@ -0,0 +1,240 @@
+#! /usr/bin/env python
+# Library size benchmark. Generates synthetic vaperecipes.json libraries of 10 up to 1M recipes
+# and times the things that scale with the library:
+#   construct_json_ms      Backend(file) parsing the json (no snapshot yet, so it writes one too)
+#   construct_snapshot_ms  Backend(file) with an up-to-date RecipeSnapshot
+#   check_recipes_ms       Backend._check_recipes on the parsed json
+#   get_recipes_ms
+#   calculate_mix_<mix>_us per call, uncached, for each of the three mix types
+#   calculate_mix_cached_us
+#   write_file_ms
+#   populate_recipe_box_ms and editor_open_ms, in a child process under the offscreen Qt platform
+#                          (skipped if PyQt4 or a display isn't available, see startup.py)
+# Every number is the median of --repeat runs. Results can be written to json (--json) and compared
+# against an earlier run (--baseline): anything more than --tolerance slower is a regression, and
+# the exit status is 1 so this can be used as a gate.
+# Generated libraries are kept in --data-dir, the 1M one is a couple of hundred MB and takes a while.
+# Usage: python benchmarks/library.py [--sizes 10,1000,...] [--repeat N] [--json FILE] [--baseline FILE]
+
+import argparse, bisect, datetime, json, os, platform, random, statistics, subprocess, sys, tempfile, time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, REPO_DIR)
+from Backend import Backend
+import RecipeSnapshot
+
+SIZES = [10, 100, 1000, 10000, 100000, 1000000]
+MIXES = ['from_ingredients', 'from_concentrate', 'concentrate']
+
+# number of distinct flavors in a generated library, and the vendor prefixes they get
+N_FLAVORS = 3000
+VENDORS = ['TPA', 'CAP', 'FA', 'FW', 'INW', 'LA', 'FLV', 'WF', 'MB', 'OOO']
+WORDS = ['Strawberry', 'Custard', 'Vanilla', 'Mango', 'Cream', 'Cookie', 'Lemon', 'Menthol', 'Tobacco',
+         'Peach', 'Blueberry', 'Cheesecake', 'Apple', 'Caramel', 'Melon', 'Grape', 'Donut', 'Coffee']
+
+# calculate_mix calls per measurement
+MIX_CALLS = 1000
+
+# differences smaller than this are noise, whatever the ratio, by the metric's unit
+MIN_DELTA = {'ms': 1.0, 'us': 2.0}
+
+def generate_library(filename, n_recipes, seed=0):
+    """ Write a library of n_recipes random recipes. Flavor counts are lognormal around 4 (1 to 20),
+    flavor popularity is Zipf-like (a few flavors are in everything, most are rare), strengths are
+    lognormal around 2%, like real DIY recipes. Streamed out, so 1M recipes don't need the memory. """
+    rng = random.Random(seed)
+    flavors = ['%s %s %d'%(VENDORS[i % len(VENDORS)], WORDS[i % len(WORDS)], i) for i in range(N_FLAVORS)]
+    cum = []
+    total = 0.0
+    for k in range(N_FLAVORS):
+        total += 1.0 / (k + 1) ** 1.1
+        cum.append(total)
+
+    tmp_name = filename + '.tmp'
+    with open(tmp_name, 'w', encoding='utf-8') as fp:
+        fp.write('{"_config": {"nic_base": "vg", "nic_strength": 100}, "_recipes": {')
+        for i in range(n_recipes):
+            n = min(1 + int(rng.lognormvariate(1.1, 0.55)), 20)
+            recipe = {}
+            while len(recipe) < n:
+                flavor = flavors[bisect.bisect_left(cum, rng.random() * total)]
+                recipe[flavor] = round(min(rng.lognormvariate(0.7, 0.6), 15.0), 2)
+            name = '%s %s %d'%(rng.choice(WORDS), rng.choice(WORDS), i)
+            fp.write('%s\n%s: %s'%(',' if i else '', json.dumps(name), json.dumps(recipe)))
+        fp.write('\n}}\n')
+    os.replace(tmp_name, filename)
+
+def library_file(data_dir, n_recipes):
+    filename = os.path.join(data_dir, 'lib_%d.json'%n_recipes)
+    if not os.path.exists(filename):
+        print('generating %d recipes...'%n_recipes, file=sys.stderr)
+        generate_library(filename, n_recipes)
+    return filename
+
+def remove_snapshot(filename):
+    try:
+        os.remove(RecipeSnapshot.snapshot_path(filename))
+    except OSError:
+        pass
+
+def median_ms(fn, repeat, setup=None):
+    samples = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        t = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - t) * 1000.0)
+    return statistics.median(samples)
+
+QT_SCRIPT = """
+import sys, time, json
+from PyQt4 import QtGui
+app = QtGui.QApplication(sys.argv)
+import Main
+# the window loads its config file in the background, make that the benchmark library and wait for it
+Main.CONFIG_FILE = %r
+result = {}
+
+win = Main.YaccMain()
+while win.runner.is_running('load'):
+    app.processEvents()
+    time.sleep(0.01)
+app.processEvents()
+be = win.be
+samples = []
+for _ in range(%d):
+    t = time.perf_counter()
+    win.populate_recipe_box()
+    app.processEvents()
+    samples.append((time.perf_counter() - t) * 1000.0)
+result['populate_recipe_box_ms'] = sorted(samples)[len(samples) // 2]
+
+from RecipeEditor import RecipeEditor
+samples = []
+for _ in range(%d):
+    t = time.perf_counter()
+    editor = RecipeEditor(None, be)
+    editor.show()
+    app.processEvents()
+    samples.append((time.perf_counter() - t) * 1000.0)
+    editor.close()
+result['editor_open_ms'] = sorted(samples)[len(samples) // 2]
+win.runner.cancel_all()
+print(json.dumps(result))
+"""
+
+def bench_qt(filename, repeat):
+    """ The Qt measurements, in a child process so a missing PyQt4/display only skips them """
+    env = dict(os.environ)
+    env.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    proc = subprocess.run([sys.executable, '-c', QT_SCRIPT%(filename, repeat, repeat)], cwd=REPO_DIR, env=env,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if proc.returncode != 0:
+        return {}
+    try:
+        return json.loads(proc.stdout.strip().splitlines()[-1])
+    except (ValueError, IndexError):
+        return {}
+
+def bench_size(filename, repeat, qt=True):
+    res = {}
+    quiet = open(os.devnull, 'w')
+    stdout = sys.stdout
+    try:
+        # Backend prints progress and warnings, keep them out of the table
+        sys.stdout = quiet
+        res['construct_json_ms'] = median_ms(lambda: Backend(filename), repeat, lambda: remove_snapshot(filename))
+        res['construct_snapshot_ms'] = median_ms(lambda: Backend(filename), repeat)
+
+        with open(filename, encoding='utf-8') as fp:
+            raw = json.load(fp)['_recipes']
+        be = Backend(filename)
+        res['check_recipes_ms'] = median_ms(lambda: be._check_recipes(raw), repeat)
+        # done with it, don't keep a whole parsed library around for the rest
+        raw = None
+        res['get_recipes_ms'] = median_ms(be.get_recipes, repeat)
+
+        names = be.get_recipes()
+        rng = random.Random(1)
+        sample = [rng.choice(names) for _ in range(MIX_CALLS)]
+        for mix in MIXES:
+            def run():
+                for name in sample:
+                    be.clear_cache()
+                    be.calculate_mix(name, 30, 3, 70, mix)
+            res['calculate_mix_%s_us'%mix] = median_ms(run, repeat) * 1000.0 / MIX_CALLS
+        be.calculate_mix(sample[0], 30, 3, 70, MIXES[0])
+        res['calculate_mix_cached_us'] = median_ms(
+            lambda: [be.calculate_mix(sample[0], 30, 3, 70, MIXES[0]) for _ in range(MIX_CALLS)], repeat) * 1000.0 / MIX_CALLS
+
+        out = os.path.join(os.path.dirname(filename), 'write_test.json')
+        res['write_file_ms'] = median_ms(lambda: be.write_file(out), repeat)
+        os.remove(out)
+        remove_snapshot(out)
+    finally:
+        sys.stdout = stdout
+        quiet.close()
+
+    if qt:
+        res.update(bench_qt(filename, repeat))
+    return res
+
+def compare(results, baseline, tolerance):
+    """ Print how results compare to baseline, returns the number of regressions """
+    regressions = 0
+    print('\n%-10s %-28s %12s %12s %8s'%('recipes', 'metric', 'baseline', 'now', 'ratio'))
+    for (size, metrics) in sorted(results.items(), key=lambda item: int(item[0])):
+        old_metrics = baseline.get(size, {})
+        for (name, value) in sorted(metrics.items()):
+            old = old_metrics.get(name)
+            if old is None:
+                continue
+            ratio = value / old if old > 0 else float('inf')
+            bad = value > old * (1.0 + tolerance) and value - old > MIN_DELTA[name.rsplit('_', 1)[1]]
+            regressions += bad
+            print('%-10s %-34s %12.3f %12.3f %7.2fx %s'%(size, name, old, value, ratio, 'REGRESSION' if bad else ''))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark yacc against synthetic recipe libraries')
+    parser.add_argument('--sizes', default=','.join(str(n) for n in SIZES),
+                        help='comma separated library sizes (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'yacc-bench'),
+                        help='where the generated libraries are kept (default: %(default)s)')
+    parser.add_argument('--no-qt', action='store_true', help="skip the Qt measurements")
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline', help='results json of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='how much slower than the baseline counts as a regression (default: %(default)s)')
+    args = parser.parse_args()
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    results = {}
+    for n in [int(s) for s in args.sizes.split(',') if s.strip()]:
+        filename = library_file(args.data_dir, n)
+        res = bench_size(filename, args.repeat, qt=not args.no_qt)
+        results[str(n)] = res
+        print('%d recipes'%n)
+        for (name, value) in sorted(res.items()):
+            print('    %-34s %12.3f'%(name, value))
+
+    if args.json:
+        meta = {'date': datetime.datetime.now().isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'repeat': args.repeat}
+        with open(args.json, 'w') as fp:
+            json.dump({'meta': meta, 'results': results}, fp, indent=4, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        print('\n%d regression%s'%(regressions, '' if regressions == 1 else 's'))
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
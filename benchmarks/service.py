@@ -0,0 +1,175 @@
+#! /usr/bin/env python
+# Load test for `yacc serve`. Starts the service on a synthetic library (see library.py) in a child
+# process, then runs --connections keep-alive clients against it from this process, each sending
+# its share of --requests back to back:
+#   mix     GET /mix for a random recipe/volume/nic/VG/mix type, most of the traffic
+#   recipe  GET /recipes/<name>, --lookup-ratio of the requests
+#   batch   POST /mix/batch of --batch-size random orders, --batch-ratio of the requests
+# --reloads N also POSTs /reload N times spread over the run, to check a reload doesn't drop or
+# fail anything that's in flight.
+# Prints throughput and latency percentiles per request type. Note the clients share one process
+# and one core, on a fast server they can be the bottleneck: compare with --connections 1 and a
+# couple of concurrent runs before believing a throughput number.
+# Usage: python benchmarks/service.py [--recipes N] [--connections N] [--requests N] [--json FILE]
+
+import argparse, asyncio, json, os, random, re, statistics, subprocess, sys, tempfile, threading, time
+from urllib.parse import quote, urlencode
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+from library import library_file, MIXES
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+def make_requests(names, n, lookup_ratio, batch_ratio, batch_size, seed=0):
+    """ n (kind, request bytes) pairs with a fixed seed, so runs are comparable """
+    rng = random.Random(seed)
+    def order():
+        return {'recipe': rng.choice(names), 'totalvol': rng.choice((10, 30, 60, 120)),
+                'nic': rng.choice((0, 3, 6, 12)), 'vg': rng.choice((50, 70, 80)), 'mix': rng.choice(MIXES)}
+    requests = []
+    for _ in range(n):
+        r = rng.random()
+        if r < batch_ratio:
+            body = json.dumps({'orders': [order() for _ in range(batch_size)]}).encode('utf-8')
+            requests.append(('batch', b'POST /mix/batch HTTP/1.1\r\nHost: localhost\r\n'
+                             b'Content-Type: application/json\r\nContent-Length: %d\r\n\r\n'%len(body) + body))
+        elif r < batch_ratio + lookup_ratio:
+            path = '/recipes/' + quote(rng.choice(names), safe='')
+            requests.append(('recipe', ('GET %s HTTP/1.1\r\nHost: localhost\r\n\r\n'%path).encode('latin-1')))
+        else:
+            path = '/mix?' + urlencode(order())
+            requests.append(('mix', ('GET %s HTTP/1.1\r\nHost: localhost\r\n\r\n'%path).encode('latin-1')))
+    return requests
+
+async def read_response(reader):
+    """ (status, body) of the next response """
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError('connection closed by the server')
+    status = int(status_line.split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        (name, _, value) = line.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+    return (status, await reader.readexactly(length))
+
+async def client(host, port, requests, latencies, errors):
+    (reader, writer) = await asyncio.open_connection(host, port)
+    try:
+        for (kind, data) in requests:
+            t = time.perf_counter()
+            writer.write(data)
+            (status, body) = await read_response(reader)
+            latencies[kind].append(time.perf_counter() - t)
+            if status != 200:
+                errors.append('%s: %d %s'%(kind, status, body[:200].decode('utf-8', 'replace')))
+    finally:
+        writer.close()
+
+async def reloader(host, port, n, duration, errors):
+    """ POST /reload n times over about duration seconds, on its own connection """
+    (reader, writer) = await asyncio.open_connection(host, port)
+    try:
+        for _ in range(n):
+            await asyncio.sleep(duration / (n + 1))
+            writer.write(b'POST /reload HTTP/1.1\r\nHost: localhost\r\nContent-Length: 0\r\n\r\n')
+            (status, body) = await read_response(reader)
+            if status != 200:
+                errors.append('reload: %d %s'%(status, body[:200].decode('utf-8', 'replace')))
+    finally:
+        writer.close()
+
+async def run_load(host, port, requests, connections, reloads, expected_seconds):
+    latencies = {kind: [] for kind in ('mix', 'recipe', 'batch')}
+    errors = []
+    # deal the requests out round robin, every connection gets the same mix
+    tasks = [client(host, port, requests[i::connections], latencies, errors) for i in range(connections)]
+    if reloads:
+        tasks.append(reloader(host, port, reloads, expected_seconds, errors))
+    t = time.perf_counter()
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    elapsed = time.perf_counter() - t
+    for r in results:
+        if isinstance(r, Exception):
+            errors.append('connection failed: %s: %s'%(type(r).__name__, r))
+    return (latencies, errors, elapsed)
+
+def percentile(sorted_values, p):
+    return sorted_values[min(int(len(sorted_values) * p / 100.0), len(sorted_values) - 1)]
+
+def start_server(library):
+    """ Start `yacc serve` on a free port, returns (process, port) once it's listening """
+    proc = subprocess.Popen([sys.executable, '-m', 'yacc', 'serve', '--library', library, '--port', '0',
+                             '--watch', '0'], cwd=REPO_DIR, stdout=subprocess.PIPE, universal_newlines=True)
+    for line in proc.stdout:
+        m = re.match(r'Serving .* on http://[^:]+:(\d+)/', line)
+        if m:
+            # keep reading what it prints (reloads, errors) so it never blocks on a full pipe
+            threading.Thread(target=proc.stdout.read, daemon=True).start()
+            return (proc, int(m.group(1)))
+    proc.wait()
+    raise RuntimeError('yacc serve exited with status %s'%proc.returncode)
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test yacc serve over localhost')
+    parser.add_argument('--recipes', type=int, default=10000, help='library size (default: %(default)s)')
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'yacc-bench'),
+                        help='where the generated libraries are kept (default: %(default)s)')
+    parser.add_argument('--connections', type=int, default=16, help='(default: %(default)s)')
+    parser.add_argument('--requests', type=int, default=20000, help='total requests (default: %(default)s)')
+    parser.add_argument('--lookup-ratio', type=float, default=0.05, help='(default: %(default)s)')
+    parser.add_argument('--batch-ratio', type=float, default=0.01, help='(default: %(default)s)')
+    parser.add_argument('--batch-size', type=int, default=100, help='orders per batch (default: %(default)s)')
+    parser.add_argument('--reloads', type=int, default=0, help='reloads during the run (default: %(default)s)')
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    library = library_file(args.data_dir, args.recipes)
+    with open(library, encoding='utf-8') as fp:
+        names = sorted(json.load(fp)['_recipes'])
+    requests = make_requests(names, args.requests, args.lookup_ratio, args.batch_ratio, args.batch_size)
+
+    (proc, port) = start_server(library)
+    try:
+        # a short warmup run gives a duration estimate to spread the reloads over
+        warmup = requests[:min(len(requests), 500)]
+        (_, _, warm_elapsed) = asyncio.run(run_load('127.0.0.1', port, warmup, args.connections, 0, 0))
+        expected = warm_elapsed * len(requests) / max(len(warmup), 1)
+        (latencies, errors, elapsed) = asyncio.run(run_load('127.0.0.1', port, requests, args.connections,
+                                                            args.reloads, expected))
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    total = sum(len(v) for v in latencies.values())
+    print('%d recipes, %d connections, %d requests in %.2f s: %.0f requests/s, %d errors'%(
+          args.recipes, args.connections, total, elapsed, total / elapsed, len(errors)))
+    results = {'recipes': args.recipes, 'connections': args.connections, 'requests': total,
+               'elapsed_s': elapsed, 'requests_per_s': total / elapsed, 'errors': len(errors), 'latency_ms': {}}
+    print('%-8s %8s %9s' % ('', 'count', 'mean') + ''.join('%9s'%('p%g'%p) for p in PERCENTILES) + '%9s (ms)'%'max')
+    for (kind, values) in sorted(latencies.items()):
+        if not values:
+            continue
+        values = sorted(v * 1000.0 for v in values)
+        stats = {'count': len(values), 'mean': statistics.mean(values), 'max': values[-1]}
+        stats.update(('p%g'%p, percentile(values, p)) for p in PERCENTILES)
+        results['latency_ms'][kind] = stats
+        print('%-8s %8d %9.3f' % (kind, len(values), stats['mean']) +
+              ''.join('%9.3f'%stats['p%g'%p] for p in PERCENTILES) + '%9.3f'%stats['max'])
+    for err in errors[:10]:
+        print('  %s'%err)
+
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(results, fp, indent=4, sort_keys=True)
+    return 1 if errors else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,124 @@
+#! /usr/bin/env python
+# Startup time budget check. Every measurement runs in a fresh interpreter so imports are cold
+# (well, as cold as the OS file cache allows), and is repeated a few times taking the median.
+#   import_backend_ms: import Backend
+#   import_main_ms:    import Main (PyQt4 + the main window, but not the recipe editor)
+#   first_paint_ms:    from interpreter start to the main window's first paint event
+# Also checks that modules which should only load on demand (debugger, recipe editor, numpy...)
+# haven't crept back into the startup imports.
+# Exits with status 1 if anything is over budget, so it can be used as a regression gate.
+# Usage: python benchmarks/startup.py [--runs N] [--budget name=ms ...] [--json FILE]
+
+import argparse, json, os, statistics, subprocess, sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+BUDGETS = {'import_backend_ms': 150.0,
+           'import_main_ms': 800.0,
+           'first_paint_ms': 2000.0}
+
+# modules that must not be imported just by starting up
+LAZY_MODULES = ['pdb', 'pprint', 'tempfile', 'numpy', 'RecipeEditor', 'recipe_builder_window', 'Batch',
+                'RecipeMatrix', 'Planner', 'Server', 'asyncio', 'RecipeDB', 'sqlite3']
+
+IMPORT_SCRIPT = """
+import sys, time, json
+t = time.perf_counter()
+import %s
+t = time.perf_counter() - t
+print(json.dumps({'ms': t * 1000.0, 'loaded': [m for m in %r if m in sys.modules]}))
+"""
+
+PAINT_SCRIPT = """
+import sys, time, json
+t0 = time.perf_counter()
+from PyQt4 import QtCore, QtGui
+import Main
+
+class PaintWatcher(QtCore.QObject):
+    def eventFilter(self, obj, event):
+        if event.type() == QtCore.QEvent.Paint and 'ms' not in result:
+            result['ms'] = (time.perf_counter() - t0) * 1000.0
+            QtCore.QTimer.singleShot(0, app.quit)
+        return False
+
+result = {}
+app = QtGui.QApplication(sys.argv)
+win = Main.YaccMain()
+watcher = PaintWatcher()
+win.installEventFilter(watcher)
+win.show()
+QtCore.QTimer.singleShot(10000, app.quit)
+app.exec_()
+result['loaded'] = [m for m in %r if m in sys.modules]
+print(json.dumps(result))
+"""
+
+def run_child(script):
+    """ Run a measurement script in a new interpreter, returns its json output or None if it failed """
+    env = dict(os.environ)
+    # for Qt builds that support it. Qt4 on X11 needs a display instead, e.g. run this under xvfb-run
+    env.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    proc = subprocess.run([sys.executable, '-c', script], cwd=REPO_DIR, env=env,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if proc.returncode != 0:
+        return None
+    try:
+        return json.loads(proc.stdout.strip().splitlines()[-1])
+    except (ValueError, IndexError):
+        return None
+
+def measure(name, script, runs):
+    samples = []
+    loaded = set()
+    for _ in range(runs):
+        res = run_child(script)
+        if res is None or 'ms' not in res:
+            return None
+        samples.append(res['ms'])
+        loaded.update(res['loaded'])
+    return {'name': name, 'ms': statistics.median(samples), 'samples': samples, 'eager_imports': sorted(loaded)}
+
+def main():
+    parser = argparse.ArgumentParser(description='Check startup time against a budget')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget', action='append', default=[], metavar='NAME=MS',
+                        help='override a budget, e.g. first_paint_ms=1000')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    budgets = dict(BUDGETS)
+    for b in args.budget:
+        (name, ms) = b.split('=', 1)
+        budgets[name] = float(ms)
+
+    checks = [('import_backend_ms', IMPORT_SCRIPT%('Backend', LAZY_MODULES)),
+              ('import_main_ms', IMPORT_SCRIPT%('Main', LAZY_MODULES)),
+              ('first_paint_ms', PAINT_SCRIPT%LAZY_MODULES)]
+
+    failed = False
+    results = []
+    for (name, script) in checks:
+        res = measure(name, script, args.runs)
+        if res is None:
+            # the Qt measurements need PyQt4, which a headless box might not have
+            print('%-18s skipped (failed to run)'%name)
+            results.append({'name': name, 'skipped': True})
+            continue
+
+        res['budget_ms'] = budgets[name]
+        res['ok'] = res['ms'] <= budgets[name] and not res['eager_imports']
+        failed = failed or not res['ok']
+        results.append(res)
+        print('%-18s %8.1f ms  (budget %.0f ms)  %s'%(name, res['ms'], budgets[name], 'ok' if res['ok'] else 'FAIL'))
+        if res['eager_imports']:
+            print('    loaded at startup but should be lazy: %s'%', '.join(res['eager_imports']))
+
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(results, fp, indent=4)
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,42 @@
+#! /usr/bin/env python
+# Compare the memory used by the old dict-of-dicts recipe layout against RecipeStore.
+# Usage: python benchmarks/store_memory.py [n_recipes] [n_flavors]
+
+import os, sys, random, tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from RecipeStore import RecipeStore
+
+def make_recipes(n_recipes, n_flavors, seed=0):
+    """ Random recipes the way the json loader produces them: every recipe gets its own copy
+    of each flavor name string and its own float objects """
+    rng = random.Random(seed)
+    recipes = {}
+    for i in range(n_recipes):
+        n = min(1 + int(rng.expovariate(1/4.0)), 20)
+        recipes['Recipe %d'%i] = {'Flavor %d'%rng.randrange(n_flavors): rng.uniform(0.5, 10) / 100.0
+                                  for _ in range(n)}
+    return recipes
+
+def measure(build):
+    tracemalloc.start()
+    obj = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (obj, size)
+
+def main():
+    n_recipes = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    n_flavors = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+
+    (recipes, dict_size) = measure(lambda: make_recipes(n_recipes, n_flavors))
+    (store, store_size) = measure(lambda: RecipeStore(recipes))
+    # the store shares the recipe name strings with the dicts, count them too
+    name_size = sum(sys.getsizeof(name) for name in recipes)
+
+    print('%d recipes, %d distinct flavors'%(n_recipes, n_flavors))
+    print('  dict of dicts: %8.1f MB'%(dict_size / 1e6))
+    print('  RecipeStore:   %8.1f MB'%((store_size + name_size) / 1e6))
+
+if __name__ == '__main__':
+    main()
@@ -35,7 +35,10 @@ class Ui_MainWindow(object):
         self.label = QtGui.QLabel(self.centralwidget)
         self.label.setObjectName(_fromUtf8("label"))
         self.verticalLayout.addWidget(self.label)
-        self.recipe_list = QtGui.QListWidget(self.centralwidget)
+        self.filter_box = QtGui.QLineEdit(self.centralwidget)
+        self.filter_box.setObjectName(_fromUtf8("filter_box"))
+        self.verticalLayout.addWidget(self.filter_box)
+        self.recipe_list = QtGui.QListView(self.centralwidget)
         self.recipe_list.setUniformItemSizes(True)
         self.recipe_list.setObjectName(_fromUtf8("recipe_list"))
         self.verticalLayout.addWidget(self.recipe_list)
@@ -69,14 +72,10 @@ class Ui_MainWindow(object):
         self.label_2 = QtGui.QLabel(self.centralwidget)
         self.label_2.setObjectName(_fromUtf8("label_2"))
         self.verticalLayout_2.addWidget(self.label_2)
-        self.recipe_table = QtGui.QTableWidget(self.centralwidget)
+        self.recipe_table = QtGui.QTableView(self.centralwidget)
         self.recipe_table.setEditTriggers(QtGui.QAbstractItemView.AllEditTriggers)
         self.recipe_table.setSelectionMode(QtGui.QAbstractItemView.NoSelection)
         self.recipe_table.setObjectName(_fromUtf8("recipe_table"))
-        self.recipe_table.setColumnCount(0)
-        self.recipe_table.setRowCount(1)
-        item = QtGui.QTableWidgetItem()
-        self.recipe_table.setVerticalHeaderItem(0, item)
         self.recipe_table.horizontalHeader().setVisible(True)
         self.recipe_table.horizontalHeader().setStretchLastSection(True)
         self.recipe_table.verticalHeader().setVisible(False)
@@ -102,6 +101,7 @@ class Ui_MainWindow(object):
     def retranslateUi(self, MainWindow):
         MainWindow.setWindowTitle(_translate("MainWindow", "YACC Redipe Editor", None))
         self.label.setText(_translate("MainWindow", "Select Recipe:", None))
+        self.filter_box.setPlaceholderText(_translate("MainWindow", "Search: name with: flavor > 2, flavor", None))
         self.addrecipe_button.setText(_translate("MainWindow", "Add Recipe", None))
         self.delrecipe_button.setText(_translate("MainWindow", "Delete Recipe", None))
         self.renamerecipe_button.setText(_translate("MainWindow", "Rename Recipe", None))
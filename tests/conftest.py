@@ -0,0 +1,26 @@
+# Shared fixtures. The modules are at the top of the repo rather than in a package, so that goes on
+# sys.path here. Run the tests with:  python -m pytest tests
+
+import json, os, sys
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+if REPO_DIR not in sys.path:
+    sys.path.insert(0, REPO_DIR)
+
+# percents, like in a recipe file
+RECIPES = {'Apple Pie': {'Apple': 6.0, 'Cinnamon': 1.5, 'Pie Crust': 4.0},
+           'Banana Cream': {'Banana': 8.0, 'Cream': 5.0},
+           'Heavy': {'Custard': 40.0, 'Vanilla': 25.0},
+           'Menthol': {'Koolada': 2.0},
+           'Empty': {}}
+
+def write_library(path, recipes=RECIPES, nic_base='vg', nic_strength=100):
+    with open(path, 'w') as fp:
+        json.dump({'_config': {'nic_base': nic_base, 'nic_strength': nic_strength}, '_recipes': recipes}, fp)
+    return path
+
+@pytest.fixture
+def library(tmp_path):
+    """ A recipe library json file in a temp directory """
+    return write_library(str(tmp_path / 'recipes.json'))
@@ -0,0 +1,40 @@
+# Order checking and output of `yacc batch`
+
+import csv, json, math
+import pytest
+import Batch
+from Backend import Backend
+
+@pytest.mark.parametrize('order', [{'recipe': 'A', 'totalvol': 'nan'}, {'recipe': 'A', 'totalvol': 'inf'},
+                                   {'recipe': 'A', 'totalvol': 0}, {'recipe': 'A', 'totalvol': -1},
+                                   {'recipe': 'A', 'nic': '-inf'}, {'recipe': 'A', 'vg': 'NaN'},
+                                   {'recipe': 'A', 'nic': 'three'}, {'totalvol': 10}])
+def test_bad_orders(order):
+    assert Batch.check_order(order) is not None
+    # echoed back as given, and still valid JSON
+    json.dumps(order, allow_nan=False)
+
+def test_defaults():
+    order = {'recipe': 'A', 'nic': '0'}
+    assert Batch.check_order(order) is None
+    assert order == {'recipe': 'A', 'totalvol': 10.0, 'nic': 0.0, 'vg': 70.0, 'mix': 'from_ingredients'}
+
+@pytest.mark.parametrize('out_fmt', ['jsonl', 'csv'])
+def test_process_chunk(library, out_fmt):
+    be = Backend(library)
+    rows = [json.dumps(order) for order in [{'recipe': 'Menthol', 'totalvol': 30}, {'recipe': 'Menthol', 'totalvol': 'nan'},
+                                            {'recipe': 'Empty', 'mix': 'concentrate'}, {'recipe': 'Nope'}]] + ['[1, 2]']
+    out = Batch.process_chunk(rows, 'jsonl', out_fmt, backend=be)
+    if out_fmt == 'jsonl':
+        results = [json.loads(line, parse_constant=lambda name: pytest.fail('%s in output'%name))
+                   for line in out.splitlines()]
+        assert results[0]['flavors'] == {'Koolada': 0.6}
+    else:
+        fields = Batch.ORDER_FIELDS + Batch.RESULT_FIELDS
+        results = [dict(zip(fields, row)) for row in csv.reader(out.splitlines())]
+        for result in results:
+            for field in Batch.RESULT_FIELDS[1:-2]:
+                assert result[field] == '' or math.isfinite(float(result[field]))
+    assert [r['status'] for r in results] == ['ok', 'invalid input: bad totalvol',
+                                              'recipe has no flavors to make concentrate from',
+                                              'recipe not found', 'invalid input: not a JSON object']
@@ -0,0 +1,67 @@
+# Changes journaled but not saved come back on the next load (see RecipeJournal)
+
+import os
+import pytest
+from Backend import Backend
+from RecipeJournal import journal_path
+
+def crashed(library, changes=None, removed=()):
+    """ A Backend with the journal attached that makes some changes and then 'dies' without saving """
+    be = Backend(library)
+    be.attach_journal()
+    if changes:
+        be.update_recipes(changes)
+    for name in removed:
+        be.remove_recipe(name)
+    be.close_journal()
+    return be
+
+def test_replay(library):
+    crashed(library, {'Menthol': {'Koolada': 0.03}, 'New': {'Lime': 0.04}}, removed=['Banana Cream'])
+    be = Backend(library)
+    assert be.get_recipe('New') is None
+    assert be.attach_journal() == 3
+    assert be.get_recipe('Menthol') == pytest.approx({'Koolada': 0.03})
+    assert be.get_recipe('New') == pytest.approx({'Lime': 0.04})
+    assert be.get_recipe('Banana Cream') is None
+    # replayed, not saved
+    assert be.is_dirty()
+
+def test_save_cuts_journal(library):
+    be = crashed(library, {'New': {'Lime': 0.04}})
+    be.attach_journal()
+    assert be.write_file()
+    be.close_journal()
+    be = Backend(library)
+    assert be.attach_journal() == 0
+    assert be.get_recipe('New') == pytest.approx({'Lime': 0.04})
+
+def test_replay_twice_is_harmless(library):
+    crashed(library, {'Menthol': {'Koolada': 0.03}})
+    for _ in range(2):
+        be = Backend(library)
+        be.attach_journal()
+        be.close_journal()
+    assert be.get_recipe('Menthol') == pytest.approx({'Koolada': 0.03})
+
+def test_torn_last_record(library):
+    crashed(library, {'Menthol': {'Koolada': 0.03}})
+    with open(journal_path(library), 'ab') as fp:
+        fp.write(b'{"op": "put", "recipe": "Half", "da')
+    be = Backend(library)
+    assert be.attach_journal() == 1
+    assert be.get_recipe('Half') is None
+    assert be.get_recipe('Menthol') == pytest.approx({'Koolada': 0.03})
+
+def test_compact(library):
+    be = crashed(library, {'New': {'Lime': 0.04}})
+    be.attach_journal()
+    size = os.path.getsize(journal_path(library))
+    be.compact_journal(background=False)
+    assert os.path.getsize(journal_path(library)) < size
+    be.update_recipe('Later', {'Mint': 0.01})
+    be.close_journal()
+    be = Backend(library)
+    assert be.get_recipe('New') == pytest.approx({'Lime': 0.04})
+    assert be.attach_journal() == 1
+    assert be.get_recipe('Later') == pytest.approx({'Mint': 0.01})
@@ -0,0 +1,57 @@
+# calculate_mix_batch has to give the same numbers as calculate_mix, clamping included
+
+import pytest
+from Backend import Backend
+from conftest import RECIPES, write_library
+
+NAMES = sorted(name for name in RECIPES if name != 'Empty')
+# (totalvol, nic, vg): plain, clamped to Max VG, clamped to Max PG (nic in VG base with vg 0), big batch
+ORDERS = [(10.0, 3.0, 70.0), (30.0, 6.0, 100.0), (60.0, 12.0, 0.0), (1000.0, 0.0, 0.5)]
+
+@pytest.fixture(params=['vg', 'pg'])
+def backend(request, tmp_path):
+    return Backend(write_library(str(tmp_path / 'recipes.json'), nic_base=request.param, nic_strength=48))
+
+@pytest.mark.parametrize('mix', ['from_ingredients', 'from_concentrate', 'concentrate'])
+def test_batch_matches_scalar(backend, mix):
+    orders = [(name, totalvol, nic, vg) for name in NAMES for (totalvol, nic, vg) in ORDERS]
+    res = backend.calculate_mix_batch(*zip(*orders), mix=mix)
+    assert res['valid'].all()
+    for (i, (name, totalvol, nic, vg)) in enumerate(orders):
+        mix_result = backend.calculate_mix(name, totalvol, nic, vg, mix)
+        (start, end) = (res['flavor_offsets'][i], res['flavor_offsets'][i+1])
+        assert list(res['flavors'][start:end]) == list(mix_result.flavors)
+        assert res['flavor_vol'][start:end] == pytest.approx(mix_result.volumes)
+        assert res['concentrate'][i] == pytest.approx(mix_result.concentrate)
+        assert res['nic'][i] == pytest.approx(mix_result.nic)
+        assert res['vg'][i] == pytest.approx(mix_result.vg)
+        assert res['pg'][i] == pytest.approx(mix_result.pg)
+        assert res['makes'][i] == pytest.approx(mix_result.makes)
+        clamp = {0: None, 1: 'Using Max VG', -1: 'Using Max PG'}[int(res['clamp'][i])]
+        if clamp is None:
+            assert not mix_result.message
+        else:
+            assert mix_result.message.startswith(clamp)
+
+def test_clamping_happens(backend):
+    # make sure the orders above actually cover both clamps
+    res = backend.calculate_mix_batch(['Heavy', 'Menthol'], [30.0, 60.0], [6.0, 12.0], [100.0, 0.0])
+    if backend.get_config()['nic_base'] == 'vg':
+        assert list(res['clamp']) == [1, -1]
+    else:
+        assert res['clamp'][0] == 1
+
+def test_unknown_recipe(backend):
+    res = backend.calculate_mix_batch(['Apple Pie', 'Nope'])
+    assert list(res['valid']) == [True, False]
+    assert res['flavor_offsets'][2] == res['flavor_offsets'][1]
+    assert backend.calculate_mix('Nope') is None
+
+def test_cache_follows_changes(backend):
+    first = backend.calculate_mix('Menthol', 10, 3, 70, 'from_ingredients')
+    assert backend.calculate_mix('Menthol', 10, 3, 70, 'from_ingredients') is first
+    backend.update_recipe('Menthol', {'Koolada': 0.05})
+    changed = backend.calculate_mix('Menthol', 10, 3, 70, 'from_ingredients')
+    assert changed.volumes == pytest.approx((0.5,))
+    res = backend.calculate_mix_batch(['Menthol'], 10, 3, 70)
+    assert res['flavor_vol'] == pytest.approx([0.5])
@@ -0,0 +1,99 @@
+# The HTTP service's error paths, through Server.dispatch (no sockets) and response()
+
+import asyncio, json
+import pytest
+import Server
+from Backend import Backend
+
+def strict_json(data):
+    """ json.loads that refuses NaN/Infinity, like a browser would """
+    def bad_constant(name):
+        raise ValueError('%s is not JSON'%name)
+    return json.loads(data.decode('utf-8') if isinstance(data, bytes) else data, parse_constant=bad_constant)
+
+@pytest.fixture
+def server(library):
+    return Server.Server(Backend(library), library, watch=0)
+
+def request(server, method, target, body=None):
+    """ (status, decoded JSON) the way a client would get them """
+    async def run():
+        server._reload_lock = asyncio.Lock()
+        return await server.dispatch(method, target, b'' if body is None else json.dumps(body).encode('utf-8'))
+    (status, obj) = asyncio.run(run())
+    data = Server.response(status, obj, False)
+    (head, _, body) = data.partition(b'\r\n\r\n')
+    return (int(head.split()[1]), strict_json(body))
+
+def test_mix(server):
+    (status, obj) = request(server, 'GET', '/mix?recipe=Menthol&totalvol=30&nic=6')
+    assert status == 200
+    assert obj['flavors'] == {'Koolada': 0.6}
+
+@pytest.mark.parametrize('query', ['totalvol=0', 'totalvol=nan', 'totalvol=inf', 'totalvol=-10', 'nic=nan',
+                                   'vg=-inf', 'totalvol=lots', 'mix=juice'])
+def test_bad_order(server, query):
+    (status, obj) = request(server, 'GET', '/mix?recipe=Menthol&' + query)
+    assert status == 400
+    assert 'invalid input' in obj['error']
+
+def test_bad_order_post(server):
+    (status, obj) = request(server, 'POST', '/mix', {'recipe': 'Menthol', 'totalvol': 0})
+    assert status == 400
+    (status, obj) = request(server, 'POST', '/mix', ['not', 'an', 'object'])
+    assert status == 400
+
+def test_concentrate_without_flavors(server):
+    (status, obj) = request(server, 'POST', '/mix', {'recipe': 'Empty', 'mix': 'concentrate'})
+    assert status == 400
+    assert 'no flavors' in obj['error']
+
+def test_not_found(server):
+    assert request(server, 'GET', '/mix?recipe=Nope')[0] == 404
+    assert request(server, 'GET', '/recipes/Nope')[0] == 404
+    assert request(server, 'GET', '/nothing')[0] == 404
+    assert request(server, 'DELETE', '/mix')[0] == 405
+
+def test_bad_body(server):
+    async def run():
+        return await server.dispatch('POST', '/mix', b'{"recipe": ')
+    assert asyncio.run(run())[0] == 400
+
+def test_batch(server):
+    orders = [{'recipe': 'Menthol'}, {'recipe': 'Empty', 'mix': 'concentrate'}, {'recipe': 'Menthol', 'totalvol': 'NaN'},
+              {'recipe': 'Nope'}, {'recipe_name': 'Apple Pie', 'mix': 'concentrate', 'totalvol': 11.5}]
+    (status, obj) = request(server, 'POST', '/mix/batch', {'orders': orders})
+    assert status == 200
+    statuses = [result['status'] for result in obj['results']]
+    assert statuses[0] == 'ok'
+    assert 'no flavors' in statuses[1]
+    assert statuses[2] == 'invalid input: bad totalvol'
+    assert statuses[3] == 'recipe not found'
+    assert obj['results'][4]['makes_ml'] == pytest.approx(100.0)
+
+def test_batch_on_executor(server, monkeypatch):
+    # the same answer when it's done on an executor thread and encoded there
+    orders = [{'recipe': name, 'totalvol': 30} for name in ('Menthol', 'Heavy', 'Nope')] * 10
+    (_, inline) = request(server, 'POST', '/mix/batch', {'orders': orders})
+    monkeypatch.setattr(Server, 'EXECUTOR_MIN_BODY', 0)
+    (status, on_executor) = request(server, 'POST', '/mix/batch', {'orders': orders})
+    assert status == 200
+    assert on_executor == inline
+
+def test_batch_limits(server, monkeypatch):
+    monkeypatch.setattr(Server, 'MAX_BATCH', 2)
+    assert request(server, 'POST', '/mix/batch', {'orders': [{'recipe': 'Menthol'}] * 3})[0] == 413
+    assert request(server, 'POST', '/mix/batch', {'nothing': []})[0] == 400
+
+def test_no_nan_in_responses():
+    (head, _, body) = Server.response(200, {'makes_ml': float('inf')}, True).partition(b'\r\n\r\n')
+    assert head.startswith(b'HTTP/1.1 500')
+    strict_json(body)
+
+def test_search_waits_for_index(server):
+    assert not server.be.has_search_index()
+    (status, obj) = request(server, 'GET', '/recipes?q=apple')
+    assert status == 200
+    assert obj['recipes'] == ['Apple Pie']
+    assert server.be.has_search_index()
+    assert request(server, 'GET', '/recipes?limit=x')[0] == 400
@@ -0,0 +1,87 @@
+# Saving a library directory (see RecipeShards): only changed shards are written, nothing in a
+# shard is lost to a conflict
+
+import json, os
+import pytest
+import RecipeShards
+from Backend import Backend
+from conftest import write_library
+
+def read(path):
+    with open(path) as fp:
+        return json.load(fp)
+
+@pytest.fixture
+def shards(tmp_path):
+    """ Two shards that both have 'Dup', with different _configs """
+    dirname = str(tmp_path / 'library')
+    os.mkdir(dirname)
+    write_library(os.path.join(dirname, 'a.json'), {'Dup': {'Apple': 5.0}, 'X': {'Banana': 3.0}})
+    write_library(os.path.join(dirname, 'b.json'), {'Dup': {'Cherry': 7.0}, 'Y': {'Date': 2.0}},
+                  nic_base='pg', nic_strength=48)
+    return dirname
+
+def test_conflicts(shards):
+    be = Backend(shards)
+    assert be.is_sharded()
+    assert sorted(be.get_conflicts()) == [('Dup', 'a.json', 'b.json'), ('_config', 'a.json', 'b.json')]
+    assert be.get_recipe('Dup') == pytest.approx({'Apple': 0.05})
+    assert be.get_config()['nic_base'] == 'vg'
+
+def test_save_keeps_ignored_copy_and_config(shards):
+    be = Backend(shards)
+    be.update_recipe('Y', {'Date': 0.04})
+    assert be.write_file()
+    b = read(os.path.join(shards, 'b.json'))
+    assert b['_recipes']['Dup'] == pytest.approx({'Cherry': 7.0})
+    assert b['_recipes']['Y'] == pytest.approx({'Date': 4.0})
+    assert b['_config'] == {'nic_base': 'pg', 'nic_strength': 48}
+    # and the same again after loading what was saved (from the snapshots this time)
+    be = Backend(shards)
+    assert be.get_recipe('Dup') == pytest.approx({'Apple': 0.05})
+    be.update_recipe('Y', {'Date': 0.05})
+    assert be.write_file()
+    b = read(os.path.join(shards, 'b.json'))
+    assert b['_recipes']['Dup'] == pytest.approx({'Cherry': 7.0})
+    assert b['_config'] == {'nic_base': 'pg', 'nic_strength': 48}
+
+def test_only_changed_shards_written(shards, monkeypatch):
+    be = Backend(shards)
+    written = []
+    write_json = be._write_json
+    def recording(filename, *args):
+        written.append(os.path.basename(filename))
+        return write_json(filename, *args)
+    monkeypatch.setattr(be, '_write_json', recording)
+    be.update_recipe('X', {'Banana': 0.04})
+    assert be.write_file()
+    assert written == ['a.json']
+    assert not be.write_file()
+
+def test_new_and_removed_recipes(shards):
+    be = Backend(shards)
+    be.update_recipe('New', {'Lime': 0.04})
+    be.remove_recipe('X')
+    assert be.write_file()
+    assert list(read(os.path.join(shards, RecipeShards.NEW_SHARD))['_recipes']) == ['New']
+    assert sorted(read(os.path.join(shards, 'a.json'))['_recipes']) == ['Dup']
+    assert Backend(shards).get_recipes() == ['Dup', 'New', 'Y']
+
+def test_export_to_another_directory(shards, tmp_path):
+    be = Backend(shards)
+    other = str(tmp_path / 'copy')
+    os.mkdir(other)
+    assert be.write_file(other)
+    assert RecipeShards.list_shards(other) == ['a.json', 'b.json']
+    assert read(os.path.join(other, 'b.json'))['_recipes']['Dup'] == pytest.approx({'Cherry': 7.0})
+
+def test_reload_keeps_unsaved_changes(shards):
+    be = Backend(shards)
+    be.update_recipe('Y', {'Date': 0.06})
+    write_library(os.path.join(shards, 'a.json'), {'Dup': {'Apple': 5.0}, 'X': {'Banana': 9.0}})
+    (added, removed, modified) = be.reload()
+    assert (added, removed, modified) == ([], [], ['X'])
+    assert be.get_recipe('X') == pytest.approx({'Banana': 0.09})
+    assert be.get_recipe('Y') == pytest.approx({'Date': 0.06})
+    assert be.write_file()
+    assert read(os.path.join(shards, 'b.json'))['_recipes']['Dup'] == pytest.approx({'Cherry': 7.0})
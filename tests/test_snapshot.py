@@ -0,0 +1,77 @@
+# When a RecipeSnapshot can be used instead of the json, and when it's stale
+
+import os
+import pytest
+import RecipeSnapshot
+from Backend import Backend
+from conftest import RECIPES, write_library
+
+@pytest.fixture
+def hashes(monkeypatch):
+    """ Counts the times the json gets hashed """
+    calls = []
+    hash_file = RecipeSnapshot.hash_file
+    def counting(filename):
+        calls.append(filename)
+        return hash_file(filename)
+    monkeypatch.setattr(RecipeSnapshot, 'hash_file', counting)
+    return calls
+
+def touch(path):
+    """ New mtime, same content """
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+def test_loaded_from_snapshot(library):
+    be = Backend(library)
+    assert os.path.exists(RecipeSnapshot.snapshot_path(library))
+    (store, nic_base, nic_strength) = RecipeSnapshot.load(library)
+    assert (nic_base, nic_strength) == ('vg', 100)
+    assert list(store.names()) == be.get_recipes()
+    for name in store.names():
+        assert store.get(name) == pytest.approx(be.get_recipe(name))
+
+def test_touched_json_is_hashed_once(library, hashes):
+    Backend(library)
+    touch(library)
+    assert RecipeSnapshot.load(library) is not None
+    assert len(hashes) == 1
+    # the new mtime went into the snapshot, so that was the last time
+    assert RecipeSnapshot.load(library) is not None
+    assert len(hashes) == 1
+
+def test_changed_json_same_size(library):
+    Backend(library)
+    size = os.path.getsize(library)
+    recipes = dict(RECIPES, Menthol={'Koolada': 3.0})
+    write_library(library, recipes)
+    assert os.path.getsize(library) == size
+    assert RecipeSnapshot.load(library) is None
+    assert Backend(library).get_recipe('Menthol') == pytest.approx({'Koolada': 0.03})
+
+def test_changed_json_size(library, hashes):
+    Backend(library)
+    write_library(library, dict(RECIPES, New={'Lime': 4.0}))
+    assert RecipeSnapshot.load(library) is None
+    # the size alone says it's stale
+    assert hashes == []
+
+def test_snapshot_written_after_save(library, hashes):
+    be = Backend(library)
+    be.update_recipe('New', {'Lime': 0.04})
+    assert be.write_file()
+    (store, _, _) = RecipeSnapshot.load(library)
+    assert store.get('New') == pytest.approx({'Lime': 0.04})
+    assert hashes == []
+
+def test_long_nic_base_rejected(library):
+    be = Backend(library)
+    with pytest.raises(ValueError):
+        RecipeSnapshot.write(library, be._store, 'x' * 17, 100)
+
+def test_bad_snapshot_ignored(library):
+    Backend(library)
+    with open(RecipeSnapshot.snapshot_path(library), 'r+b') as fp:
+        fp.truncate(100)
+    assert RecipeSnapshot.load(library) is None
+    assert Backend(library).get_recipes() == sorted(RECIPES)
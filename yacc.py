@@ -0,0 +1,47 @@
+#! /usr/bin/env python
+# Command line entry point for everything that doesn't need the GUI:
+#   python -m yacc batch ...
+#   python -m yacc shop ...
+#   python -m yacc plan ...
+#   python -m yacc serve ...
+#   python -m yacc import ...
+# The GUI itself is still Main.py. Nothing in here imports Qt.
+
+import argparse, sys
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='yacc', description='Yet Another E-Liquid Calculator')
+    subparsers = parser.add_subparsers(dest='command', metavar='command')
+    subparsers.required = True
+
+    import Batch
+    batch_parser = subparsers.add_parser('batch', help='calculate mixes for a file of orders (CSV/JSONL)')
+    Batch.add_arguments(batch_parser)
+    batch_parser.set_defaults(func=Batch.main)
+    shop_parser = subparsers.add_parser('shop', help='total up the ingredients needed for a file of orders')
+    Batch.add_shop_arguments(shop_parser)
+    shop_parser.set_defaults(func=Batch.shop_main)
+
+    import Planner
+    plan_parser = subparsers.add_parser('plan', help='plan production from the ingredients in stock')
+    Planner.add_arguments(plan_parser)
+    plan_parser.set_defaults(func=Planner.main)
+
+    import Server
+    serve_parser = subparsers.add_parser('serve', help='serve mixes and recipes over HTTP/JSON on this machine')
+    Server.add_arguments(serve_parser)
+    serve_parser.set_defaults(func=Server.main)
+
+    import RecipeDB
+    import_parser = subparsers.add_parser('import', help='import a json recipe library into a recipe database')
+    RecipeDB.add_arguments(import_parser)
+    import_parser.set_defaults(func=RecipeDB.main)
+
+    args = parser.parse_args(argv)
+    # YACC_PROFILE works for these too
+    import Stats
+    Stats.start_profiling()
+    return args.func(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
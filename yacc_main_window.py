@@ -45,6 +45,13 @@ class Ui_yacc_main_window(object):
         self.formLayout.setLabelAlignment(QtCore.Qt.AlignRight|QtCore.Qt.AlignTrailing|QtCore.Qt.AlignVCenter)
         self.formLayout.setVerticalSpacing(15)
         self.formLayout.setObjectName(_fromUtf8("formLayout"))
+        self.label_6 = QtGui.QLabel(self.centralwidget)
+        self.label_6.setObjectName(_fromUtf8("label_6"))
+        self.formLayout.setWidget(0, QtGui.QFormLayout.LabelRole, self.label_6)
+        self.filter_box = QtGui.QLineEdit(self.centralwidget)
+        self.filter_box.setMinimumSize(QtCore.QSize(200, 0))
+        self.filter_box.setObjectName(_fromUtf8("filter_box"))
+        self.formLayout.setWidget(0, QtGui.QFormLayout.FieldRole, self.filter_box)
         self.label = QtGui.QLabel(self.centralwidget)
         self.label.setObjectName(_fromUtf8("label"))
         self.formLayout.setWidget(1, QtGui.QFormLayout.LabelRole, self.label)
@@ -157,6 +164,8 @@ class Ui_yacc_main_window(object):
         self.label_3.setText(_translate("yacc_main_window", "Nicotine [mg/mL]", None))
         self.label_2.setText(_translate("yacc_main_window", "VG [%]", None))
         self.label_5.setText(_translate("yacc_main_window", "Recipe", None))
+        self.label_6.setText(_translate("yacc_main_window", "Search", None))
+        self.filter_box.setPlaceholderText(_translate("yacc_main_window", "name with: flavor > 2, flavor", None))
         self.update_button.setText(_translate("yacc_main_window", "Update", None))
         self.reload_button.setText(_translate("yacc_main_window", "Reload", None))
         self.redit_button.setText(_translate("yacc_main_window", "Edit Recipes", None))